@@ -0,0 +1,267 @@
+"""Run Python scripts cell by cell, resuming from checkpoints of unchanged cells.
+
+A script is split into cells at ``# %%`` marker lines or, without markers, at its
+top-level statements. After cells that took a while, the namespace is pickled to a
+checkpoint keyed by the source of all cells so far. When a fixed version of the script
+is run again, execution resumes after the last checkpoint whose cells are unchanged:
+imports, function and class definitions of the skipped cells are replayed, the other
+variables are loaded, and the script continues from the first changed cell.
+
+Resuming skips the side effects of the skipped cells, such as the global random state,
+so it is meant for bug fix retries of the same run.
+
+This module only uses the standard library, as it is run as a script by
+``tools.run_python_script``.
+"""
+
+import ast
+import hashlib
+import json
+import os
+import pickle
+import sys
+import time
+import traceback
+import types
+from pathlib import Path
+from typing import Optional
+
+# Marker line starting a new cell, as in Jupyter's percent format
+CELL_MARKER = "# %%"
+# Seconds of execution since the last checkpoint after which the namespace is saved
+MIN_CHECKPOINT_SECONDS = 1.0
+# Statements re-executed instead of loaded when resuming
+REPLAYED_STATEMENTS = (
+    ast.Import,
+    ast.ImportFrom,
+    ast.FunctionDef,
+    ast.AsyncFunctionDef,
+    ast.ClassDef,
+)
+# Values that are restored by replaying their definitions
+_SKIPPED_TYPES = (
+    types.ModuleType,
+    types.FunctionType,
+    types.BuiltinFunctionType,
+    type,
+)
+
+
+def split_cells(source: str, tree: Optional[ast.Module] = None) -> list[dict]:
+    """Split a script into cells.
+
+    Args:
+        source: Source of the script
+        tree: Parsed source, parsed here if not given
+
+    Returns:
+        Cells with their top-level statements, first line and a key identifying the
+        cell together with all cells before it
+    """
+    tree = tree or ast.parse(source)
+    lines = source.splitlines(keepends=True)
+    markers = [
+        number for number, line in enumerate(lines, 1) if line.startswith(CELL_MARKER)
+    ]
+
+    groups = {}
+    for statement in tree.body:
+        start = min(
+            [statement.lineno] + [d.lineno for d in getattr(statement, "decorator_list", [])]
+        )
+        # Without markers, every statement is its own cell
+        index = sum(marker <= start for marker in markers) if markers else len(groups)
+        groups.setdefault(index, []).append((start, statement))
+
+    cells = []
+    digest = hashlib.sha1()
+    for statements in groups.values():
+        start = statements[0][0]
+        end = statements[-1][1].end_lineno
+        digest.update("".join(lines[start - 1 : end]).encode())
+        cells.append(
+            {
+                "statements": [statement for _, statement in statements],
+                "lineno": start,
+                "key": digest.hexdigest(),
+            }
+        )
+    return cells
+
+
+class _HashingWriter:
+    """File wrapper hashing what is written, so blobs are stored by content."""
+
+    def __init__(self, file) -> None:
+        self.file = file
+        self.digest = hashlib.sha1()
+
+    def write(self, data) -> int:
+        self.digest.update(data)
+        return self.file.write(data)
+
+
+class CheckpointStore:
+    """Checkpoints of a script's namespace after its cells.
+
+    Each checkpoint lists the pickled variables by content hash, so variables that did
+    not change between checkpoints are stored once.
+    """
+
+    def __init__(self, directory: str | Path) -> None:
+        self.directory = Path(directory)
+        self.blob_dir = self.directory / "blobs"
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def find(self, cells: list[dict]) -> Optional[int]:
+        """Index of the last cell with a complete checkpoint, if any."""
+        for index in range(len(cells) - 1, -1, -1):
+            path = self._path(cells[index]["key"])
+            if not path.exists():
+                continue
+            try:
+                blobs = json.loads(path.read_text())["variables"].values()
+            except (OSError, ValueError, KeyError):
+                continue
+            if all((self.blob_dir / f"{blob}.pkl").exists() for blob in blobs):
+                return index
+        return None
+
+    def save(self, key: str, namespace: dict) -> Optional[str]:
+        """Pickle the variables of a namespace.
+
+        Returns:
+            Name of a variable that cannot be pickled, in which case nothing is saved
+        """
+        variables = {}
+        for name, value in namespace.items():
+            if name.startswith("__") or isinstance(value, _SKIPPED_TYPES):
+                continue
+            tmp_path = self.blob_dir / f"{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, "wb") as file:
+                    writer = _HashingWriter(file)
+                    pickle.dump(value, writer, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception:  # noqa: BLE001
+                tmp_path.unlink(missing_ok=True)
+                return name
+            blob = writer.digest.hexdigest()
+            tmp_path.replace(self.blob_dir / f"{blob}.pkl")
+            variables[name] = blob
+        self._path(key).write_text(json.dumps({"variables": variables}))
+        return None
+
+    def load(self, key: str) -> dict:
+        """Load the variables of a checkpoint."""
+        variables = json.loads(self._path(key).read_text())["variables"]
+        namespace = {}
+        for name, blob in variables.items():
+            with open(self.blob_dir / f"{blob}.pkl", "rb") as file:
+                namespace[name] = pickle.load(file)  # noqa: S301
+        return namespace
+
+    def prune(self, cells: list[dict]) -> None:
+        """Remove checkpoints of other versions of the script and unused blobs."""
+        keys = {cell["key"] for cell in cells}
+        used = set()
+        for path in self.directory.glob("*.json"):
+            if path.stem not in keys:
+                path.unlink(missing_ok=True)
+                continue
+            try:
+                used.update(json.loads(path.read_text())["variables"].values())
+            except (OSError, ValueError, KeyError):
+                path.unlink(missing_ok=True)
+        for path in self.blob_dir.glob("*.pkl"):
+            if path.stem not in used:
+                path.unlink(missing_ok=True)
+
+
+def _execute(statements: list[ast.stmt], script: str, namespace: dict) -> None:
+    code = compile(ast.Module(body=statements, type_ignores=[]), script, "exec")
+    exec(code, namespace)  # noqa: S102
+
+
+def run_cells(script: str | Path, checkpoint_dir: str | Path) -> int:
+    """Run a script cell by cell, resuming from its last valid checkpoint.
+
+    Args:
+        script: Path to Python script
+        checkpoint_dir: Directory of the script's checkpoints
+
+    Returns:
+        Exit code of the script
+    """
+    script = str(Path(script).resolve())
+    source = Path(script).read_text()
+    try:
+        tree = ast.parse(source, script)
+    except SyntaxError as e:
+        traceback.print_exception(type(e), e, None)
+        return 1
+    cells = split_cells(source, tree)
+    store = CheckpointStore(checkpoint_dir)
+    store.prune(cells)
+
+    # Same module, search path and arguments as 'python script.py'. The namespace is
+    # registered as __main__, so that its functions and classes can be pickled.
+    module = types.ModuleType("__main__")
+    module.__file__ = script
+    sys.modules["__main__"] = module
+    sys.path[0] = str(Path(script).parent)
+    sys.argv = [script]
+    namespace = module.__dict__
+
+    first = 0
+    resumed = store.find(cells)
+    if resumed is not None and resumed < len(cells) - 1:
+        try:
+            for cell in cells[: resumed + 1]:
+                replayed = [s for s in cell["statements"] if isinstance(s, REPLAYED_STATEMENTS)]
+                _execute(replayed, script, namespace)
+            namespace.update(store.load(cells[resumed]["key"]))
+            first = resumed + 1
+            print(
+                f"Resuming at cell {first + 1} of {len(cells)} (line {cells[first]['lineno']}) "
+                "from a checkpoint",
+                flush=True,
+            )
+        except Exception as e:  # noqa: BLE001
+            print(f"Cannot restore checkpoint, running from the start: {e!s}", flush=True)
+            namespace.clear()
+            namespace.update({"__name__": "__main__", "__file__": script})
+
+    last_checkpoint = time.perf_counter()
+    for index in range(first, len(cells)):
+        try:
+            _execute(cells[index]["statements"], script, namespace)
+        except SystemExit:
+            raise
+        except BaseException as e:  # noqa: BLE001
+            # Print the traceback from the script's frames, as the interpreter would
+            tb = e.__traceback__
+            while tb is not None and tb.tb_frame.f_code.co_filename != script:
+                tb = tb.tb_next
+            traceback.print_exception(type(e), e, tb or e.__traceback__)
+            return 1
+        if (
+            index < len(cells) - 1
+            and time.perf_counter() - last_checkpoint >= MIN_CHECKPOINT_SECONDS
+        ):
+            unpicklable = store.save(cells[index]["key"], namespace)
+            if unpicklable is not None:
+                print(
+                    f"Skipping checkpoint after cell {index + 1}: cannot pickle "
+                    f"'{unpicklable}'",
+                    flush=True,
+                )
+            last_checkpoint = time.perf_counter()
+    return 0
+
+
+if __name__ == "__main__":
+    # Started by tools.run_python_script with the script and its checkpoint directory
+    sys.exit(run_cells(sys.argv[1], sys.argv[2]))
@@ -2,18 +2,29 @@
 
 import logging
 from datetime import datetime
+import functools
 import json
+import uuid
 from pathlib import Path
-from typing import Optional, Union
+from typing import Callable, Optional, Union
 import asyncio
 
-from ..llm import LLMClient
+import pandas as pd
+
+from ..llm import LLMClient, _run_sync
+from ..tools import thread_limit_env
+from ..worker_pool import WorkerPool
 from .base import BaseAgent
+from .budget import DEFAULT_MAX_PROMPT_TOKENS
 from .data_processor import DataProcessor
+from .dev_sample import DevSample
 from .feature_engineer import FeatureEngineer
+from .fix_memory import FixMemory
 from .model_builder import ModelBuilder
 from .submission_generator import SubmissionGenerator
+from .scheduler import TaskGraph
 from .scraper import CompetitionScraper
+from .stage_cache import StageCache, data_fingerprint
 from .utils import (
     read_data_dictionary,
     read_problem_description,
@@ -21,6 +32,11 @@ from .utils import (
 
 logger = logging.getLogger(__name__)
 TIMEZONE = datetime.now().astimezone().tzinfo
+# State of a run in its output directory, read to resume it
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+# Characters of a stage's error kept in the manifest
+MAX_MANIFEST_ERROR_CHARS = 4000
 
 
 class CompetitionAgent(BaseAgent):
@@ -32,6 +48,25 @@ class CompetitionAgent(BaseAgent):
         competition_url: Optional[str] = None,
         llm_provider: str = "openai",
         model_name: str = "gpt-4o",
+        use_cache: bool = True,
+        max_concurrency: int = 4,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        fallback_targets: Optional[list[str]] = None,
+        routes: Optional[dict[str, list[str]]] = None,
+        max_prompt_tokens: int = DEFAULT_MAX_PROMPT_TOKENS,
+        profile_data: bool = True,
+        dev_sample_rows: Optional[int] = None,
+        warm_workers: int = 0,
+        script_limits: Optional[dict] = None,
+        checkpoint_cells: bool = False,
+        preflight: bool = True,
+        fix_candidates: int = 1,
+        fix_targets: Optional[list[str]] = None,
+        fix_memory: bool = True,
+        patch_fixes: bool = True,
+        stage_cache: bool = True,
+        run_dir: Optional[str | Path] = None,
     ) -> None:
         """Initialize AutoML agent.
 
@@ -41,6 +76,57 @@ class CompetitionAgent(BaseAgent):
                 only if required files don't already exist
             llm_provider: LLM provider to use
             model_name: Name of the model to use
+            use_cache: Whether to reuse cached LLM responses for identical prompts
+            max_concurrency: Maximum number of concurrent LLM requests across all agents
+            requests_per_minute: Optional cap on the LLM request rate across all agents
+            tokens_per_minute: Optional cap on the LLM prompt token rate across all agents
+            fallback_targets: Optional 'provider:model' targets that LLM requests are hedged
+                to when they are slow or fail
+            routes: Optional 'provider:model' targets per pipeline stage ('plan_tasks',
+                'DataProcessor', 'FeatureEngineer', 'ModelBuilder', 'SubmissionGenerator'
+                or 'BugFixer')
+            max_prompt_tokens: Token budget of the agents' prompts. Larger dataset info and
+                code are compacted to fit
+            profile_data: Add column statistics of the data to the data processing,
+                feature engineering and model building prompts. Computed in one streaming
+                pass per table and cached in a ``.profile.json`` file next to the data
+            dev_sample_rows: If set, generated scripts are first run and fixed on a
+                sample of about this many rows per table, and only run on the full data
+                once they pass. The sample is stratified on the label, time-contiguous
+                for time series and consistent across tables sharing a join key
+            warm_workers: Number of worker processes that preload the data science
+                libraries and fork a child per script run, which saves the interpreter
+                start and imports on every run and bug fix retry (POSIX only). 0 starts
+                a new interpreter per run
+            script_limits: Optional resource limits of generated script runs, with keys
+                'timeout' (wall-clock seconds), 'max_memory_mb', 'max_cpu_seconds' and
+                'max_threads'. A script exceeding a limit is killed and fixed like a
+                failing script, with its resource usage in the bug fixer prompt
+            checkpoint_cells: Ask for scripts split into ``# %%`` cells and run them cell
+                by cell, checkpointing the variables after slow cells. After a bug fix,
+                the run resumes from the first changed cell instead of the start
+            preflight: Check scripts statically before running them, for syntax errors,
+                imports of packages that are not installed, literal paths that do not
+                exist and undefined names. Problems are sent to the bug fixer without
+                running the script
+            fix_candidates: Number of fixes requested concurrently per fix attempt, at
+                increasing temperatures. Above 1, the candidates run in parallel
+                sandboxes (on the development sample, if enabled) and the first one that
+                succeeds and writes valid outputs is kept
+            fix_targets: Optional 'provider:model' targets the fix candidates are spread
+                over, in addition to the default model
+            fix_memory: Remember fixes that worked, keyed by a normalized signature of
+                the error, in a local database shared across runs. Stored fixes for a
+                known error are tried before asking the LLM
+            patch_fixes: Ask the bug fixer for search/replace edits of the code around
+                the failing lines, with a trimmed traceback, instead of the whole corrected
+                script. The whole script is requested if a patch does not apply
+            stage_cache: Reuse the outputs of stages whose inputs are unchanged since an
+                earlier run in the working directory, i.e. the data, task description,
+                settings, prompts, model and library versions, and the outputs of the
+                stages before them. Outputs are hard linked from ``.stage_cache``
+            run_dir: Output directory of the run (default: a new ``output/run_<timestamp>``
+                directory). An existing run directory is continued, see :meth:`resume`
 
         Raises:
             FileNotFoundError: If competition_url is not provided and required files are missing
@@ -49,19 +135,43 @@ class CompetitionAgent(BaseAgent):
         self.working_dir = Path(working_dir).resolve()
         self.data_dir = self.working_dir / "dataset"
         now = datetime.now(tz=TIMEZONE)
-        self.output_dir = self.working_dir / "output" / f"run_{now.strftime('%Y%m%d_%H%M%S')}"
+        self.output_dir = (
+            Path(run_dir).resolve()
+            if run_dir
+            else self.working_dir / "output" / f"run_{now.strftime('%Y%m%d_%H%M%S')}"
+        )
         self.processed_dir = self.output_dir / "processed_data"
         self.feature_dir = self.output_dir / "feature_data"
         self.model_dir = self.output_dir / "models"
         self.script_dir = self.output_dir / "scripts"
         self.competition_url = competition_url
         self.skip_scraping = False
+        self.warm_workers = warm_workers
+        self.script_limits = script_limits or {}
+        self.checkpoint_cells = checkpoint_cells
+        # Settings that change the generated scripts, part of the stage cache keys
+        self.stage_settings = {
+            "max_prompt_tokens": max_prompt_tokens,
+            "profile_data": profile_data,
+            "checkpoint_cells": checkpoint_cells,
+        }
 
         # Create output directories
         self._setup_output_dirs()
 
-        # Initialize LLM client
-        self.llm = LLMClient(llm_provider, model_name)
+        # Initialize LLM client. It is shared by all agents below, so they also share
+        # its concurrency and rate limits.
+        self.llm = LLMClient(
+            llm_provider,
+            model_name,
+            use_cache=use_cache,
+            max_concurrency=max_concurrency,
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+            fallback_targets=fallback_targets,
+            routes=routes,
+        )
+        self.llm.run_id = self.output_dir.name
 
         # Check for existing dataset files
         has_overview = (self.working_dir / "overview.md").exists()
@@ -86,10 +196,28 @@ class CompetitionAgent(BaseAgent):
             if not has_dataset:
                 raise FileNotFoundError("dataset directory not found in working directory")
 
-        # Initialize report
+        # Initialize report, continuing the report of a resumed run
         self.report = []
         self.report_path = self.output_dir / "report.md"
-        self._add_to_report("# Model Development Report", "")
+        if self.report_path.exists():
+            self.report.append(self.report_path.read_text().rstrip("\n"))
+        else:
+            self._add_to_report("# Model Development Report", "")
+
+        # Manifest of the run's plan and stages, which a failed run is resumed from
+        self.manifest_path = self.output_dir / MANIFEST_NAME
+        if self.manifest_path.exists():
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {
+                "version": MANIFEST_VERSION,
+                "working_dir": str(self.working_dir),
+                "created_at": now.isoformat(),
+                "status": "created",
+                "stages": {},
+            }
+            self._save_manifest()
 
         # Initialize other agents without task description and data dictionary
         self.data_processor = DataProcessor(
@@ -99,6 +227,8 @@ class CompetitionAgent(BaseAgent):
             script_dir=self.script_dir,
             task_description={},
             data_dictionary={},
+            max_prompt_tokens=max_prompt_tokens,
+            profile_data=profile_data,
         )
 
         self.feature_engineer = FeatureEngineer(
@@ -108,6 +238,8 @@ class CompetitionAgent(BaseAgent):
             script_dir=self.script_dir,
             task_description={},
             data_dictionary={},
+            max_prompt_tokens=max_prompt_tokens,
+            profile_data=profile_data,
         )
 
         self.model_builder = ModelBuilder(
@@ -117,6 +249,8 @@ class CompetitionAgent(BaseAgent):
             script_dir=self.script_dir,
             task_description={},
             data_dictionary={},
+            max_prompt_tokens=max_prompt_tokens,
+            profile_data=profile_data,
         )
 
         self.submission_generator = SubmissionGenerator(
@@ -126,6 +260,140 @@ class CompetitionAgent(BaseAgent):
             script_dir=self.script_dir,
             task_description={},
             data_dictionary={},
+            max_prompt_tokens=max_prompt_tokens,
+        )
+
+        # Generated scripts are developed on a sample of the data, if enabled
+        self.dev_sample = (
+            DevSample(self.data_dir, self.output_dir, dev_sample_rows)
+            if dev_sample_rows
+            else None
+        )
+        # Fixes are shared between the agents, as their scripts fail in similar ways
+        memory = FixMemory() if fix_memory else None
+        # Stage outputs of earlier runs in the working directory, reused if unchanged
+        self.stage_cache = (
+            StageCache(self.working_dir / ".stage_cache", self.output_dir)
+            if stage_cache
+            else None
+        )
+        for agent in self._script_agents():
+            agent.stage_cache = self.stage_cache
+            agent.dev_sample = self.dev_sample
+            agent.script_limits = self.script_limits
+            agent.checkpoint_cells = checkpoint_cells
+            agent.preflight = preflight
+            agent.fix_candidates = fix_candidates
+            agent.bug_fixer.candidate_targets = list(fix_targets or [])
+            agent.bug_fixer.memory = memory
+            agent.bug_fixer.patches = patch_fixes
+
+    def _script_agents(self) -> list[BaseAgent]:
+        """Agents that generate and run scripts, in pipeline order."""
+        return [
+            self.data_processor,
+            self.feature_engineer,
+            self.model_builder,
+            self.submission_generator,
+        ]
+
+    def _stages(self) -> list[tuple[str, BaseAgent, Callable[[], None]]]:
+        """Name, agent and step of each stage, in pipeline order."""
+        return [
+            ("process_data", self.data_processor, self.process_data),
+            ("engineer_features", self.feature_engineer, self.engineer_features),
+            ("build_model", self.model_builder, self.build_model),
+            ("generate_submission", self.submission_generator, self.generate_submission),
+        ]
+
+    def _save_manifest(self) -> None:
+        """Write the manifest atomically, so that a crash never leaves it truncated."""
+        self.manifest["updated_at"] = datetime.now(tz=TIMEZONE).isoformat()
+        tmp_path = self.manifest_path.with_suffix(".json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=2, default=str)
+        tmp_path.replace(self.manifest_path)
+
+    def _run_stage(self, name: str, agent: BaseAgent, step: Callable[[], None]) -> None:
+        """Run a stage and record its status and artifacts in the manifest.
+
+        Stages that a resumed run already completed are skipped if their outputs still
+        exist. A stage that failed or was interrupted continues with its script, which
+        may already contain fixes, instead of generating a new one.
+        """
+        state = self.manifest["stages"].setdefault(name, {"status": "pending"})
+        outputs = [
+            str(Path(path).relative_to(self.output_dir)) for path in agent.stage_outputs()
+        ]
+        if state["status"] == "completed" and all(
+            (self.output_dir / path).exists() for path in outputs
+        ):
+            logger.info(f"Skipping stage {name}, completed by the resumed run")
+            # Chained into the stage cache key of the next stage
+            agent.stage_build = state.get("stage_build")
+            return
+
+        script_path = agent.script_dir / agent.script_name
+        agent.resume_script = (
+            script_path
+            if state["status"] in ("running", "failed") and script_path.exists()
+            else None
+        )
+        if agent.resume_script is not None:
+            logger.info(f"Resuming stage {name} with its existing script {script_path.name}")
+        state.update(
+            {
+                "status": "running",
+                "script": str(script_path.relative_to(self.output_dir)),
+                "outputs": outputs,
+                "started_at": datetime.now(tz=TIMEZONE).isoformat(),
+                "error": None,
+            }
+        )
+        self._save_manifest()
+        try:
+            step()
+        except Exception as e:
+            state.update({"status": "failed", "error": str(e)[-MAX_MANIFEST_ERROR_CHARS:]})
+            raise
+        else:
+            state.update(
+                {
+                    "status": "completed",
+                    "stage_key": agent.stage_key,
+                    "stage_build": agent.stage_build,
+                }
+            )
+        finally:
+            agent.resume_script = None
+            state["finished_at"] = datetime.now(tz=TIMEZONE).isoformat()
+            self._save_manifest()
+
+    def _prepare_stage(self, agent: BaseAgent) -> None:
+        """Key a stage by its inputs for the stage cache, before it runs.
+
+        The key chains the build of the previous stage, so that every stage after a
+        rebuilt one is rebuilt too, and the raw data for the first stage.
+        """
+        agent.stage_build = None
+        if self.stage_cache is None:
+            return
+        agents = self._script_agents()
+        index = agents.index(agent)
+        if index == 0:
+            upstream = data_fingerprint(self.data_dir)
+        else:
+            # A build that could not be cached is never reused downstream
+            upstream = agents[index - 1].stage_build or uuid.uuid4().hex
+        agent.stage_key = self.stage_cache.key(
+            type(agent).__name__,
+            upstream,
+            {
+                "task_description": self.task_description,
+                "data_dictionary": self.data_dictionary,
+                "model": f"{self.llm.provider}:{self.llm.model_name}",
+                "settings": self.stage_settings,
+            },
         )
 
     def _update_agent_configs(self, task_description: dict, data_dictionary: dict) -> None:
@@ -135,12 +403,7 @@ class CompetitionAgent(BaseAgent):
             task_description: Task description dictionary
             data_dictionary: Data dictionary
         """
-        for agent in [
-            self.data_processor,
-            self.feature_engineer,
-            self.model_builder,
-            self.submission_generator,
-        ]:
+        for agent in self._script_agents():
             agent.task_description = task_description
             agent.data_dictionary = data_dictionary
 
@@ -154,6 +417,16 @@ class CompetitionAgent(BaseAgent):
         Path(self.script_dir).mkdir(parents=True, exist_ok=True)
         Path(self.model_dir).mkdir(parents=True, exist_ok=True)
 
+    def _plan_prompts(self) -> tuple[str, str]:
+        """User and system prompt of the task planning request."""
+        context = {
+            "problem_desc": self.problem_desc,
+            "data_dictionary": self.data_dictionary,
+        }
+        sys_prompt = self.load_prompt_template("competition_agent_system.txt")
+        user_prompt = self.load_prompt_template("competition_agent_user.txt", context)
+        return user_prompt, sys_prompt
+
     def plan_tasks(self) -> dict[str, str]:
         """Analyze problem description using LLM.
 
@@ -163,18 +436,34 @@ class CompetitionAgent(BaseAgent):
             - ml_task: Specific ML task description
             - train_table: Name of table containing ground truth labels
             - eval_table: Name of table for model evaluation
+            - label_table, label_column: Table and column containing the labels
+            - time_column: Time column of time series data, if any
 
         """
-        context = {
-            "problem_desc": self.problem_desc,
-            "data_dictionary": self.data_dictionary,
-        }
-        sys_prompt = self.load_prompt_template("competition_agent_system.txt")
-        user_prompt = self.load_prompt_template("competition_agent_user.txt", context)
-
-        resp = self.llm.get_response(user_prompt, sys_prompt, json_response=True)
+        user_prompt, sys_prompt = self._plan_prompts()
+        resp = self.llm.get_response(
+            user_prompt,
+            sys_prompt,
+            json_response=True,
+            max_tokens=self.llm.size_max_tokens(2048),
+            caller="plan_tasks",
+        )
         return resp
 
+    async def aplan_tasks(self) -> dict[str, str]:
+        """Analyze problem description using LLM, without blocking the event loop.
+
+        See :meth:`plan_tasks`.
+        """
+        user_prompt, sys_prompt = self._plan_prompts()
+        return await self.llm.aget_response(
+            user_prompt,
+            sys_prompt,
+            json_response=True,
+            max_tokens=self.llm.size_max_tokens(2048),
+            caller="plan_tasks",
+        )
+
     def _format_task_description(self, task_dict: dict) -> str:
         """Format task description dictionary into readable markdown.
 
@@ -237,6 +526,32 @@ class CompetitionAgent(BaseAgent):
         with open(self.report_path, "w") as f:
             f.write("\n\n".join(self.report))
 
+    def build_dev_sample(self) -> None:
+        """Build the development sample that generated scripts are first run on."""
+        if self.dev_sample is None:
+            return
+        logger.info("Building development sample")
+        try:
+            summary = self.dev_sample.build(
+                label_table=self.task_description.get("label_table"),
+                label_column=self.task_description.get("label_column"),
+                time_column=self.task_description.get("time_column"),
+            )
+        except Exception as e:
+            # Scripts are then developed on the full data, as without a sample
+            logger.warning(f"Failed to build development sample: {e!s}")
+            return
+
+        lines = [
+            f"- **{name}**: {info['sample_rows']} of {info['rows']} rows ({info['method']})"
+            for name, info in summary.items()
+        ]
+        self._add_to_report(
+            "## Development Sample",
+            f"Scripts were developed on a sample in {self.dev_sample.sample_dir}:\n\n"
+            + "\n".join(lines),
+        )
+
     def process_data(self) -> None:
         """Process raw data.
 
@@ -245,16 +560,18 @@ class CompetitionAgent(BaseAgent):
 
         """
         logger.info("Processing data")
-        # Process data and save to disk
-        processed_data = self.data_processor.run()
+        # Process data and save to disk, the output is described from its metadata
+        self._prepare_stage(self.data_processor)
+        self.data_processor.execute()
+        processed_data = self.data_processor.output_metadata()
 
         # Add to report
         summary = []
-        for name, df in processed_data.items():
+        for name, meta in processed_data.items():
             summary.append(f"- **{name}**")
-            summary.append(f"  - Shape: {df.shape}")
+            summary.append(f"  - Shape: {meta['shape']}")
             summary.append("  - Columns:")
-            for col, dtype in df.schema.items():
+            for col, dtype in meta["schema"].items():
                 summary.append(f"    - {col}: {dtype}")
 
         self._add_to_report(
@@ -271,16 +588,18 @@ class CompetitionAgent(BaseAgent):
         """
         logger.info("Engineering features")
 
-        # Engineer features and save to disk
-        feature_df = self.feature_engineer.run()
+        # Engineer features and save to disk, the output is described from its metadata
+        self._prepare_stage(self.feature_engineer)
+        self.feature_engineer.execute()
+        feature_df = self.feature_engineer.output_metadata()
 
         # Add to report
         summary = []
-        for name, df in feature_df.items():
+        for name, meta in feature_df.items():
             summary.append(f"- **{name}**")
-            summary.append(f"  - Shape: {df.shape}")
+            summary.append(f"  - Shape: {meta['shape']}")
             summary.append("  - Columns:")
-            for col, dtype in df.schema.items():
+            for col, dtype in meta["schema"].items():
                 summary.append(f"    - {col}: {dtype}")
 
         self._add_to_report(
@@ -293,6 +612,7 @@ class CompetitionAgent(BaseAgent):
         logger.info("Building model")
 
         # Build and train model
+        self._prepare_stage(self.model_builder)
         self.model_builder.run()
 
         # Add to report
@@ -304,6 +624,7 @@ class CompetitionAgent(BaseAgent):
     def generate_submission(self) -> None:
         """Generate submission file."""
         logger.info("Generating submission")
+        self._prepare_stage(self.submission_generator)
         submit_df = self.submission_generator.run()
 
         summary = []
@@ -317,30 +638,150 @@ class CompetitionAgent(BaseAgent):
             "\n".join(summary),
         )
 
+    def report_llm_usage(self) -> None:
+        """Add latency, token and cost totals of this run's LLM calls to the report."""
+        if self.llm.telemetry is None:
+            return
+        summary = self.llm.telemetry.summarize(self.llm.run_id)
+        if summary.empty:
+            return
+        self._add_to_report(
+            "## LLM Usage",
+            summary.round(4).to_markdown(),
+        )
+
+    def report_script_usage(self) -> None:
+        """Add the wall time, CPU time, memory and I/O of every script run to the report."""
+        runs = [run for agent in self._script_agents() for run in agent.script_runs]
+        if not runs:
+            return
+        usage = pd.DataFrame(runs).rename(
+            columns={
+                "wall_time": "wall_time_s",
+                "cpu_time": "cpu_time_s",
+            }
+        )
+        limited = usage[usage["limit"].notna()]
+        content = usage.fillna({"limit": ""}).round(2).to_markdown(index=False)
+        if not limited.empty:
+            content += (
+                f"\n\n{len(limited)} runs were killed for exceeding a resource limit: "
+                + ", ".join(f"{row.script} ({row.limit})" for row in limited.itertuples())
+            )
+        self._add_to_report("## Script Resources", content)
+
     def run(self) -> None:
-        """Run the complete model development pipeline."""
+        """Run the complete model development pipeline.
+
+        Blocks until :meth:`arun` completes. Works inside a running event loop too, e.g.
+        in Jupyter, where the pipeline runs on its own loop in a worker thread.
+        """
+        _run_sync(self.arun())
+
+    async def arun(self) -> None:
+        """Run the complete model development pipeline, overlapping independent steps."""
         logger.info("Starting model development pipeline")
 
-        # If competition URL is provided and scraping not skipped, scrape the data
-        if self.competition_url and not self.skip_scraping:
-            logger.info(f"Scraping competition data from {self.competition_url}")
-            scrape_result = asyncio.run(self.scraper.scrape(self.competition_url))
-            if any(val is None for val in scrape_result.values()):
-                raise RuntimeError(f"Failed to scrape competition data: {scrape_result}")
-            logger.info("Successfully scraped competition data")
+        # Workers import the libraries in the background, while the tasks are planned.
+        # Thread caps are read by some libraries on import, so the workers get them too.
+        worker_pool = None
+        if self.warm_workers:
+            worker_pool = WorkerPool(
+                self.warm_workers,
+                env=thread_limit_env(self.script_limits.get("max_threads")),
+            )
+        self._set_worker_pool(worker_pool)
+        self.manifest["status"] = "running"
+        self._save_manifest()
+        try:
+            await self._run_pipeline()
+        except BaseException:
+            # Resumable from the first incomplete stage, see resume()
+            self.manifest["status"] = "failed"
+            raise
+        else:
+            self.manifest["status"] = "completed"
+        finally:
+            self._save_manifest()
+            # Also reported if the pipeline fails, e.g. on a script exceeding a limit
+            self.report_script_usage()
+            if worker_pool is not None:
+                worker_pool.close()
+                self._set_worker_pool(None)
 
-            # Verify required files exist after scraping
-            if not (self.working_dir / "overview.md").exists():
-                raise FileNotFoundError("overview.md not found in working directory")
-            if not (self.working_dir / "data_dictionary.xlsx").exists():
-                raise FileNotFoundError("data_dictionary.xlsx not found in working directory")
-            if not self.data_dir.exists():
-                raise FileNotFoundError("dataset directory not found in working directory")
+        logger.info("Model development pipeline completed")
 
-        # Load and analyze problem description
-        self.problem_desc = read_problem_description(self.working_dir / "overview.md")
-        self.data_dictionary = read_data_dictionary(self.working_dir / "data_dictionary.xlsx")
-        self.task_description = self.plan_tasks()
+    @classmethod
+    def resume(cls, run_dir: str | Path, **kwargs) -> "CompetitionAgent":
+        """Resume a failed or interrupted run from its first incomplete stage.
+
+        The task plan and data dictionary are read from the run's manifest instead of
+        scraping and planning again. Completed stages are skipped, and the first
+        incomplete stage continues with its existing script, if it was generated.
+
+        Args:
+            run_dir: Output directory of the run, containing its ``manifest.json``
+            **kwargs: Other arguments of the constructor, e.g. the LLM provider and
+                model, which are not stored in the manifest
+
+        Returns:
+            Agent of the resumed run, after its pipeline completed
+
+        Raises:
+            FileNotFoundError: If the run directory has no manifest
+        """
+        run_dir = Path(run_dir).resolve()
+        manifest_path = run_dir / MANIFEST_NAME
+        if not manifest_path.exists():
+            raise FileNotFoundError(f"{MANIFEST_NAME} not found in {run_dir}, cannot resume")
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        agent = cls(manifest["working_dir"], run_dir=run_dir, **kwargs)
+        agent.run()
+        return agent
+
+    def _set_worker_pool(self, worker_pool: Optional[WorkerPool]) -> None:
+        """Set the worker pool that the agents run their scripts in."""
+        for agent in self._script_agents():
+            agent.worker_pool = worker_pool
+
+    async def _scrape(self) -> None:
+        """Scrape the competition data, if a URL is given and scraping is not skipped."""
+        if not self.competition_url or self.skip_scraping:
+            return
+        logger.info(f"Scraping competition data from {self.competition_url}")
+        scrape_result = await self.scraper.scrape(self.competition_url)
+        if any(val is None for val in scrape_result.values()):
+            raise RuntimeError(f"Failed to scrape competition data: {scrape_result}")
+        logger.info("Successfully scraped competition data")
+
+        # Verify required files exist after scraping
+        if not (self.working_dir / "overview.md").exists():
+            raise FileNotFoundError("overview.md not found in working directory")
+        if not (self.working_dir / "data_dictionary.xlsx").exists():
+            raise FileNotFoundError("data_dictionary.xlsx not found in working directory")
+        if not self.data_dir.exists():
+            raise FileNotFoundError("dataset directory not found in working directory")
+
+    async def _plan_run(self) -> None:
+        """Plan the tasks, or load the plan of a resumed run, and save the plan."""
+        if self.manifest.get("task_description") is not None:
+            # Resumed run, which has already been planned
+            logger.info(f"Resuming run {self.output_dir.name} with its saved task plan")
+            self.problem_desc = self.manifest["problem_desc"]
+            self.data_dictionary = self.manifest["data_dictionary"]
+            self.task_description = self.manifest["task_description"]
+            self._update_agent_configs(self.task_description, self.data_dictionary)
+            return
+
+        # Load and analyze problem description, both are part of the planning prompt
+        self.problem_desc, self.data_dictionary = await asyncio.gather(
+            asyncio.to_thread(read_problem_description, self.working_dir / "overview.md"),
+            asyncio.to_thread(
+                read_data_dictionary, self.working_dir / "data_dictionary.xlsx"
+            ),
+        )
+        self.task_description = await self.aplan_tasks()
 
         # Update agent configurations with task description and data dictionary
         self._update_agent_configs(self.task_description, self.data_dictionary)
@@ -348,16 +789,62 @@ class CompetitionAgent(BaseAgent):
         # Add development plan to report
         self._add_to_report("## Development Plan", self.task_description)
 
-        # Process data
-        self.process_data()
-
-        # Engineer features
-        self.engineer_features()
-
-        # Build and train model
-        self.build_model()
-
-        # Make predictions
-        self.generate_submission()
+        # Saved, so that a failed run can be resumed without planning again
+        self.manifest.update(
+            {
+                "problem_desc": self.problem_desc,
+                "data_dictionary": self.data_dictionary,
+                "task_description": self.task_description,
+            }
+        )
+        self._save_manifest()
+
+    async def _run_pipeline(self) -> None:
+        """Run the pipeline steps, each as soon as the steps it depends on have finished.
+
+        The raw data is profiled and the tokenizer loaded while the tasks are planned, and
+        the prompt context of each later stage is prefetched while the stage before it
+        runs. Only the context that does not depend on that stage's outputs is ready
+        then, see :meth:`BaseAgent.prefetch_context`. Blocking steps, i.e. the stages
+        with their LLM calls and script runs, run in threads, so that they do not block
+        the event loop. The stages themselves depend on each other's outputs and run in
+        pipeline order.
+        """
+        graph = TaskGraph()
+        graph.add("scrape", self._scrape)
+        graph.add("plan", self._plan_run, after=["scrape"])
+        graph.add(
+            "prefetch_process_data",
+            functools.partial(asyncio.to_thread, self.data_processor.prefetch_context),
+            after=["scrape"],
+        )
+        # Sample the data to develop the scripts on
+        graph.add(
+            "dev_sample",
+            functools.partial(asyncio.to_thread, self.build_dev_sample),
+            after=["plan"],
+        )
 
-        logger.info("Model development pipeline completed")
+        # Process data, engineer features, build and train the model and make predictions
+        after = ["dev_sample", "prefetch_process_data"]
+        previous_after = None
+        for name, agent, step in self._stages():
+            prefetch = f"prefetch_{name}"
+            if prefetch not in graph.steps:
+                # Depends on what the stage before depends on, so that it overlaps its run
+                graph.add(
+                    prefetch,
+                    functools.partial(asyncio.to_thread, agent.prefetch_context),
+                    after=previous_after,
+                )
+                after = [*after, prefetch]
+            graph.add(
+                name,
+                functools.partial(asyncio.to_thread, self._run_stage, name, agent, step),
+                after=after,
+            )
+            previous_after, after = after, [name]
+        await graph.run()
+
+        # Summarize LLM usage per stage
+        self.report_llm_usage()
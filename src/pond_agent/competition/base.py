@@ -1,20 +1,518 @@
 """Base class for AutoML agent."""
 
+import contextlib
+import functools
 import importlib.resources
+import logging
+import os
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Optional
+
+import pyarrow.parquet as pq
+
+from ..llm import _run_sync
+from ..tools import ScriptStreamWriter, run_python_script
+from .dev_sample import rewrite_paths
+from .preflight import format_problems, validate_script
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def _read_template(template_name: str) -> str:
+    """Read a prompt template from the package resources, once per process."""
+    return importlib.resources.read_text("pond_agent.competition.prompts", template_name)
 
 
 class BaseAgent:
     """Base class for AutoML agent."""
 
+    # What the agent's generated script does, used in log and error messages
+    script_description = "generated"
+    # File name of the agent's generated script
+    script_name = "script.py"
+    # Templates of the script's prompts, read ahead by prefetch_context
+    prompt_templates = ()
+
     def __init__(self) -> None:
         """Initialize class for AutoML agent."""
+        self.llm_stats = None
+        # Fits prompt contexts into a token budget, set by agents that build large prompts
+        self.budgeter = None
+        # Sample of the data that scripts are first run on, set by the CompetitionAgent
+        self.dev_sample = None
+        # Warm workers that scripts are run in, set by the CompetitionAgent
+        self.worker_pool = None
+        # Resource limits of script runs, see tools.run_python_script
+        self.script_limits = None
+        # Resource usage of every script run, for the report
+        self.script_runs = []
+        # Whether scripts are checked statically before each run
+        self.preflight = True
+        # Dataset paths given to the script's prompt, set when generating the script
+        self.data_paths = None
+        # Number of fixes requested and run in parallel per fix attempt, set by the
+        # CompetitionAgent. 1 fixes serially.
+        self.fix_candidates = 1
+        # Whether scripts are run cell by cell, so that fix retries resume from the first
+        # changed cell, set by the CompetitionAgent
+        self.checkpoint_cells = False
+        # Cache of stage outputs and the key of this stage's inputs, set by the
+        # CompetitionAgent, and the build ID of the outputs, chained into the next key
+        self.stage_cache = None
+        self.stage_key = None
+        self.stage_build = None
+        # Existing script run instead of generating one, set by the CompetitionAgent
+        # when resuming the stage of a failed run
+        self.resume_script = None
+
+    def prefetch_context(self) -> None:
+        """Warm the parts of the script's prompt context that are ready before the stage.
+
+        Called by the CompetitionAgent while other work is in flight, e.g. while the stage
+        before runs. Reads the prompt templates and loads the tokenizer of the budgeter,
+        whose encoding may be downloaded on first use.
+        """
+        for template_name in self.prompt_templates:
+            _read_template(template_name)
+        if self.budgeter is not None:
+            self.budgeter.count("")
 
     def load_prompt_template(self, template_name: str, context: dict = None) -> str:
-        """Load prompt template from resources."""
-        template = importlib.resources.read_text(
-            "pond_agent.competition.prompts", template_name
-        )
+        """Load prompt template from resources.
+
+        If the agent has a token budgeter, large context values such as dataset info and
+        code are compacted to fit its budget.
+        """
+        template = _read_template(template_name)
         if context:
+            if self.budgeter is not None:
+                context = self.budgeter.fit_context(template, context)
             return template.format(**context)
         else:
             return template
+
+    def stream_script(
+        self,
+        user_prompt: str,
+        sys_prompt: str,
+        script_path: Optional[Path] = None,
+        expected_tokens: int = 4096,
+        cache_prompt: bool = False,
+    ) -> str:
+        """Get a script from the agent's LLM client, writing it to disk as it streams.
+
+        Statistics of the call, such as time to first token and tokens per second, are
+        kept in ``self.llm_stats``.
+
+        Args:
+            user_prompt: User prompt asking for the script
+            sys_prompt: System prompt
+            script_path: Path the script is streamed to. If None, the response is not streamed
+            expected_tokens: Estimated length of the script, used to size ``max_tokens``
+            cache_prompt: Mark the user prompt as cacheable by the provider. Worth it for
+                long prompts that are likely resent, e.g. by continuations
+
+        Returns:
+            Raw response text
+        """
+        max_tokens = self.llm.size_max_tokens(expected_tokens)
+        if self.checkpoint_cells:
+            sys_prompt += "\n" + self.load_prompt_template("script_cells.txt")
+        # A cacheable prompt is sent as the static prefix of the request
+        prefix, user_prompt = (user_prompt, "") if cache_prompt else ("", user_prompt)
+        if script_path is None:
+            return self.llm.get_response(
+                user_prompt,
+                sys_prompt,
+                json_response=False,
+                max_tokens=max_tokens,
+                caller=type(self).__name__,
+                prefix=prefix,
+            )
+
+        with ScriptStreamWriter(script_path, logger) as writer:
+            resp, stats = self.llm.get_response(
+                user_prompt,
+                sys_prompt,
+                json_response=False,
+                max_tokens=max_tokens,
+                stream=True,
+                on_chunk=writer.write,
+                return_stats=True,
+                caller=type(self).__name__,
+                prefix=prefix,
+            )
+        self.llm_stats = stats
+        if stats["tokens_per_second"] is not None and not stats["cached"]:
+            logger.info(
+                "Streamed %s: first token after %.2fs, %.1f tokens/s",
+                Path(script_path).name,
+                stats["time_to_first_token"] or 0.0,
+                stats["tokens_per_second"],
+            )
+        return resp
+
+    def run_script(self, script_path: Path, retry_count: int = 3) -> None:
+        """Run a generated script, asking the bug fixer to fix it until it succeeds.
+
+        If a development sample is active, the script is first run and fixed on the
+        sample, which is much faster, and only promoted to the full data once it passes.
+        With ``checkpoint_cells``, runs after a fix resume from the first changed cell.
+
+        Args:
+            script_path: Path to the generated script
+            retry_count: Number of fix attempts, separately on the sample and full data
+
+        Raises:
+            RuntimeError: If the script still fails after all fix attempts
+        """
+        # Execute script in subprocess
+        env = os.environ.copy()
+        env["PYTHONPATH"] = str(
+            Path(__file__).parent.parent.parent
+        )  # Add project root to PYTHONPATH
+
+        # Checkpoints of an earlier run of the stage may predate changes of its inputs
+        self._clear_checkpoints(script_path)
+        try:
+            if self.dev_sample is not None and self.dev_sample.active:
+                logger.info(
+                    f"Running {self.script_description} script on the development sample"
+                )
+                returncode, _ = self._run_and_fix(script_path, env, retry_count, sample=True)
+                if returncode == 0:
+                    logger.info(
+                        "Script passed on the development sample, running it on the full data"
+                    )
+                else:
+                    # Later stages have no sample outputs to run on
+                    logger.warning(
+                        "Script still fails on the development sample, running it on the "
+                        "full data"
+                    )
+                    self.dev_sample.active = False
+
+            returncode, stderr = self._run_and_fix(script_path, env, retry_count)
+            if returncode != 0:
+                msg = f"Cannot fix the bug: {stderr}"
+                logger.error(msg)
+                raise RuntimeError(msg) from None
+
+            logger.info(f"Successfully executed {self.script_description} script")
+            self._clear_checkpoints(script_path)
+            self._store_stage(script_path)
+
+        except subprocess.CalledProcessError as e:
+            msg = f"Error executing {self.script_description} script: {e.stderr}"
+            logger.error(msg)
+            raise RuntimeError(msg) from e
+
+        except RuntimeError as e:
+            logger.error(str(e))
+            raise
+
+    def _run_and_fix(
+        self, script_path: Path, env: dict, retry_count: int, sample: bool = False
+    ) -> tuple[int, str]:
+        """Run a script and fix it until it succeeds or the fix attempts are used up.
+
+        Fixes are always applied to the script at ``script_path``. On the sample, a copy
+        with rewritten paths is run, and the bug fixer sees errors with the full paths.
+        If a run exceeds a resource limit, the bug fixer also sees its resource usage.
+        Scripts failing the static pre-flight check are sent to the bug fixer without
+        being run. With ``fix_candidates`` above 1, each fix attempt runs several
+        candidate fixes in parallel, see :meth:`_fix_speculatively`. Fixes stored by the
+        bug fixer's memory for the same error are tried before any new fix is requested.
+
+        Returns:
+            Return code and stderr of the last run
+        """
+        run_path = script_path
+        output_dir = Path(self.output_dir)
+        if sample:
+            run_path = self.dev_sample.sample_path(script_path)
+            run_path.parent.mkdir(parents=True, exist_ok=True)
+            output_dir = self.dev_sample.sample_path(self.output_dir)
+            output_dir.mkdir(parents=True, exist_ok=True)
+        # Entries that exist before the first run are not outputs of the script, e.g. the
+        # models read by the submission script, which sandboxes of fix candidates link to
+        inputs = set(output_dir.iterdir())
+
+        def run(check: bool = True) -> tuple[int, str, dict]:
+            if check and self.preflight:
+                with open(script_path) as script_file:
+                    problems = validate_script(script_file.read(), script_path, self.data_paths)
+                if problems:
+                    # Fixed without spending a run on a script that cannot succeed
+                    logger.warning(f"{script_path.name} failed the pre-flight check")
+                    return 1, format_problems(problems, script_path), {"preflight": True}
+            if sample:
+                with open(script_path) as script_file:
+                    script = script_file.read()
+                with open(run_path, "w") as script_file:
+                    script_file.write(self.dev_sample.rewrite(script))
+            returncode, stderr, usage = run_python_script(
+                run_path,
+                env,
+                logger,
+                self.worker_pool,
+                limits=self.script_limits,
+                return_usage=True,
+                checkpoint_dir=self._checkpoint_dir(run_path) if self.checkpoint_cells else None,
+            )
+            self._record_run(script_path.name, sample, returncode, usage)
+            return returncode, self.dev_sample.restore(stderr) if sample else stderr, usage
+
+        returncode, stderr, usage = run()
+        while returncode != 0 and retry_count > 0:
+            msg = f"Error executing {self.script_description} script: {stderr}"
+            logger.error(msg)
+            logger.info("Attempting to fix bug, %d attempts remaining", retry_count)
+            with open(script_path) as script_file:
+                script = script_file.read()
+            # A stored fix for the same error is cheaper than any number of candidates
+            fixed_code = self.bug_fixer.recall_fix(script, stderr)
+            if fixed_code is None and self.fix_candidates > 1:
+                result = self._fix_speculatively(
+                    script_path, script, stderr, usage, env, sample, output_dir, inputs
+                )
+                if result is not None:
+                    returncode, stderr, usage = result
+                    self.bug_fixer.report_outcome(returncode, stderr)
+                retry_count -= 1
+                continue
+            if fixed_code is None:
+                fixed_code = self.bug_fixer.fix_bug(
+                    script, stderr, usage if usage.get("limit") else None
+                )
+            if fixed_code:
+                with open(script_path, "w") as script_file:
+                    script_file.write(fixed_code)
+                returncode, stderr, usage = run()
+                self.bug_fixer.report_outcome(returncode, stderr)
+            retry_count -= 1
+        if usage.get("preflight"):
+            # The static checks can be wrong, e.g. about names defined by exec
+            logger.warning(f"Running {script_path.name} despite failing the pre-flight check")
+            returncode, stderr, usage = run(check=False)
+        return returncode, stderr
+
+    def _record_run(self, name: str, sample: bool, returncode: int, usage: dict) -> None:
+        """Keep the resource usage of a script run for the report."""
+        self.script_runs.append(
+            {
+                "script": name,
+                "data": "sample" if sample else "full",
+                "returncode": returncode,
+                **usage,
+            }
+        )
+        logger.info(
+            f"{name} ran for {usage['wall_time']:.1f}s, "
+            f"peak memory {usage['peak_rss_mb'] or 0:.0f} MB"
+        )
+
+    def _fix_speculatively(
+        self,
+        script_path: Path,
+        script: str,
+        stderr: str,
+        usage: dict,
+        env: dict,
+        sample: bool,
+        output_dir: Path,
+        inputs: set[Path],
+    ) -> Optional[tuple[int, str, dict]]:
+        """Request several fixes at once and run them in parallel sandboxes.
+
+        Each candidate runs in its own directory, with its outputs redirected to a
+        sandbox output directory that links to the input directories of the real one.
+        The first candidate that succeeds and writes valid outputs wins: the others are
+        cancelled, the winner's outputs replace those of earlier failed runs in the real
+        output directory and its code is written to ``script_path``. If none succeeds,
+        the first candidate is kept, like a serial fix.
+
+        Returns:
+            Return code, stderr and usage of the kept candidate's run, or None if no
+            candidate was received
+        """
+        candidates = _run_sync(
+            self.bug_fixer.afix_candidates(
+                script, stderr, self.fix_candidates, usage if usage.get("limit") else None
+            )
+        )
+        if not candidates:
+            return None
+        logger.info(f"Running {len(candidates)} fix candidates in parallel")
+        scripts_dir = script_path.parent
+        if sample:
+            scripts_dir = self.dev_sample.sample_path(script_path).parent
+        sandbox_root = scripts_dir / ".sandboxes" / script_path.stem
+        shutil.rmtree(sandbox_root, ignore_errors=True)
+        cancel = threading.Event()
+
+        def run_candidate(index: int, code: str) -> tuple[int, str, dict, Path]:
+            sandbox = sandbox_root / f"candidate_{index}"
+            sandbox_output = sandbox / "output"
+            sandbox_output.mkdir(parents=True)
+            for path in inputs:
+                if path.is_dir():
+                    (sandbox_output / path.name).symlink_to(path, target_is_directory=True)
+            if self.preflight:
+                problems = validate_script(code, script_path, self.data_paths)
+                if problems:
+                    return 1, format_problems(problems, script_path), {}, sandbox_output
+            run_code = self.dev_sample.rewrite(code) if sample else code
+            run_path = sandbox / script_path.name
+            run_path.write_text(
+                rewrite_paths(run_code, {str(output_dir.resolve()): str(sandbox_output)})
+            )
+            pool = self.worker_pool
+            returncode, error, run_usage = run_python_script(
+                run_path,
+                env,
+                logger,
+                # Scripts beyond the pool's size would wait for a worker
+                pool if pool is not None and index < pool.size else None,
+                limits=self.script_limits,
+                return_usage=True,
+                cancel=cancel,
+            )
+            name = f"{script_path.name} (candidate {index + 1})"
+            self._record_run(name, sample, returncode, run_usage)
+            if returncode == 0:
+                invalid = self._check_outputs(sandbox_output)
+                if invalid:
+                    returncode, error = 1, invalid
+            error = rewrite_paths(error, {str(sandbox_output): str(output_dir.resolve())})
+            return returncode, error, run_usage, sandbox_output
+
+        results = {}
+        winner = None
+        with ThreadPoolExecutor(max_workers=len(candidates)) as executor:
+            futures = {
+                executor.submit(run_candidate, index, code): index
+                for index, code in enumerate(candidates)
+            }
+            for future in as_completed(futures):
+                index = futures[future]
+                results[index] = future.result()
+                if results[index][0] == 0 and winner is None:
+                    winner = index
+                    cancel.set()
+
+        kept = 0 if winner is None else winner
+        returncode, error, run_usage, sandbox_output = results[kept]
+        with open(script_path, "w") as script_file:
+            script_file.write(candidates[kept])
+        self.bug_fixer.track_fix(script, stderr, candidates[kept])
+        if winner is not None:
+            logger.info(f"Fix candidate {winner + 1} of {len(candidates)} succeeded")
+            for path in output_dir.iterdir():
+                if path in inputs:
+                    continue
+                if path.is_dir() and not path.is_symlink():
+                    shutil.rmtree(path)
+                else:
+                    path.unlink()
+            for path in sandbox_output.iterdir():
+                if not path.is_symlink():
+                    shutil.move(path, output_dir / path.name)
+        else:
+            logger.warning(f"None of the {len(candidates)} fix candidates succeeded")
+        shutil.rmtree(sandbox_root, ignore_errors=True)
+        with contextlib.suppress(OSError):
+            # Only removed if no other script's sandboxes are left
+            sandbox_root.parent.rmdir()
+        error = self.dev_sample.restore(error) if sample else error
+        return returncode, error, run_usage
+
+    def _check_outputs(self, output_dir: Path) -> Optional[str]:
+        """Check the outputs a script wrote to a directory, ignoring linked inputs.
+
+        Returns:
+            Description of the problem, or None if the outputs are valid
+        """
+        written = []
+        for entry in output_dir.iterdir():
+            if entry.is_symlink():
+                continue
+            if entry.is_file():
+                written.append(entry)
+            else:
+                written.extend(path for path in entry.rglob("*") if path.is_file())
+        if not written:
+            return f"The script did not write any output to {output_dir}"
+        for path in written:
+            if path.suffix == ".parquet":
+                try:
+                    pq.read_metadata(path)
+                except Exception as e:
+                    return f"Output {path} is not a valid parquet file: {e!s}"
+            elif path.stat().st_size == 0:
+                return f"Output {path} is empty"
+        return None
+
+    def stage_outputs(self) -> list[Path]:
+        """Files and directories written by the agent's script, kept by the stage cache."""
+        return [Path(self.output_dir)]
+
+    def _active_sample_dir(self) -> Optional[Path]:
+        if self.dev_sample is not None and self.dev_sample.active:
+            return self.dev_sample.sample_dir
+        return None
+
+    def restore_stage(self) -> Optional[Path]:
+        """Reuse the outputs of an earlier run of the stage with the same inputs.
+
+        Returns:
+            Path of the stage's script, restored from the cache, or None if the stage
+            is not cached and must be generated and run
+        """
+        if self.stage_cache is None or self.stage_key is None:
+            return None
+        script_path = self.script_dir / self.script_name
+        sample_dir = self._active_sample_dir()
+        meta = self.stage_cache.restore(
+            self.stage_key, self.stage_outputs(), script_path, sample_dir
+        )
+        if meta is None:
+            return None
+        self.stage_build = meta["build_id"]
+        if sample_dir is not None and not meta["sample_restored"]:
+            # Later stages have no sample outputs to run on
+            self.dev_sample.active = False
+        logger.info(f"Reusing the cached outputs of the {self.script_description} stage")
+        return script_path
+
+    def _store_stage(self, script_path: Path) -> None:
+        """Cache the outputs and final script of the stage after a successful run."""
+        if self.stage_cache is None or self.stage_key is None:
+            return
+        meta = self.stage_cache.store(
+            self.stage_key,
+            type(self).__name__,
+            self.stage_outputs(),
+            script_path,
+            self._active_sample_dir(),
+        )
+        if meta is not None:
+            self.stage_build = meta["build_id"]
+
+    @staticmethod
+    def _checkpoint_dir(script_path: Path) -> Path:
+        """Directory of the cell checkpoints of a script."""
+        return script_path.parent / ".checkpoints" / script_path.stem
+
+    def _clear_checkpoints(self, script_path: Path) -> None:
+        """Remove the cell checkpoints of a script and of its development sample copy."""
+        paths = [script_path]
+        if self.dev_sample is not None:
+            paths.append(self.dev_sample.sample_path(script_path))
+        for path in paths:
+            shutil.rmtree(self._checkpoint_dir(Path(path)), ignore_errors=True)
@@ -0,0 +1,332 @@
+"""Token budgeting of prompt context such as dataset schemas and code."""
+
+import logging
+import re
+from functools import lru_cache
+from typing import Optional
+
+from ..llm import estimate_tokens
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_PROMPT_TOKENS = 32_000
+
+# Minimum number of columns sharing a name pattern before they are collapsed
+MIN_GROUP_SIZE = 3
+
+# Patterns ranking the importance of code lines when trimming code
+_IO_PATTERN = re.compile(
+    r"\b(read_\w+|scan_\w+|write_\w+|to_parquet|to_csv|save\w*|load\w*|open|Path|dump)\("
+)
+_STRUCTURE_PATTERN = re.compile(
+    r"^\s*(def |class |return\b|if __name__|for |while |with |try:|except\b)"
+)
+_DATA_PATTERN = re.compile(
+    r"\b(merge|join|concat|groupby|group_by|agg|fit|predict\w*)\(|LABEL"
+)
+
+
+@lru_cache(maxsize=8)
+def _encoding(model_name: Optional[str]):
+    """Return the tiktoken encoding of a model, or None if it is not available."""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model_name or "gpt-4o")
+    except KeyError:
+        # Other providers' tokenizers are close enough to OpenAI's latest one for budgeting
+        return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # Encodings are downloaded on first use, which fails when offline
+        logger.warning(f"tiktoken encoding unavailable, estimating token counts: {e!s}")
+        return None
+
+
+def count_tokens(text: str, model_name: Optional[str] = None) -> int:
+    """Count the tokens of text with tiktoken, or estimate them if it is not installed."""
+    encoding = _encoding(model_name)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def group_columns(names: list[str], by_prefix: bool = False) -> list[str]:
+    """Collapse column names that differ only in numbers, e.g. 'lag_1' ... 'lag_30'.
+
+    Args:
+        names: Column names
+        by_prefix: Also collapse names sharing the part before the first underscore,
+            e.g. 'token_price', 'token_volume' and 'token_supply'
+
+    Returns:
+        Column names and descriptions of collapsed groups, in order of first appearance
+    """
+    groups = {}
+    for name in names:
+        groups.setdefault(re.sub(r"\d+", "#", name), []).append(name)
+
+    grouped = []
+    for members in groups.values():
+        if len(members) >= MIN_GROUP_SIZE:
+            grouped.append(f"{members[0]} ... {members[-1]} ({len(members)} columns)")
+        else:
+            grouped.extend(members)
+    if not by_prefix:
+        return grouped
+
+    # Collapsed groups are kept as they are, other names are grouped by prefix
+    prefixes = {}
+    for name in grouped:
+        prefix, sep, rest = name.partition("_")
+        if sep and rest and " " not in name:
+            prefixes.setdefault(prefix, []).append(rest)
+        else:
+            prefixes[name] = None
+    result = []
+    for prefix, rests in prefixes.items():
+        if rests is None:
+            result.append(prefix)
+        elif len(rests) >= MIN_GROUP_SIZE:
+            result.append(f"{prefix}_{{{', '.join(rests)}}}")
+        else:
+            result.extend(f"{prefix}_{rest}" for rest in rests)
+    return result
+
+
+def _truncate(text: str, max_chars: int) -> str:
+    """Truncate text to ``max_chars`` characters, marking the cut."""
+    text = str(text)
+    return text if len(text) <= max_chars else text[: max_chars - 3].rstrip() + "..."
+
+
+def _omission(count: int) -> str:
+    """Comment replacing omitted code lines."""
+    return f"# ... ({count} line{'s' if count > 1 else ''} omitted)"
+
+
+class TokenBudgeter:
+    """Fit prompt context into a per-call token budget.
+
+    Schema descriptions are compacted step by step, from dropping redundant detail to
+    grouping columns by dtype and name pattern. Code is trimmed line by line, keeping
+    imports, structure and data input/output longest.
+    """
+
+    def __init__(
+        self,
+        max_prompt_tokens: int = DEFAULT_MAX_PROMPT_TOKENS,
+        model_name: Optional[str] = None,
+    ) -> None:
+        """Initialize token budgeter.
+
+        Args:
+            max_prompt_tokens: Token budget of a single user prompt
+            model_name: Model whose tokenizer is used for counting, if tiktoken is installed
+
+        """
+        self.max_prompt_tokens = max_prompt_tokens
+        self.model_name = model_name
+
+    def count(self, text: str) -> int:
+        """Count the tokens of text."""
+        return count_tokens(text, self.model_name)
+
+    def fit_context(self, template: str, context: dict) -> dict:
+        """Compact the large values of a prompt context to fit the budget.
+
+        ``dataset_info`` is compacted and values whose key ends in ``_code`` are trimmed.
+        The budget left by the template and the other values is shared between them in
+        proportion to their size.
+
+        Args:
+            template: Prompt template the context is formatted into
+            context: Template context
+
+        Returns:
+            Context with compacted values
+        """
+        compressible = [
+            key for key in context if key == "dataset_info" or key.endswith("_code")
+        ]
+        if not compressible:
+            return context
+        fixed = template.format(**{**context, **{key: "" for key in compressible}})
+        available = max(0, self.max_prompt_tokens - self.count(fixed))
+        sizes = {key: self.count(str(context[key])) for key in compressible}
+        total = sum(sizes.values())
+        if total <= available:
+            return context
+
+        logger.info(
+            f"Prompt context of {total} tokens exceeds the budget of {available} tokens, "
+            "compacting it"
+        )
+        fitted = dict(context)
+        for key in compressible:
+            budget = available * sizes[key] // total
+            if key == "dataset_info":
+                fitted[key] = self.compact_dataset_info(context[key], budget)
+            else:
+                fitted[key] = self.trim_code(context[key], budget)
+        return fitted
+
+    def compact_dataset_info(self, dataset_info: list[dict], budget: int) -> list[dict]:
+        """Compact table descriptions until they fit the token budget.
+
+        Args:
+            dataset_info: Table descriptions with name, description, shape, column dtypes,
+                column descriptions and optionally missing value counts
+            budget: Token budget of the formatted descriptions
+
+        Returns:
+            The most detailed compaction that fits, or the most compact one
+        """
+        compacted = dataset_info
+        for level in range(5):
+            compacted = [self._compact_table(info, level) for info in dataset_info]
+            if self.count(str(compacted)) <= budget:
+                if level:
+                    logger.info(f"Compacted dataset info to level {level}")
+                return compacted
+
+        # Finally, list only the leading column names of each dtype
+        max_names = 64
+        while max_names > 4:
+            compacted = [
+                self._compact_table(info, 5, max_names) for info in dataset_info
+            ]
+            if self.count(str(compacted)) <= budget:
+                break
+            max_names //= 2
+        logger.warning(
+            f"Dataset info compacted to {self.count(str(compacted))} tokens, "
+            f"budget is {budget}"
+        )
+        return compacted
+
+    @staticmethod
+    def _compact_table(info: dict, level: int, max_names: Optional[int] = None) -> dict:
+        """Compact the description of one table.
+
+        Levels: 0 unchanged, 1 no zero null counts and shorter descriptions, 2 columns
+        grouped by dtype and number patterns and column stats reduced to ranges and
+        distinct counts, 3 also grouped by name prefix and no column stats, 4 no column
+        descriptions and a null count summary, 5 like 4 with at most ``max_names``
+        names per dtype.
+        """
+        if level == 0:
+            return info
+        compact = {key: info[key] for key in ("name", "description", "shape") if key in info}
+        compact["description"] = _truncate(
+            info.get("description", ""), 500 if level < 4 else 200
+        )
+
+        dtypes = info.get("column_dtypes", {})
+        if level == 1:
+            compact["column_dtypes"] = dtypes
+        else:
+            by_dtype = {}
+            for col, dtype in dtypes.items():
+                by_dtype.setdefault(dtype, []).append(col)
+            compact["column_dtypes"] = {}
+            for dtype, names in by_dtype.items():
+                names = group_columns(names, by_prefix=level >= 3)
+                if max_names is not None and len(names) > max_names:
+                    names = names[:max_names] + [f"... and {len(names) - max_names} more"]
+                compact["column_dtypes"][dtype] = names
+
+        descriptions = info.get("column_descriptions", {})
+        if descriptions and level < 4:
+            max_chars = {1: 200, 2: 100, 3: 50}[level]
+            compact["column_descriptions"] = {
+                col: _truncate(desc, max_chars) for col, desc in descriptions.items()
+            }
+
+        stats = info.get("column_stats")
+        if stats and level < 3:
+            # Keep only ranges and distinct counts at level 2
+            keys = {"distinct", "min", "max"} if level == 2 else None
+            compact["column_stats"] = {
+                col: {k: v for k, v in col_stats.items() if keys is None or k in keys}
+                for col, col_stats in stats.items()
+            }
+
+        if "missing_values" in info:
+            nulls = {col: count for col, count in info["missing_values"].items() if count}
+            if level < 4:
+                compact["missing_values"] = nulls
+            else:
+                compact["missing_values"] = {
+                    "columns_with_nulls": len(nulls),
+                    "max_null_count": max(nulls.values(), default=0),
+                }
+        return compact
+
+    def trim_code(self, code: str, budget: int) -> str:
+        """Trim code to the token budget, dropping its least important lines first.
+
+        Comments, blank lines and status prints go first, then ordinary statements, then
+        control flow and data transformations. Imports and data input/output are kept
+        longest. Runs of dropped lines are replaced by a comment.
+
+        Args:
+            code: Python code
+            budget: Token budget of the trimmed code
+
+        Returns:
+            Trimmed code
+        """
+        if self.count(code) <= budget:
+            return code
+
+        lines = code.splitlines()
+        priorities = [self._line_priority(line) for line in lines]
+        tokens = [self.count(line) + 1 for line in lines]
+        total = sum(tokens)
+        dropped = set()
+        # Drop the lowest priority first and, within a priority, the longest lines
+        for index in sorted(range(len(lines)), key=lambda i: (priorities[i], -tokens[i])):
+            if total <= budget * 0.9:
+                # Leave room for the omission markers
+                break
+            if priorities[index] >= 4:
+                break
+            dropped.add(index)
+            total -= tokens[index]
+
+        trimmed = []
+        omitted = 0
+        for index, line in enumerate(lines):
+            if index in dropped:
+                if priorities[index] > 0:
+                    omitted += 1
+                continue
+            if omitted:
+                indent = line[: len(line) - len(line.lstrip())]
+                trimmed.append(f"{indent}{_omission(omitted)}")
+                omitted = 0
+            trimmed.append(line)
+        if omitted:
+            trimmed.append(_omission(omitted))
+        result = "\n".join(trimmed)
+        logger.info(f"Trimmed code from {self.count(code)} to {self.count(result)} tokens")
+        return result
+
+    @staticmethod
+    def _line_priority(line: str) -> int:
+        """Importance of a code line when trimming, from 0 (dropped first) to 4 (kept)."""
+        stripped = line.strip()
+        if not stripped or stripped.startswith("#"):
+            return 0
+        if stripped.startswith(("print(", "logger.", "logging.")):
+            return 1
+        if stripped.startswith(("import ", "from ")) or _IO_PATTERN.search(stripped):
+            return 4
+        if _STRUCTURE_PATTERN.match(line) or _DATA_PATTERN.search(stripped):
+            return 3
+        return 2
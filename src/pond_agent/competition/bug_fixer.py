@@ -1,42 +1,332 @@
 """Bug fixer agent for Python code."""
 
+import asyncio
+import logging
 from typing import Optional
 
 from .base import BaseAgent
-from ..llm import LLMClient
+from .fix_memory import FixMemory, error_signature
+from .patches import apply_edits, code_window, failing_lines, parse_edits, trim_traceback
+from .utils import clean_script
+from ..llm import LLMClient, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Temperatures of speculative fix candidates, cycled through, from focused to diverse
+CANDIDATE_TEMPERATURES = (0.1, 0.5, 0.8, 1.0)
 
 
 class BugFixer(BaseAgent):
     """Bug fixer agent for Python code."""
 
-    def __init__(self, llm_client: LLMClient) -> None:
+    def __init__(
+        self,
+        llm_client: LLMClient,
+        candidate_targets: Optional[list[str]] = None,
+        memory: Optional[FixMemory] = None,
+        patches: bool = True,
+    ) -> None:
         """Initialize bug fixer agent.
 
         Args:
             llm_client: LLM client for getting fixes
+            candidate_targets: Optional 'provider:model' targets that speculative fix
+                candidates are spread over, in addition to the client's own model
+            memory: Optional memory of earlier fixes, tried before asking the LLM
+            patches: Ask for search/replace edits of the code around the failing lines
+                instead of the whole corrected script, see :meth:`_patch_prompts`
         """
         super().__init__()
         self.llm_client = llm_client
+        self.candidate_targets = candidate_targets or []
+        self.memory = memory
+        self.patches = patches
+        # Fix whose outcome is reported next, see report_outcome
+        self.last_fix = None
+        # Stored fixes already tried since the last successful run
+        self._tried = set()
 
-    def fix_bug(self, code: str, error: str) -> Optional[str]:
-        """Fix bug in code based on error message.
+    def recall_fix(self, code: str, error: str) -> Optional[str]:
+        """Apply a stored fix for the error, if the memory has one that was not tried yet.
 
         Args:
             code: Code containing the bug
             error: Error message from running the code
 
         Returns:
-            Fixed code if successful, None if unable to fix
+            Fixed code, or None if no stored fix applies
+        """
+        if self.memory is None:
+            return None
+        for edits_hash, fixed_code in self.memory.lookup(code, error):
+            if edits_hash in self._tried:
+                continue
+            self._tried.add(edits_hash)
+            logger.info("Applying a stored fix for this error instead of asking the LLM")
+            self.track_fix(code, error, fixed_code, edits_hash)
+            return fixed_code
+        return None
+
+    def track_fix(
+        self, code: str, error: str, fixed_code: str, edits_hash: Optional[str] = None
+    ) -> None:
+        """Remember a fix that is about to be run, so that its outcome can be reported.
+
+        Args:
+            code: Code containing the bug
+            error: Error message from running the code
+            fixed_code: Fixed code
+            edits_hash: Identifier of the stored fix, None for a fix from the LLM
         """
-        context = {
+        self.last_fix = {
             "code": code,
             "error": error,
+            "fixed_code": fixed_code,
+            "edits_hash": edits_hash,
         }
-        sys_prompt = self.load_prompt_template("bug_fixer_system.txt")
-        user_prompt = self.load_prompt_template("bug_fixer_user.txt", context)
+
+    def report_outcome(self, returncode: int, error: str) -> None:
+        """Update the memory with the outcome of running the last fix.
+
+        Only a fix after which the script succeeded counts as working, a fix that merely
+        leads to another error is not stored. A fix after which the script fails with the
+        same error counts as failed. Working fixes from the LLM are stored; stored fixes
+        are ranked by how often they worked.
+
+        Args:
+            returncode: Return code of the run of the fixed code
+            error: Error message of the run
+        """
+        fix, self.last_fix = self.last_fix, None
+        if fix is None or self.memory is None:
+            return
+        if returncode == 0:
+            worked = True
+            self._tried.clear()
+        elif error_signature(error) == error_signature(fix["error"]):
+            worked = False
+        else:
+            # Another error, or one without a traceback, e.g. of the pre-flight check,
+            # says nothing about whether the fix is right
+            return
+        if fix["edits_hash"] is not None:
+            self.memory.report(fix["error"], fix["edits_hash"], worked)
+        elif worked:
+            self.memory.record(fix["error"], fix["code"], fix["fixed_code"])
+
+    def fix_bug(self, code: str, error: str, usage: Optional[dict] = None) -> Optional[str]:
+        """Fix bug in code based on error message.
+
+        Fixes stored in the memory for the same error are tried first. Otherwise the LLM
+        is asked for a patch, and for the whole corrected script if the patch does not
+        apply.
+
+        Args:
+            code: Code containing the bug
+            error: Error message from running the code
+            usage: Resource usage of a run that was killed for exceeding a resource
+                limit, see ``tools.run_python_script``
+
+        Returns:
+            Fixed code if successful, None if unable to fix
+        """
+        fixed_code = self.recall_fix(code, error)
+        if fixed_code is not None:
+            return fixed_code
+        # Fixes are tracked with the full error, which the memory's signatures need
+        trimmed = trim_traceback(error)
+        patch_prompts = self._patch_prompts(code, trimmed, usage)
+        if patch_prompts is not None:
+            sys_prompt, user_prompt, expected_tokens = patch_prompts
+            response = self.llm_client.get_response(
+                user_prompt,
+                sys_prompt,
+                json_response=False,
+                max_tokens=self.llm_client.size_max_tokens(expected_tokens),
+                caller="BugFixer",
+            )
+            fixed_code = self._apply_patch(code, response)
+            if fixed_code is not None:
+                self.track_fix(code, error, fixed_code)
+                return fixed_code
+        sys_prompt, code_prompt, error_prompt = self._build_prompts(code, trimmed, usage)
         response = self.llm_client.get_response(
-            user_prompt, sys_prompt, json_response=False
+            error_prompt,
+            sys_prompt,
+            json_response=False,
+            # The fixed script is about as long as the original one
+            max_tokens=self.llm_client.size_max_tokens(estimate_tokens(code)),
+            caller="BugFixer",
+            prefix=code_prompt,
+        )
+        fixed_code = self._clean_response(response)
+        if fixed_code:
+            self.track_fix(code, error, fixed_code)
+        return fixed_code
+
+    async def afix_bug(
+        self,
+        code: str,
+        error: str,
+        usage: Optional[dict] = None,
+        temperature: float = 0.1,
+        target: Optional[str] = None,
+        use_cache: Optional[bool] = None,
+    ) -> Optional[str]:
+        """Fix bug in code without blocking the event loop, with a patch if possible.
+
+        Args:
+            code: Code containing the bug
+            error: Error message from running the code
+            usage: Resource usage of a run that was killed for exceeding a resource
+                limit, see ``tools.run_python_script``
+            temperature: Sampling temperature of the fix
+            target: Optional 'provider:model' target asked instead of the client's model
+            use_cache: Whether to use the response cache (default: the client's setting)
+
+        Returns:
+            Fixed code if successful, None if unable to fix
+        """
+        client = self.llm_client
+        if target is not None:
+            client = client._target_client(target)
+        error = trim_traceback(error)
+        patch_prompts = self._patch_prompts(code, error, usage)
+        if patch_prompts is not None:
+            sys_prompt, user_prompt, expected_tokens = patch_prompts
+            response = await client.aget_response(
+                user_prompt,
+                sys_prompt,
+                json_response=False,
+                temperature=temperature,
+                max_tokens=client.size_max_tokens(expected_tokens),
+                use_cache=use_cache,
+                caller="BugFixer",
+            )
+            fixed_code = self._apply_patch(code, response)
+            if fixed_code is not None:
+                return fixed_code
+        sys_prompt, code_prompt, error_prompt = self._build_prompts(code, error, usage)
+        response = await client.aget_response(
+            error_prompt,
+            sys_prompt,
+            json_response=False,
+            temperature=temperature,
+            # The fixed script is about as long as the original one
+            max_tokens=client.size_max_tokens(estimate_tokens(code)),
+            use_cache=use_cache,
+            caller="BugFixer",
+            prefix=code_prompt,
         )
+        return self._clean_response(response)
+
+    async def afix_candidates(
+        self, code: str, error: str, count: int, usage: Optional[dict] = None
+    ) -> list[str]:
+        """Request several diverse fixes concurrently.
+
+        Candidates are spread over the client's model and the ``candidate_targets`` and
+        over increasing temperatures. Failed requests and duplicate fixes are dropped.
+
+        Args:
+            code: Code containing the bug
+            error: Error message from running the code
+            count: Number of candidates requested
+            usage: Resource usage of a run that was killed for exceeding a resource
+                limit, see ``tools.run_python_script``
+
+        Returns:
+            Distinct fixed scripts, the most conservative request first
+        """
+        targets = [None, *self.candidate_targets]
+        requests = [
+            self.afix_bug(
+                code,
+                error,
+                usage,
+                temperature=CANDIDATE_TEMPERATURES[index % len(CANDIDATE_TEMPERATURES)],
+                target=targets[index % len(targets)],
+                # Otherwise repeated temperatures would return the cached candidate
+                use_cache=None if index == 0 else False,
+            )
+            for index in range(count)
+        ]
+        candidates = []
+        for result in await asyncio.gather(*requests, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.warning(f"Fix candidate request failed: {result!s}")
+            elif result and result not in candidates:
+                candidates.append(result)
+        return candidates
+
+    def _build_prompts(
+        self, code: str, error: str, usage: Optional[dict] = None
+    ) -> tuple[str, str, str]:
+        """Build system prompt, code prompt and error prompt for a fix request.
+
+        The instructions and code come first so that repeated requests for the same code
+        can be served from the provider's prompt cache.
+        """
+        sys_prompt = self.load_prompt_template("bug_fixer_system.txt")
+        code_prompt = self.load_prompt_template("bug_fixer_user.txt", {"code": code})
+        if usage and usage.get("limit"):
+            error += "\n\n" + self.load_prompt_template(
+                "bug_fixer_resources.txt",
+                {
+                    "wall_time": usage["wall_time"],
+                    "cpu_time": usage["cpu_time"] or 0.0,
+                    "peak_rss_mb": usage["peak_rss_mb"] or 0.0,
+                    "read_mb": usage["read_mb"] or 0.0,
+                    "write_mb": usage["write_mb"] or 0.0,
+                },
+            )
+        error_prompt = self.load_prompt_template("bug_fixer_error.txt", {"error": error})
+        return sys_prompt, code_prompt, error_prompt
+
+    def _patch_prompts(
+        self, code: str, error: str, usage: Optional[dict] = None
+    ) -> Optional[tuple[str, str, int]]:
+        """Build the prompts of a patch request, showing the code around the failing lines.
+
+        Scripts killed for exceeding a resource limit are regenerated in whole, as making
+        them cheaper usually takes more than a local change.
+
+        Returns:
+            System prompt, user prompt and expected tokens of the response, or None if
+            patches are disabled or the error points to no line of the script
+        """
+        if not self.patches or (usage and usage.get("limit")):
+            return None
+        lines = failing_lines(error, len(code.splitlines()))
+        if not lines:
+            return None
+        window = code_window(code, lines)
+        sys_prompt = self.load_prompt_template("bug_fixer_system.txt")
+        user_prompt = self.load_prompt_template(
+            "bug_fixer_patch.txt", {"code": window, "error": error}
+        )
+        # Edits repeat the lines they change, which are a part of the shown code
+        return sys_prompt, user_prompt, estimate_tokens(window)
+
+    @staticmethod
+    def _apply_patch(code: str, response: Optional[str]) -> Optional[str]:
+        """Apply the edits of a patch response to the code.
+
+        Returns:
+            Patched code, or None if the response has no edits, an edit does not match
+            the code exactly once or the patched code does not parse
+        """
+        edits = parse_edits(response or "")
+        fixed_code = apply_edits(code, edits) if edits else None
+        if fixed_code is None or fixed_code == code:
+            logger.warning("Patch could not be applied, asking for the whole script")
+            return None
+        logger.info(f"Applied a patch of {len(edits)} edits")
+        return fixed_code
+
+    @staticmethod
+    def _clean_response(response: Optional[str]) -> Optional[str]:
+        """Strip markdown fences from the LLM response."""
         if response:
-            response = response.strip().strip("`").removeprefix("python")
+            response = clean_script(response)
         return response if response else None
@@ -1,17 +1,17 @@
 """Data processing module with LLM-powered analysis."""
 
 import logging
-import os
-import subprocess
 from pathlib import Path
+from typing import Optional
 
 import polars as pl
 
 from ..llm import LLMClient
-from ..tools import run_python_script
 from .base import BaseAgent
+from .budget import DEFAULT_MAX_PROMPT_TOKENS, TokenBudgeter
 from .bug_fixer import BugFixer
-from .utils import load_parquet_data
+from .profiler import profile_dataset, summarize_profile
+from .utils import clean_script, load_parquet_data, load_parquet_metadata
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +19,10 @@ logger = logging.getLogger(__name__)
 class DataProcessor(BaseAgent):
     """Data processing component."""
 
+    script_description = "data processing"
+    script_name = "preprocess_data.py"
+    prompt_templates = ("data_processor_system.txt", "data_processor_user.txt")
+
     def __init__(
         self,
         llm_client: LLMClient,
@@ -27,6 +31,8 @@ class DataProcessor(BaseAgent):
         script_dir: Path,
         task_description: dict,
         data_dictionary: dict,
+        max_prompt_tokens: int = DEFAULT_MAX_PROMPT_TOKENS,
+        profile_data: bool = True,
     ) -> None:
         """Initialize data processor.
 
@@ -36,6 +42,10 @@ class DataProcessor(BaseAgent):
             output_dir: Directory to save processed data
             task_description: Task description
             data_dictionary: Optional data dictionary
+            max_prompt_tokens: Token budget of the prompt, which large dataset info and
+                code are compacted to fit
+            profile_data: Add column statistics (ranges, distinct counts, quantiles and
+                frequent values) of the input data to the prompt
 
         """
         super().__init__()
@@ -47,6 +57,14 @@ class DataProcessor(BaseAgent):
         self.data_dictionary = data_dictionary
         self.script = None
         self.bug_fixer = BugFixer(llm_client)
+        self.budgeter = TokenBudgeter(max_prompt_tokens, llm_client.model_name)
+        self.profile_data = profile_data
+
+    def prefetch_context(self) -> None:
+        """Also profile the raw data, whose profiles are cached next to it for the prompt."""
+        super().prefetch_context()
+        if self.profile_data:
+            profile_dataset(self.input_dir)
 
     def generate_script(self) -> str:
         """Generate data processing script.
@@ -57,14 +75,16 @@ class DataProcessor(BaseAgent):
         """
         logger.info("Generating data processing script")
 
-        # Load raw data to get schema
-        raw_data, data_paths = load_parquet_data(self.input_dir, return_path=True)
+        # Read schema from the parquet metadata, without loading the data
+        raw_data, data_paths = load_parquet_metadata(self.input_dir, return_path=True)
+        # Known to the pre-flight check of the script
+        self.data_paths = data_paths
 
-        # Get preprocessing recommendations
-        script = self._get_script_from_llm(raw_data, data_paths)
+        # Get preprocessing recommendations, streamed to disk as it is generated
+        script_path = self.script_dir / self.script_name
+        script = self._get_script_from_llm(raw_data, data_paths, script_path)
 
-        # Save script
-        script_path = self.script_dir / "preprocess_data.py"
+        # Save cleaned script
         with open(script_path, "w") as f:  # noqa: PTH123
             f.write(script)
             logger.info("Saved processing script to %s", script_path)
@@ -73,35 +93,37 @@ class DataProcessor(BaseAgent):
 
     def _get_script_from_llm(
         self,
-        raw_data: dict[str, pl.DataFrame],
+        raw_data: dict[str, dict],
         data_paths: dict[str, str],
+        script_path: Optional[Path] = None,
     ) -> str:
         """Get feature engineering recommendations from LLM.
 
         Args:
             data_paths: Dictionary of data paths
-            processed_data: Dictionary of processed DataFrames
+            script_path: Optional path the script is streamed to while generated
+            processed_data: Dictionary of processed table metadata
         Returns:
             Dictionary containing feature engineering script
 
         """
-        # Prepare dataset info for LLM
+        # Prepare dataset info for LLM. Profiles are cached next to the data.
+        profiles = profile_dataset(self.input_dir) if self.profile_data else {}
         dataset_info = []
-        for name, df in raw_data.items():
+        for name, meta in raw_data.items():
             data_dict = self.data_dictionary.get(name, {})
             info = {
                 "name": name,
                 "description": data_dict.get("description", ""),
-                "shape": df.shape,
+                "shape": meta["shape"],
                 "column_dtypes": {
-                    str(col): str(dtype) for col, dtype in df.schema.items()
+                    str(col): str(dtype) for col, dtype in meta["schema"].items()
                 },
                 "column_descriptions": data_dict.get("columns", {}),
-                "missing_values": {
-                    col: count
-                    for col, count in zip(df.columns, df.null_count(), strict=False)
-                },
+                "missing_values": meta["null_counts"],
             }
+            if name in profiles:
+                info["column_stats"] = summarize_profile(profiles[name])
             dataset_info.append(info)
 
         context = {
@@ -115,11 +137,40 @@ class DataProcessor(BaseAgent):
         sys_prompt = self.load_prompt_template("data_processor_system.txt")
         user_prompt = self.load_prompt_template("data_processor_user.txt", context)
 
-        resp = self.llm.get_response(user_prompt, sys_prompt, json_response=False)
-        resp = resp.strip().strip("`").removeprefix("python")
+        resp = self.stream_script(user_prompt, sys_prompt, script_path)
+        resp = clean_script(resp)
         self.script = resp
         return resp
 
+    def execute(self, retry_count: int = 3) -> None:
+        """Generate the data processing script and run it, without loading its outputs.
+
+        Args:
+            retry_count: Number of fix attempts, separately on the sample and full data
+
+        """
+        logger.info("Processing raw data files")
+
+        # Outputs of an earlier run with the same inputs are reused
+        if self.restore_stage() is None:
+            # Generate and save script, unless a resumed run has one
+            script_path = self.resume_script or self.generate_script()
+            if not script_path.exists():
+                msg = f"data_processing.py not found in {self.script_dir}"
+                raise ValueError(msg)
+
+            self.run_script(script_path, retry_count)
+
+    def output_metadata(self) -> dict[str, dict]:
+        """Describe the output tables from their parquet metadata, without loading them.
+
+        Returns:
+            Dictionary of processed table metadata (shape, schema and null counts), see
+            :func:`~pond_agent.competition.utils.read_parquet_metadata`
+
+        """
+        return load_parquet_metadata(self.output_dir)
+
     def run(self, retry_count: int = 3) -> dict[str, pl.DataFrame]:
         """Process raw data files by executing generated script.
 
@@ -127,50 +178,5 @@ class DataProcessor(BaseAgent):
             Dictionary of processed DataFrames
 
         """
-        logger.info("Processing raw data files")
-
-        # Generate and save script
-        script_path = self.generate_script()
-        if not script_path.exists():
-            msg = f"data_processing.py not found in {self.script_dir}"
-            raise ValueError(msg)
-
-        # Execute script in subprocess
-        env = os.environ.copy()
-        env["PYTHONPATH"] = str(
-            Path(__file__).parent.parent.parent
-        )  # Add project root to PYTHONPATH
-
-        try:
-            returncode, stderr = run_python_script(script_path, env, logger)
-
-            while returncode != 0 and retry_count > 0:
-                msg = f"Error executing data processing script: {stderr}"
-                logger.error(msg)
-                logger.info("Attempting to fix bug, %d attempts remaining", retry_count)
-                with open(script_path) as script_file:
-                    script = script_file.read()
-                fixed_code = self.bug_fixer.fix_bug(script, stderr)
-                if fixed_code:
-                    with open(script_path, "w") as script_file:
-                        script_file.write(fixed_code)
-                    returncode, stderr = run_python_script(script_path, env, logger)
-                retry_count -= 1
-
-            if returncode != 0:
-                msg = f"Cannot fix the bug: {stderr}"
-                logger.error(msg)
-                raise RuntimeError(msg) from None
-
-            logger.info("Successfully executed data processing script")
-            # Load processed datasets
-            return load_parquet_data(self.output_dir)
-
-        except subprocess.CalledProcessError as e:
-            msg = f"Error executing data processing script: {e.stderr}"
-            logger.error(msg)
-            raise RuntimeError(msg) from e
-
-        except RuntimeError as e:
-            logger.error(str(e))
-            raise
\ No newline at end of file
+        self.execute(retry_count)
+        return load_parquet_data(self.output_dir)
@@ -0,0 +1,291 @@
+"""Small, representative samples of the input data for developing generated scripts."""
+
+import logging
+import os
+import re
+import shutil
+from collections import Counter
+from pathlib import Path
+from typing import Optional
+
+import polars as pl
+
+from .utils import (
+    HIVE_PARTITION,
+    _is_hive_partitioned,
+    _parquet_sources,
+    read_parquet_metadata,
+    scan_parquet_dataset,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SAMPLE_ROWS = 50_000
+# Resolution of hash-based sampling fractions
+BUCKETS = 1_000_000
+# Rows (or keys) kept per label class, however rare, when stratifying
+MIN_ROWS_PER_CLASS = 20
+# Labels with more distinct values are treated as continuous and not stratified on
+MAX_CLASSES = 100
+# Column names that look like join keys, e.g. 'id', 'user_id', 'TOKEN_KEY' or 'userId'
+KEY_PATTERN = re.compile(r"(?i:(^|_)(id|key|uuid)$)|[a-z](Id|ID)$")
+
+
+def path_pattern(paths: dict[str, str] | list[str]) -> re.Pattern:
+    """Pattern matching any of the paths, longest first and not as a name prefix."""
+    alternatives = "|".join(re.escape(path) for path in sorted(paths, key=len, reverse=True))
+    return re.compile(f"(?:{alternatives})(?![\\w.-])")
+
+
+def rewrite_paths(text: str, paths: dict[str, str]) -> str:
+    """Replace the paths in a text, e.g. a script, in a single pass.
+
+    Args:
+        text: Text containing paths
+        paths: Dictionary mapping paths to their replacements. A path only matches as
+            a whole name, e.g. '/data' does not match '/data2'
+
+    Returns:
+        Text with replaced paths
+    """
+    return path_pattern(paths).sub(lambda match: paths[match.group(0)], text)
+
+
+def _partition_keys(path: Path) -> list[str]:
+    """Names of the hive partition keys of a directory, outermost first."""
+    keys = []
+    while True:
+        partitions = [
+            item for item in path.iterdir() if item.is_dir() and HIVE_PARTITION.match(item.name)
+        ]
+        if not partitions:
+            return keys
+        keys.append(partitions[0].name.split("=")[0])
+        path = partitions[0]
+
+
+def _link_tree(source: Path, target: Path) -> None:
+    """Hard link a file or the files of a directory, copying where links are unsupported."""
+    files = [source] if source.is_file() else sorted(source.rglob("*.parquet"))
+    for file in files:
+        destination = target if source.is_file() else target / file.relative_to(source)
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(file, destination)
+        except OSError:
+            shutil.copy2(file, destination)
+
+
+class DevSample:
+    """Sample of the input data that generated scripts are developed on.
+
+    Every table is reduced to about ``sample_rows`` rows, keeping it representative:
+
+    - Tables sharing a join key are sampled by a hash of the key, so the same keys are
+      kept in every table and joins still match. If the label table has the key, rare
+      label classes are topped up with keys of that class.
+    - Time series tables keep a contiguous window of the most recent rows.
+    - The label table is stratified on the label, so every class is present.
+    - Other tables are sampled uniformly, and small tables are kept whole.
+
+    Scripts are run on the sample by rewriting their paths: the data directory maps to
+    ``<run_dir>/dev_sample/dataset`` and the rest of the run directory to
+    ``<run_dir>/dev_sample``. Sample runs thus write their outputs next to the sample,
+    where the sample runs of later stages read them.
+    """
+
+    def __init__(
+        self,
+        data_dir: str | Path,
+        run_dir: str | Path,
+        sample_rows: int = DEFAULT_SAMPLE_ROWS,
+        seed: int = 0,
+    ) -> None:
+        """Initialize development sample.
+
+        Args:
+            data_dir: Directory containing the raw data files
+            run_dir: Output directory of the run, the sample is created in its
+                ``dev_sample`` subdirectory
+            sample_rows: Approximate number of rows per table
+            seed: Seed of the sampling hashes
+
+        """
+        self.data_dir = Path(data_dir).resolve()
+        self.run_dir = Path(run_dir).resolve()
+        self.sample_dir = self.run_dir / "dev_sample"
+        self.sample_rows = sample_rows
+        self.seed = seed
+        # Whether scripts are run on the sample first. Cleared if the sample cannot be
+        # built or a stage's script never passes on it, as later stages depend on its
+        # sample outputs.
+        self.active = False
+        self._paths = {
+            str(self.data_dir): str(self.sample_dir / "dataset"),
+            str(self.run_dir): str(self.sample_dir),
+        }
+        self._pattern = path_pattern(self._paths)
+        self._reverse_paths = {sample: full for full, sample in self._paths.items()}
+        self._reverse_pattern = path_pattern(self._reverse_paths)
+
+    def rewrite(self, text: str) -> str:
+        """Point the paths in a script to the sample, in a single pass."""
+        return self._pattern.sub(lambda match: self._paths[match.group(0)], text)
+
+    def restore(self, text: str) -> str:
+        """Point the sample paths in a text, e.g. a traceback, back to the full data."""
+        return self._reverse_pattern.sub(lambda match: self._reverse_paths[match.group(0)], text)
+
+    def sample_path(self, path: str | Path) -> Path:
+        """Counterpart of a path of the data or run directory in the sample."""
+        return Path(self.rewrite(str(Path(path).resolve())))
+
+    def build(
+        self,
+        label_table: Optional[str] = None,
+        label_column: Optional[str] = None,
+        time_column: Optional[str] = None,
+        key_column: Optional[str] = None,
+    ) -> dict[str, dict]:
+        """Sample every table of the data directory into the sample directory.
+
+        Args:
+            label_table: Name of the table containing the labels
+            label_column: Name of the label column, stratified on if categorical
+            time_column: Name of the time column of time series tables
+            key_column: Join key shared by tables (default: the key-like column shared
+                by the most tables)
+
+        Returns:
+            Dictionary mapping table names to their full and sampled row counts and the
+            sampling method
+        """
+        sample_data_dir = self.sample_dir / "dataset"
+        if sample_data_dir.exists():
+            shutil.rmtree(sample_data_dir)
+        sample_data_dir.mkdir(parents=True)
+
+        sources = _parquet_sources(self.data_dir)
+        metadata = {name: read_parquet_metadata(path) for name, path in sources.items()}
+        schemas = {name: meta["schema"] for name, meta in metadata.items()}
+        rows = {name: meta["shape"][0] for name, meta in metadata.items()}
+
+        label_name = self._find_label_table(schemas, label_table, label_column)
+        stratify = label_name is not None and self._is_categorical(
+            sources[label_name], label_column
+        )
+        key_column = key_column or self._find_join_key(
+            schemas, exclude={label_column, time_column}
+        )
+        key_predicate = None
+        key_tables = [name for name, schema in schemas.items() if key_column in schema]
+        if key_tables:
+            # Keep the same fraction of keys in every table, sized for the largest one
+            fraction = min(1.0, self.sample_rows / max(max(rows[n] for n in key_tables), 1))
+            key_hash = pl.col(key_column).cast(pl.String).hash(self.seed)
+            key_predicate = key_hash % BUCKETS < int(fraction * BUCKETS)
+            if stratify and label_name in key_tables:
+                # Top up rare classes with the keys of their rows, in every table
+                extra_keys = (
+                    scan_parquet_dataset(sources[label_name], [key_column, label_column])
+                    .filter(key_hash.rank("dense").over(label_column) <= MIN_ROWS_PER_CLASS)
+                    .select(pl.col(key_column).cast(pl.String).unique())
+                    .collect()
+                    .to_series()
+                )
+                key_predicate = key_predicate | pl.col(key_column).cast(pl.String).is_in(
+                    extra_keys.implode()
+                )
+            logger.info(f"Sampling {len(key_tables)} tables on join key {key_column}")
+
+        summary = {}
+        for name, path in sources.items():
+            target = sample_data_dir / path.relative_to(self.data_dir)
+            lf = scan_parquet_dataset(path)
+            fraction = self.sample_rows / max(rows[name], 1)
+            row_hash = pl.int_range(pl.len()).hash(self.seed)
+            if key_predicate is not None and name in key_tables:
+                method = f"key {key_column}"
+                lf = lf.filter(key_predicate)
+            elif rows[name] <= self.sample_rows:
+                method = "full"
+                _link_tree(path, target)
+                lf = None
+            elif time_column in schemas[name]:
+                method = f"latest by {time_column}"
+                lf = lf.sort(time_column).tail(self.sample_rows)
+            elif name == label_name and stratify:
+                method = f"stratified on {label_column}"
+                lf = lf.filter(
+                    (row_hash % BUCKETS < int(fraction * BUCKETS))
+                    | (row_hash.rank("ordinal").over(label_column) <= MIN_ROWS_PER_CLASS)
+                )
+            else:
+                method = "uniform"
+                lf = lf.filter(row_hash % BUCKETS < int(fraction * BUCKETS))
+
+            if lf is not None:
+                self._write(lf, path, target)
+            summary[name] = {
+                "rows": rows[name],
+                "sample_rows": read_parquet_metadata(target)["shape"][0],
+                "method": method,
+            }
+
+        logger.info(f"Built development sample in {sample_data_dir}")
+        for name, info in summary.items():
+            logger.info(
+                f"  - {name}: {info['rows']} -> {info['sample_rows']} rows ({info['method']})"
+            )
+        self.active = True
+        return summary
+
+    @staticmethod
+    def _write(lf: pl.LazyFrame, source: Path, target: Path) -> None:
+        """Write a sampled table in the layout of its source."""
+        if source.is_file():
+            target.parent.mkdir(parents=True, exist_ok=True)
+            lf.sink_parquet(target)
+        elif _is_hive_partitioned(source):
+            lf.collect().write_parquet(target, partition_by=_partition_keys(source))
+        else:
+            target.mkdir(parents=True, exist_ok=True)
+            lf.sink_parquet(target / "part-0.parquet")
+
+    @staticmethod
+    def _find_label_table(
+        schemas: dict[str, dict], label_table: Optional[str], label_column: Optional[str]
+    ) -> Optional[str]:
+        """Name of the table containing the label column, preferring ``label_table``."""
+        if not label_column:
+            return None
+        candidates = [name for name, schema in schemas.items() if label_column in schema]
+        if label_table and label_table.upper() in candidates:
+            return label_table.upper()
+        if not candidates:
+            logger.warning(f"Label column {label_column} not found in the data")
+            return None
+        return candidates[0]
+
+    @staticmethod
+    def _is_categorical(path: Path, label_column: str) -> bool:
+        """Check whether a label has few enough distinct values to stratify on."""
+        distinct = (
+            scan_parquet_dataset(path, [label_column])
+            .select(pl.col(label_column).n_unique())
+            .collect()
+            .item()
+        )
+        return distinct <= MAX_CLASSES
+
+    @staticmethod
+    def _find_join_key(schemas: dict[str, dict], exclude: set) -> Optional[str]:
+        """Key-like column shared by the most tables, if any is shared."""
+        counts = Counter(
+            column
+            for schema in schemas.values()
+            for column in schema
+            if column not in exclude and KEY_PATTERN.search(column)
+        )
+        shared = [column for column, count in counts.items() if count >= 2]
+        return max(shared, key=lambda column: counts[column], default=None)
@@ -1,17 +1,17 @@
 """Feature engineering module with LLM-powered recommendations."""
 
 import logging
-import os
-import subprocess
 from pathlib import Path
+from typing import Optional
 
 import polars as pl
 
 from ..llm import LLMClient
-from ..tools import run_python_script
 from .base import BaseAgent
+from .budget import DEFAULT_MAX_PROMPT_TOKENS, TokenBudgeter
 from .bug_fixer import BugFixer
-from .utils import load_parquet_data
+from .profiler import profile_dataset, summarize_profile
+from .utils import clean_script, load_parquet_data, load_parquet_metadata
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +19,10 @@ logger = logging.getLogger(__name__)
 class FeatureEngineer(BaseAgent):
     """Feature engineering component."""
 
+    script_description = "feature engineering"
+    script_name = "engineer_features.py"
+    prompt_templates = ("feature_engineer_system.txt", "feature_engineer_user.txt")
+
     def __init__(
         self,
         llm_client: LLMClient,
@@ -27,6 +31,8 @@ class FeatureEngineer(BaseAgent):
         script_dir: Path,
         task_description: dict,
         data_dictionary: dict,
+        max_prompt_tokens: int = DEFAULT_MAX_PROMPT_TOKENS,
+        profile_data: bool = True,
     ) -> None:
         """Initialize data processor.
 
@@ -36,6 +42,10 @@ class FeatureEngineer(BaseAgent):
             output_dir: Directory to save processed data
             task_description: Task description
             data_dictionary: Optional data dictionary
+            max_prompt_tokens: Token budget of the prompt, which large dataset info and
+                code are compacted to fit
+            profile_data: Add column statistics (ranges, distinct counts, quantiles and
+                frequent values) of the input data to the prompt
 
         """
         super().__init__()
@@ -47,6 +57,8 @@ class FeatureEngineer(BaseAgent):
         self.data_dictionary = data_dictionary
         self.script = None
         self.bug_fixer = BugFixer(llm_client)
+        self.budgeter = TokenBudgeter(max_prompt_tokens, llm_client.model_name)
+        self.profile_data = profile_data
 
     def generate_script(self) -> str:
         """Generate feature engineering script.
@@ -57,14 +69,16 @@ class FeatureEngineer(BaseAgent):
         """
         logger.info("Generating feature engineering script")
 
-        # Load processed data to get schema
-        processed_data, data_paths = load_parquet_data(self.input_dir, return_path=True)
+        # Read schema from the parquet metadata, without loading the data
+        processed_data, data_paths = load_parquet_metadata(self.input_dir, return_path=True)
+        # Known to the pre-flight check of the script
+        self.data_paths = data_paths
 
-        # Get feature engineering script
-        script = self._get_script_from_llm(processed_data, data_paths)
+        # Get feature engineering script, streamed to disk as it is generated
+        script_path = self.script_dir / self.script_name
+        script = self._get_script_from_llm(processed_data, data_paths, script_path)
 
-        # Save script
-        script_path = self.script_dir / "engineer_features.py"
+        # Save cleaned script
         with open(script_path, "w") as f:  # noqa: PTH123
             f.write(script)
             logger.info("Saved feature engineering script to %s", script_path)
@@ -73,31 +87,36 @@ class FeatureEngineer(BaseAgent):
 
     def _get_script_from_llm(
         self,
-        processed_data: dict[str, pl.DataFrame],
+        processed_data: dict[str, dict],
         data_paths: dict[str, str],
+        script_path: Optional[Path] = None,
     ) -> str:
         """Get feature engineering recommendations from LLM.
 
         Args:
             data_paths: Dictionary of data paths
-            processed_data: Dictionary of processed DataFrames
+            script_path: Optional path the script is streamed to while generated
+            processed_data: Dictionary of processed table metadata
         Returns:
             Dictionary containing feature engineering script
 
         """
-        # Prepare dataset info for LLM
+        # Prepare dataset info for LLM. Profiles are cached next to the data.
+        profiles = profile_dataset(self.input_dir) if self.profile_data else {}
         dataset_info = []
-        for name, df in processed_data.items():
+        for name, meta in processed_data.items():
             data_dict = self.data_dictionary.get(name, {})
             info = {
                 "name": name,
                 "description": data_dict.get("description", ""),
-                "shape": df.shape,
+                "shape": meta["shape"],
                 "column_dtypes": {
-                    str(col): str(dtype) for col, dtype in df.schema.items()
+                    str(col): str(dtype) for col, dtype in meta["schema"].items()
                 },
                 "column_descriptions": data_dict.get("columns", {}),
             }
+            if name in profiles:
+                info["column_stats"] = summarize_profile(profiles[name])
             dataset_info.append(info)
 
         context = {
@@ -113,63 +132,46 @@ class FeatureEngineer(BaseAgent):
         sys_prompt = self.load_prompt_template("feature_engineer_system.txt")
         user_prompt = self.load_prompt_template("feature_engineer_user.txt", context)
 
-        resp = self.llm.get_response(user_prompt, sys_prompt, json_response=False)
-        resp = resp.strip().strip("`").removeprefix("python")
+        resp = self.stream_script(user_prompt, sys_prompt, script_path)
+        resp = clean_script(resp)
         self.script = resp
         return resp
 
+    def execute(self, retry_count: int = 3) -> None:
+        """Generate the feature engineering script and run it, without loading its outputs.
+
+        Args:
+            retry_count: Number of fix attempts, separately on the sample and full data
+
+        """
+        logger.info("Engineering features")
+
+        # Outputs of an earlier run with the same inputs are reused
+        if self.restore_stage() is None:
+            # Generate and save script, unless a resumed run has one
+            script_path = self.resume_script or self.generate_script()
+            if not script_path.exists():
+                msg = f"data_processing.py not found in {self.script_dir}"
+                raise ValueError(msg)
+
+            self.run_script(script_path, retry_count)
+
+    def output_metadata(self) -> dict[str, dict]:
+        """Describe the output tables from their parquet metadata, without loading them.
+
+        Returns:
+            Dictionary of feature table metadata (shape, schema and null counts), see
+            :func:`~pond_agent.competition.utils.read_parquet_metadata`
+
+        """
+        return load_parquet_metadata(self.output_dir)
+
     def run(self, retry_count: int = 3) -> dict[str, pl.DataFrame]:
         """Engineer features by executing generated script.
 
         Returns:
-            Dictionary of processed DataFrames
+            Dictionary of feature DataFrames
 
         """
-        logger.info("Engineering features")
-
-        # Generate and save script
-        script_path = self.generate_script()
-        if not script_path.exists():
-            msg = f"data_processing.py not found in {self.script_dir}"
-            raise ValueError(msg)
-
-        # Execute script in subprocess
-        env = os.environ.copy()
-        env["PYTHONPATH"] = str(
-            Path(__file__).parent.parent.parent
-        )  # Add project root to PYTHONPATH
-
-        try:
-            returncode, stderr = run_python_script(script_path, env, logger)
-
-            while returncode != 0 and retry_count > 0:
-                msg = f"Error executing feature engineering script: {stderr}"
-                logger.error(msg)
-                logger.info("Attempting to fix bug, %d attempts remaining", retry_count)
-                with open(script_path) as script_file:
-                    script = script_file.read()
-                fixed_code = self.bug_fixer.fix_bug(script, stderr)
-                if fixed_code:
-                    with open(script_path, "w") as script_file:
-                        script_file.write(fixed_code)
-                    returncode, stderr = run_python_script(script_path, env, logger)
-                retry_count -= 1
-            
-            if returncode != 0:
-                msg = f"Cannot fix the bug: {stderr}"
-                logger.error(msg)
-                raise RuntimeError(msg) from None
-
-            logger.info("Successfully executed feature engineering script")
-
-            # Load processed datasets
-            return load_parquet_data(self.output_dir)
-
-        except subprocess.CalledProcessError as e:
-            msg = f"Error executing feature engineering script: {e.stderr}"
-            logger.error(msg)
-            raise RuntimeError(msg) from e
-
-        except RuntimeError as e:
-            logger.error(str(e))
-            raise
\ No newline at end of file
+        self.execute(retry_count)
+        return load_parquet_data(self.output_dir)
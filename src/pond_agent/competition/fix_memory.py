@@ -0,0 +1,245 @@
+"""Local memory of bug fixes, keyed by normalized error signatures."""
+
+import difflib
+import hashlib
+import json
+import keyword
+import logging
+import re
+import sqlite3
+import time
+from contextlib import closing
+from pathlib import Path
+from typing import Optional
+
+from ..llm import DEFAULT_CACHE_DIR
+from .patches import FRAME, LIBRARY_FILE, apply_edits
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FIX_MEMORY_PATH = DEFAULT_CACHE_DIR / "fix_memory.sqlite"
+# Fixes with more edits are too specific to the script to be reused
+MAX_EDITS = 8
+# Unchanged lines stored before and after each block of changed lines
+CONTEXT_LINES = 1
+# Non-whitespace characters a stored search text needs at least
+MIN_SEARCH_CHARS = 16
+# Library frames included in a signature, innermost last
+MAX_LIBRARY_FRAMES = 3
+
+_EXCEPTION = re.compile(
+    r"^(?P<type>[A-Za-z_][\w.]*(?:Error|Exception|Warning|Exit|Interrupt))"
+    r"(?::\s*(?P<message>.*))?$"
+)
+
+
+def _normalize_message(message: str) -> str:
+    """Remove the run-specific parts of an error message, keeping identifiers."""
+    message = re.sub(r"(?:[A-Za-z]:)?[/\\][^\s'\"]*", "<path>", message)
+    # Quoted identifiers such as column and attribute names are kept, other literals not
+    message = re.sub(
+        r"(['\"])(.*?)\1",
+        lambda m: m[0] if re.fullmatch(r"[\w.]+", m[2]) else "<str>",
+        message,
+    )
+    message = re.sub(r"\b\d+(?:\.\d+)?\b", "<n>", message)
+    return message.strip()[:200]
+
+
+def error_signature(error: str) -> Optional[str]:
+    """Normalize the last traceback of an error output into a signature.
+
+    The signature consists of the exception type, its message without paths, numbers
+    and literals, the calls on the failing line of the script and the innermost library
+    frames, so the same failure yields the same signature across scripts and runs.
+
+    Args:
+        error: Stderr of a failed run
+
+    Returns:
+        Signature, or None if the error contains no exception
+    """
+    lines = error.strip().splitlines()
+    exception = None
+    for index in range(len(lines) - 1, -1, -1):
+        match = _EXCEPTION.match(lines[index].strip())
+        if match:
+            exception = match
+            lines = lines[:index]
+            break
+    if exception is None:
+        return None
+
+    # Frames of the last traceback only, e.g. not of the exception it was raised from
+    start = max(
+        (i for i, line in enumerate(lines) if line.startswith("Traceback")), default=0
+    )
+    library_frames = []
+    failing_line = ""
+    for index in range(start, len(lines)):
+        match = FRAME.match(lines[index])
+        if not match:
+            continue
+        file = match["file"]
+        if LIBRARY_FILE.search(file):
+            module = re.split(r"(?:site|dist)-packages[/\\]|python\d[\d.]*[/\\]", file)[-1]
+            library_frames.append(f"{module}:{match['function'] or '<module>'}")
+        elif index + 1 < len(lines) and not FRAME.match(lines[index + 1]):
+            failing_line = lines[index + 1].strip()
+    calls = re.findall(r"\.?(\w+)\(", failing_line)
+    parts = [
+        exception["type"].rsplit(".", 1)[-1],
+        _normalize_message(exception["message"] or ""),
+        ",".join(calls),
+        ",".join(library_frames[-MAX_LIBRARY_FRAMES:]),
+    ]
+    return " | ".join(parts)
+
+
+def is_specific(search: str) -> bool:
+    """Whether a search text is distinctive enough to be replayed on other scripts.
+
+    Short texts and texts of only keywords and punctuation, e.g. ``)`` or ``else:``,
+    occur in most scripts, where replacing them would corrupt unrelated code.
+    """
+    names = [
+        name for name in re.findall(r"[A-Za-z_]\w*", search) if not keyword.iskeyword(name)
+    ]
+    return len("".join(search.split())) >= MIN_SEARCH_CHARS and bool(names)
+
+
+def make_edits(code: str, fixed_code: str) -> Optional[list[dict]]:
+    """Describe a fix as search/replace edits that can be applied to other scripts.
+
+    Each block of changed lines becomes an edit of whole lines, with
+    ``CONTEXT_LINES`` unchanged lines before and after it, so that it only applies to
+    scripts containing the same code.
+
+    Returns:
+        Edits, or None if the fix changes too much to be reused, or an edit is too
+        generic or does not match exactly once
+    """
+    old_lines = code.splitlines(keepends=True)
+    new_lines = fixed_code.splitlines(keepends=True)
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    edits = []
+    for group in matcher.get_grouped_opcodes(CONTEXT_LINES):
+        if all(tag == "equal" for tag, *_ in group):
+            continue
+        _, i1, _, j1, _ = group[0]
+        _, _, i2, _, j2 = group[-1]
+        edits.append({"search": "".join(old_lines[i1:i2]), "replace": "".join(new_lines[j1:j2])})
+    if not edits or len(edits) > MAX_EDITS:
+        return None
+    if not all(is_specific(edit["search"]) for edit in edits):
+        return None
+    # Replayed edits must match exactly once, see FixMemory.lookup
+    if apply_edits(code, edits, exact=True) != fixed_code:
+        return None
+    return edits
+
+
+class FixMemory:
+    """SQLite store of fixes that made failing scripts pass, keyed by error signature.
+
+    A fix is stored as search/replace edits, so it can be applied to other scripts that
+    fail with the same signature. Fixes are ranked by how often they worked.
+    """
+
+    def __init__(self, path: Optional[str | Path] = None) -> None:
+        """Initialize fix memory.
+
+        Args:
+            path: Path of the SQLite database (default: ~/.cache/pond_agent/fix_memory.sqlite)
+
+        """
+        self.path = Path(path or DEFAULT_FIX_MEMORY_PATH)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS fixes ("
+                "signature_hash TEXT, edits_hash TEXT, signature TEXT, edits TEXT, "
+                "successes INTEGER, failures INTEGER, created_at REAL, used_at REAL, "
+                "PRIMARY KEY (signature_hash, edits_hash))"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    @staticmethod
+    def _hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def lookup(self, code: str, error: str) -> list[tuple[str, str]]:
+        """Find stored fixes for the error that apply to the code.
+
+        Returns:
+            Identifiers and fixed code of the applicable fixes, the most successful first
+        """
+        signature = error_signature(error)
+        if signature is None:
+            return []
+        try:
+            with closing(self._connect()) as conn:
+                rows = conn.execute(
+                    "SELECT edits_hash, edits FROM fixes WHERE signature_hash = ? "
+                    "AND successes > failures ORDER BY successes - failures DESC",
+                    (self._hash(signature),),
+                ).fetchall()
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to read fix memory: {e!s}")
+            return []
+        fixes = []
+        for edits_hash, edits in rows:
+            edits = json.loads(edits)
+            # Also skips generic edits stored by earlier versions
+            if not all(is_specific(edit["search"]) for edit in edits):
+                continue
+            fixed_code = apply_edits(code, edits, exact=True)
+            if fixed_code is not None and fixed_code != code:
+                fixes.append((edits_hash, fixed_code))
+        return fixes
+
+    def record(self, error: str, code: str, fixed_code: str) -> None:
+        """Store a fix after which a failing script ran successfully."""
+        signature = error_signature(error)
+        edits = make_edits(code, fixed_code)
+        if signature is None or edits is None:
+            return
+        edits_json = json.dumps(edits)
+        now = time.time()
+        try:
+            with closing(self._connect()) as conn:
+                conn.execute(
+                    "INSERT INTO fixes VALUES (?, ?, ?, ?, 1, 0, ?, ?) "
+                    "ON CONFLICT (signature_hash, edits_hash) "
+                    "DO UPDATE SET successes = successes + 1, used_at = excluded.used_at",
+                    (
+                        self._hash(signature),
+                        self._hash(edits_json),
+                        signature,
+                        edits_json,
+                        now,
+                        now,
+                    ),
+                )
+        except sqlite3.Error as e:
+            # The memory must never break the pipeline
+            logger.warning(f"Failed to record fix: {e!s}")
+
+    def report(self, error: str, edits_hash: str, success: bool) -> None:
+        """Count whether a stored fix worked when it was reused."""
+        signature = error_signature(error)
+        if signature is None:
+            return
+        column = "successes" if success else "failures"
+        try:
+            with closing(self._connect()) as conn:
+                conn.execute(
+                    f"UPDATE fixes SET {column} = {column} + 1, used_at = ? "
+                    "WHERE signature_hash = ? AND edits_hash = ?",
+                    (time.time(), self._hash(signature), edits_hash),
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to update fix memory: {e!s}")
@@ -0,0 +1,203 @@
+"""Search/replace edits of scripts, and the traceback excerpts fixes are based on."""
+
+import ast
+import re
+from typing import Optional
+
+# Lines kept from the end of an error, which hold the exception and its innermost frames
+TRACEBACK_TAIL_LINES = 10
+# Lines kept of errors without a traceback
+MAX_ERROR_LINES = 40
+# Lines of code shown before and after each failing line
+WINDOW_LINES = 15
+
+FRAME = re.compile(r'^\s*File "(?P<file>[^"]+)", line (?P<line>\d+)(?:, in (?P<function>\S+))?')
+LIBRARY_FILE = re.compile(r"[/\\](?:site|dist)-packages[/\\]|[/\\]lib[/\\]python\d")
+_EDIT = re.compile(
+    r"^<{5,7} ?SEARCH[^\n]*\n(?P<search>.*?)^={5,7}[ \t]*\n(?P<replace>.*?)^>{5,7} ?REPLACE",
+    re.MULTILINE | re.DOTALL,
+)
+_PREFLIGHT_LINE = re.compile(r"^- line (\d+):", re.MULTILINE)
+
+
+def _is_user_frame(match: re.Match) -> bool:
+    file = match["file"]
+    return not LIBRARY_FILE.search(file) and not file.startswith("<")
+
+
+def trim_traceback(error: str, tail_lines: int = TRACEBACK_TAIL_LINES) -> str:
+    """Shorten an error to the parts needed to fix it.
+
+    Of the last traceback, the frames in the script and the last ``tail_lines`` lines
+    are kept, with the library frames in between and the output before the traceback
+    elided. Errors without a traceback keep their last lines.
+
+    Args:
+        error: Stderr of a failed run
+        tail_lines: Number of lines kept from the end
+
+    Returns:
+        Trimmed error
+    """
+    lines = error.rstrip().splitlines()
+    starts = [i for i, line in enumerate(lines) if line.startswith("Traceback")]
+    if not starts:
+        if len(lines) <= MAX_ERROR_LINES:
+            return "\n".join(lines)
+        return "\n".join(["...", *lines[-MAX_ERROR_LINES:]])
+
+    start = starts[-1]
+    kept = {start, *range(max(start, len(lines) - tail_lines), len(lines))}
+    for index in range(start, len(lines)):
+        match = FRAME.match(lines[index])
+        if match and _is_user_frame(match):
+            kept.add(index)
+            # The source line of the frame, without the position markers below it
+            if index + 1 < len(lines) and not FRAME.match(lines[index + 1]):
+                kept.add(index + 1)
+    trimmed = ["..."] if start > 0 else []
+    previous = None
+    for index in sorted(kept):
+        if previous is not None and index > previous + 1:
+            trimmed.append("  ...")
+        trimmed.append(lines[index])
+        previous = index
+    return "\n".join(trimmed)
+
+
+def failing_lines(error: str, line_count: int) -> list[int]:
+    """Line numbers of the script that an error points to.
+
+    These are the lines of the script's frames in the last traceback, or the lines
+    reported by the pre-flight check.
+
+    Args:
+        error: Stderr of a failed run
+        line_count: Number of lines of the script, larger line numbers are ignored
+
+    Returns:
+        Line numbers, in the order of the error
+    """
+    lines = error.rstrip().splitlines()
+    starts = [i for i, line in enumerate(lines) if line.startswith("Traceback")]
+    numbers = []
+    for line in lines[starts[-1] if starts else 0 :]:
+        match = FRAME.match(line)
+        if match and _is_user_frame(match):
+            numbers.append(int(match["line"]))
+    numbers.extend(int(number) for number in _PREFLIGHT_LINE.findall(error))
+    return [number for number in numbers if 0 < number <= line_count]
+
+
+def code_window(code: str, lines: list[int], context: int = WINDOW_LINES) -> str:
+    """Excerpt of a script around the given lines, together with its top-level imports.
+
+    Args:
+        code: Source of the script
+        lines: Line numbers to show
+        context: Number of lines shown before and after each line
+
+    Returns:
+        Numbered excerpts of the script, each in a code fence
+    """
+    source = code.splitlines()
+    ranges = [(max(1, line - context), min(len(source), line + context)) for line in lines]
+    try:
+        ranges.extend(
+            (node.lineno, node.end_lineno)
+            for node in ast.parse(code).body
+            if isinstance(node, (ast.Import, ast.ImportFrom))
+        )
+    except SyntaxError:
+        pass
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    parts = []
+    for first, last in merged:
+        excerpt = "\n".join(source[first - 1 : last])
+        parts.append(f"Lines {first}-{last} of {len(source)}:\n```python\n{excerpt}\n```")
+    return "\n\n".join(parts)
+
+
+def parse_edits(response: str) -> list[dict]:
+    """Parse search/replace blocks from an LLM response.
+
+    Returns:
+        Edits in the order of the response, empty if the response has none
+    """
+    return [
+        {"search": match["search"], "replace": match["replace"]}
+        for match in _EDIT.finditer(response)
+        if match["search"].strip()
+    ]
+
+
+def _locate(code: str, search: str, exact: bool = False) -> Optional[tuple[int, int]]:
+    """Span of the only occurrence of a search text in the code.
+
+    The model sees only excerpts of the script, so it cannot make sure that its search
+    text is unique. A text that also occurs elsewhere is ambiguous and not located.
+
+    Args:
+        code: Source of the script
+        search: Text to locate
+        exact: Match the text only as is, instead of also when lines differ in
+            trailing whitespace
+
+    Returns:
+        Start and end of the occurrence, or None if the text is missing or ambiguous
+    """
+    spans = []
+    start = code.find(search)
+    while start >= 0:
+        spans.append((start, start + len(search)))
+        start = code.find(search, start + len(search))
+    if not exact:
+        # Models often change trailing whitespace or drop the last newline of a block
+        lines = code.splitlines(keepends=True)
+        stripped = [line.rstrip() for line in lines]
+        wanted = [line.rstrip() for line in search.splitlines()]
+        offsets = [0]
+        for line in lines:
+            offsets.append(offsets[-1] + len(line))
+        for index in range(len(lines) - len(wanted) + 1):
+            if stripped[index : index + len(wanted)] == wanted and not any(
+                offsets[index] <= first < offsets[index + len(wanted)] for first, _ in spans
+            ):
+                spans.append((offsets[index], offsets[index + len(wanted)]))
+    return spans[0] if len(spans) == 1 else None
+
+
+def apply_edits(code: str, edits: list[dict], exact: bool = False) -> Optional[str]:
+    """Apply search/replace edits to a script.
+
+    Each search text has to occur exactly once in the script.
+
+    Args:
+        code: Source of the script
+        edits: Edits with the keys 'search' and 'replace'
+        exact: Match search texts only as is, instead of also when lines differ in
+            trailing whitespace
+
+    Returns:
+        Edited script, or None if an edit does not apply, matches more than once or the
+        result does not parse
+    """
+    for edit in edits:
+        search, replace = edit["search"], edit["replace"]
+        span = _locate(code, search, exact)
+        if span is None:
+            return None
+        start, end = span
+        if code[start:end].endswith("\n") and replace and not replace.endswith("\n"):
+            replace += "\n"
+        code = code[:start] + replace + code[end:]
+    try:
+        ast.parse(code)
+    except SyntaxError:
+        return None
+    return code
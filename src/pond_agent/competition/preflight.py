@@ -0,0 +1,195 @@
+"""Static checks of generated scripts, run before spending a process start on them."""
+
+import ast
+import builtins
+import importlib.util
+from pathlib import Path
+from typing import Optional
+
+# Calls whose first argument is a path that must exist, e.g. pd.read_csv or pl.scan_parquet
+READ_PREFIXES = ("read_", "scan_", "load")
+# Suffixes of string literals treated as file paths
+DATA_SUFFIXES = (".parquet", ".csv", ".tsv", ".json", ".feather", ".pkl", ".pickle", ".joblib")
+# Names defined in every module namespace
+MODULE_NAMES = {"__file__", "__name__", "__doc__", "__builtins__", "__spec__", "__loader__"}
+
+
+def _line(node: ast.AST) -> str:
+    return f"line {node.lineno}"
+
+
+def _guarded_imports(tree: ast.Module) -> set[ast.AST]:
+    """Import statements inside a try block that handles ImportError."""
+    guarded = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Try):
+            continue
+        handled = set()
+        for handler in node.handlers:
+            types = handler.type.elts if isinstance(handler.type, ast.Tuple) else [handler.type]
+            handled.update(
+                t.id if isinstance(t, ast.Name) else None for t in types if t is not None
+            )
+            if handler.type is None:
+                handled.add("Exception")
+        if handled & {"ImportError", "ModuleNotFoundError", "Exception", "BaseException"}:
+            for statement in node.body:
+                guarded.update(
+                    child
+                    for child in ast.walk(statement)
+                    if isinstance(child, (ast.Import, ast.ImportFrom))
+                )
+    return guarded
+
+
+def _check_imports(tree: ast.Module, script_dir: Optional[Path]) -> list[str]:
+    """Imports of modules that are not installed."""
+    guarded = _guarded_imports(tree)
+    problems = []
+    checked = set()
+    for node in ast.walk(tree):
+        if node in guarded:
+            continue
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and not node.level and node.module:
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            # Only the top-level package is looked up, which does not import anything
+            top = name.split(".")[0]
+            if top in checked or top == "__future__":
+                continue
+            checked.add(top)
+            if script_dir is not None and (
+                (script_dir / f"{top}.py").exists() or (script_dir / top).is_dir()
+            ):
+                continue
+            if importlib.util.find_spec(top) is None:
+                problems.append(
+                    f"{_line(node)}: module '{top}' is not installed, use an installed "
+                    "library instead"
+                )
+    return problems
+
+
+def _call_name(node: ast.Call) -> Optional[str]:
+    func = node.func
+    if isinstance(func, ast.Attribute):
+        return func.attr
+    if isinstance(func, ast.Name):
+        return func.id
+    return None
+
+
+def _check_paths(tree: ast.Module, data_paths: Optional[dict[str, str]]) -> list[str]:
+    """Literal paths that are read but do not exist."""
+    problems = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call) or not node.args:
+            continue
+        name = _call_name(node)
+        if name is None or not name.startswith(READ_PREFIXES):
+            continue
+        arg = node.args[0]
+        if not isinstance(arg, ast.Constant) or not isinstance(arg.value, str):
+            continue
+        path = arg.value
+        if not (Path(path).is_absolute() or path.endswith(DATA_SUFFIXES)):
+            continue
+        # Globs and URLs are resolved by the reader
+        if any(char in path for char in "*?[") or "://" in path:
+            continue
+        if not Path(path).exists():
+            known = f", the available data is at {data_paths}" if data_paths else ""
+            problems.append(
+                f"{_line(node)}: {name}() reads '{path}', which does not exist{known}"
+            )
+    return problems
+
+
+def _bound_names(tree: ast.Module) -> Optional[set[str]]:
+    """Names bound anywhere in a module, or None if it has a star import."""
+    bound = set(dir(builtins)) | MODULE_NAMES
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            bound.add(node.id)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                if alias.name == "*":
+                    return None
+                bound.add(alias.asname or alias.name.split(".")[0])
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            bound.add(node.name)
+        elif isinstance(node, ast.arg):
+            bound.add(node.arg)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            bound.add(node.name)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            bound.update(node.names)
+        elif isinstance(node, (ast.MatchAs, ast.MatchStar)) and node.name:
+            bound.add(node.name)
+        elif isinstance(node, ast.MatchMapping) and node.rest:
+            bound.add(node.rest)
+    return bound
+
+
+def _check_names(tree: ast.Module) -> list[str]:
+    """Names that are used but never bound anywhere in the script.
+
+    Scopes are ignored, so only names that cannot be defined at all are reported.
+    """
+    bound = _bound_names(tree)
+    if bound is None:
+        return []
+    problems = []
+    reported = set()
+    names = [node for node in ast.walk(tree) if isinstance(node, ast.Name)]
+    for node in sorted(names, key=lambda node: (node.lineno, node.col_offset)):
+        if (
+            isinstance(node.ctx, ast.Load)
+            and node.id not in bound
+            and node.id not in reported
+        ):
+            reported.add(node.id)
+            problems.append(f"{_line(node)}: name '{node.id}' is not defined")
+    return problems
+
+
+def validate_script(
+    code: str,
+    script_path: Optional[str | Path] = None,
+    data_paths: Optional[dict[str, str]] = None,
+) -> list[str]:
+    """Check a script for errors that would make it fail, without running it.
+
+    The script is parsed, its imports are looked up in the current environment, literal
+    paths passed to reading functions such as ``read_parquet`` are checked for existence,
+    and names that are used but never defined are flagged.
+
+    Args:
+        code: Source of the script
+        script_path: Path of the script, for error messages and local imports
+        data_paths: Known dataset paths, listed when a read path does not exist
+
+    Returns:
+        Descriptions of the problems found, empty if the script passes
+    """
+    filename = str(script_path) if script_path else "<script>"
+    try:
+        tree = ast.parse(code, filename)
+    except SyntaxError as e:
+        line = (e.text or "").rstrip()
+        return [f"line {e.lineno}: SyntaxError: {e.msg}" + (f"\n    {line}" if line else "")]
+
+    script_dir = Path(script_path).parent if script_path else None
+    problems = _check_imports(tree, script_dir) + _check_paths(tree, data_paths)
+    return problems + _check_names(tree)
+
+
+def format_problems(problems: list[str], script_path: Optional[str | Path] = None) -> str:
+    """Describe pre-flight problems like an error message of a failed run."""
+    name = Path(script_path).name if script_path else "The script"
+    lines = "\n".join(f"- {problem}" for problem in problems)
+    return f"{name} was not run because static checks found problems:\n{lines}\n"
@@ -0,0 +1,321 @@
+"""Streaming column statistics of parquet datasets, cached in a JSON sidecar."""
+
+import hashlib
+import json
+import logging
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, time, timedelta
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import polars as pl
+import pyarrow.dataset as ds
+
+from .utils import _is_hive_partitioned, _parquet_sources
+
+logger = logging.getLogger(__name__)
+
+SIDECAR_NAME = ".profile.json"
+# Bumped when the profile format changes, so that old sidecars are recomputed
+PROFILE_VERSION = 1
+QUANTILES = (0.01, 0.25, 0.5, 0.75, 0.99)
+
+
+class HyperLogLog:
+    """HyperLogLog sketch estimating the number of distinct values."""
+
+    def __init__(self, precision: int = 12) -> None:
+        """Initialize sketch with ``2**precision`` registers (about 1.6% error at 12)."""
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def add(self, series: pl.Series) -> None:
+        """Add the non-null values of a series."""
+        hashes = series.drop_nulls().hash(seed=0).to_numpy()
+        if not len(hashes):
+            return
+        p = np.uint64(self.precision)
+        index = (hashes >> (np.uint64(64) - p)).astype(np.int64)
+        # Rank of the first set bit in the remaining bits. The extra low bit bounds the
+        # rank for all-zero remainders.
+        rest = (hashes << p) | np.uint64(1 << (self.precision - 1))
+        rank = 64 - np.frexp(rest.astype(np.float64))[1] + 1
+        np.maximum.at(self.registers, index, rank.astype(np.uint8))
+
+    def estimate(self) -> int:
+        """Estimated number of distinct values."""
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small cardinalities
+            return round(m * math.log(m / zeros))
+        return round(raw)
+
+
+class QuantileSketch:
+    """Uniform sample of bounded size, from which quantiles are estimated.
+
+    Each value gets a random key and the values with the smallest keys are kept, which
+    yields a uniform sample of the whole stream regardless of chunking.
+    """
+
+    def __init__(self, size: int = 4096, seed: int = 0) -> None:
+        """Initialize sketch keeping at most ``size`` values."""
+        self.size = size
+        self.values = np.empty(0, dtype=np.float64)
+        self.keys = np.empty(0, dtype=np.float64)
+        self.random = np.random.default_rng(seed)
+
+    def add(self, series: pl.Series) -> None:
+        """Add the non-null, non-NaN values of a numeric series."""
+        values = series.drop_nulls().cast(pl.Float64).to_numpy()
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return
+        self.values = np.concatenate([self.values, values])
+        self.keys = np.concatenate([self.keys, self.random.random(len(values))])
+        if len(self.values) > self.size:
+            keep = np.argpartition(self.keys, self.size)[: self.size]
+            self.values = self.values[keep]
+            self.keys = self.keys[keep]
+
+    def quantiles(self, qs: tuple[float, ...] = QUANTILES) -> Optional[dict[str, float]]:
+        """Estimated quantiles, or None if no values were added."""
+        if not len(self.values):
+            return None
+        estimates = np.quantile(self.values, qs)
+        return {str(q): float(v) for q, v in zip(qs, estimates, strict=True)}
+
+
+class TopK:
+    """Approximate most frequent values.
+
+    Each chunk contributes the counts of its own most frequent values, and the merged
+    counts are pruned to ``capacity`` entries, so memory stays bounded.
+    """
+
+    def __init__(self, k: int = 10, capacity: int = 200) -> None:
+        """Initialize tracker reporting ``k`` values out of ``capacity`` candidates."""
+        self.k = k
+        self.capacity = capacity
+        self.counts = {}
+
+    def add(self, series: pl.Series) -> None:
+        """Add the non-null values of a series."""
+        counts = series.drop_nulls().value_counts(sort=True).head(self.capacity)
+        for value, count in counts.iter_rows():
+            self.counts[value] = self.counts.get(value, 0) + count
+        if len(self.counts) > self.capacity:
+            top = sorted(self.counts.items(), key=lambda item: -item[1])[: self.capacity]
+            self.counts = dict(top)
+
+    def top(self) -> list[list]:
+        """The ``k`` most frequent values with their counts."""
+        top = sorted(self.counts.items(), key=lambda item: -item[1])[: self.k]
+        return [[_to_json(value), count] for value, count in top]
+
+
+def _to_json(value):
+    """Convert a scalar to a JSON-serializable value."""
+    if value is None or isinstance(value, (bool, int, str)):
+        return value
+    if isinstance(value, float):
+        return None if math.isnan(value) or math.isinf(value) else value
+    if isinstance(value, (date, datetime, time)):
+        return value.isoformat()
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return str(value)
+
+
+class ColumnProfiler:
+    """Accumulate the statistics of one column over chunks."""
+
+    def __init__(self, dtype: pl.DataType) -> None:
+        """Initialize profiler of a column of type ``dtype``."""
+        self.dtype = dtype
+        self.nulls = 0
+        self.min = None
+        self.max = None
+        self.nested = dtype.is_nested()
+        self.numeric = dtype.is_numeric()
+        self.ordered = self.numeric or dtype.is_temporal()
+        self.distinct = None if self.nested else HyperLogLog()
+        self.sketch = QuantileSketch() if self.numeric else None
+        categorical = dtype in (pl.String, pl.Boolean, pl.Categorical, pl.Enum)
+        self.top_k = TopK() if categorical or dtype.is_integer() else None
+
+    def add(self, series: pl.Series) -> None:
+        """Add a chunk of the column."""
+        self.nulls += series.null_count()
+        if self.nested:
+            return
+        if self.ordered:
+            low, high = series.min(), series.max()
+            if low is not None:
+                self.min = low if self.min is None else min(self.min, low)
+                self.max = high if self.max is None else max(self.max, high)
+        self.distinct.add(series)
+        if self.sketch is not None:
+            self.sketch.add(series)
+        if self.top_k is not None:
+            self.top_k.add(series)
+
+    def result(self, rows: int) -> dict:
+        """Statistics of the column."""
+        stats = {"dtype": str(self.dtype), "null_count": self.nulls}
+        if self.nested:
+            return stats
+        distinct = min(self.distinct.estimate(), rows - self.nulls)
+        stats["distinct"] = distinct
+        if self.ordered:
+            stats["min"] = _to_json(self.min)
+            stats["max"] = _to_json(self.max)
+        if self.sketch is not None:
+            stats["quantiles"] = self.sketch.quantiles()
+        # Frequent values are only informative if values repeat often
+        if self.top_k is not None and distinct < 0.1 * max(rows - self.nulls, 1):
+            stats["top_values"] = self.top_k.top()
+        return stats
+
+
+def fingerprint(path: Path) -> str:
+    """Fingerprint of a parquet file or directory from file names, sizes and mtimes."""
+    files = sorted(path.rglob("*.parquet")) if path.is_dir() else [path]
+    digest = hashlib.sha1()
+    for file in files:
+        stat = file.stat()
+        name = file.relative_to(path.parent)
+        digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return digest.hexdigest()
+
+
+def profile_table(path: str | Path, batch_size: int = 65_536) -> dict:
+    """Compute column statistics of a parquet dataset in one streaming pass.
+
+    Args:
+        path: Parquet file or directory of parquet files, possibly hive-partitioned
+        batch_size: Rows per chunk, which bounds memory use
+
+    Returns:
+        Dictionary with the row count and per-column statistics: dtype, null count,
+        approximate distinct count, min/max, quantiles of numeric columns and the most
+        frequent values of low-cardinality columns
+
+    """
+    path = Path(path)
+    dataset = ds.dataset(
+        path, format="parquet", partitioning="hive" if _is_hive_partitioned(path) else None
+    )
+    rows = 0
+    profilers = None
+    for batch in dataset.to_batches(batch_size=batch_size):
+        chunk = pl.from_arrow(batch)
+        if profilers is None:
+            profilers = {name: ColumnProfiler(dtype) for name, dtype in chunk.schema.items()}
+        rows += chunk.height
+        for name, profiler in profilers.items():
+            profiler.add(chunk[name])
+    return {
+        "rows": rows,
+        "columns": {
+            name: profiler.result(rows) for name, profiler in (profilers or {}).items()
+        },
+    }
+
+
+def profile_dataset(
+    data_dir: str | Path, max_workers: Optional[int] = None
+) -> dict[str, dict]:
+    """Profile every parquet dataset in a directory, reusing cached profiles.
+
+    Profiles are stored in a ``.profile.json`` sidecar in the directory, keyed by dataset
+    name and fingerprint, so unchanged datasets are not read again.
+
+    Args:
+        data_dir: Directory containing parquet files
+        max_workers: Number of datasets profiled in parallel (default: up to 4)
+
+    Returns:
+        Dictionary mapping dataset names to their profiles, see :func:`profile_table`
+
+    """
+    data_dir = Path(data_dir)
+    sidecar_path = data_dir / SIDECAR_NAME
+    sidecar = {}
+    if sidecar_path.exists():
+        try:
+            sidecar = json.loads(sidecar_path.read_text())
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"Ignoring unreadable profile cache {sidecar_path}: {e!s}")
+    if sidecar.get("version") != PROFILE_VERSION:
+        sidecar = {"version": PROFILE_VERSION, "tables": {}}
+
+    sources = _parquet_sources(data_dir)
+    fingerprints = {name: fingerprint(path) for name, path in sources.items()}
+    cached = sidecar["tables"]
+    stale = [
+        name for name in sources
+        if cached.get(name, {}).get("fingerprint") != fingerprints[name]
+    ]
+    if stale:
+        logger.info(f"Profiling {len(stale)} datasets in {data_dir}")
+        workers = max_workers or min(4, len(stale))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            profiles = executor.map(lambda name: profile_table(sources[name]), stale)
+            for name, profile in zip(stale, profiles, strict=True):
+                cached[name] = {"fingerprint": fingerprints[name], "profile": profile}
+
+        # Drop datasets that no longer exist and write atomically
+        sidecar["tables"] = {name: cached[name] for name in sources}
+        tmp_path = sidecar_path.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            tmp_path.write_text(json.dumps(sidecar))
+            tmp_path.replace(sidecar_path)
+        except OSError as e:
+            logger.warning(f"Failed to write profile cache {sidecar_path}: {e!s}")
+
+    return {name: cached[name]["profile"] for name in sources}
+
+
+def _round(value, digits: int = 4):
+    """Round floats to ``digits`` significant digits."""
+    if isinstance(value, float) and value:
+        return round(value, digits - 1 - int(math.floor(math.log10(abs(value)))))
+    return value
+
+
+def summarize_profile(profile: dict, top_values: int = 5, max_chars: int = 40) -> dict:
+    """Condense a profile for use in prompts.
+
+    Args:
+        profile: Profile from :func:`profile_table`
+        top_values: Number of frequent values listed per column
+        max_chars: Maximum length of listed string values
+
+    Returns:
+        Dictionary mapping column names to their condensed statistics
+    """
+    summary = {}
+    for name, stats in profile["columns"].items():
+        column = {}
+        if "distinct" in stats:
+            column["distinct"] = stats["distinct"]
+        if stats.get("min") is not None:
+            column["min"] = _round(stats["min"])
+            column["max"] = _round(stats["max"])
+        if stats.get("quantiles"):
+            column["p01/p25/p50/p75/p99"] = [_round(v) for v in stats["quantiles"].values()]
+        if stats.get("top_values"):
+            column["top_values"] = [
+                [value[:max_chars] if isinstance(value, str) else value, count]
+                for value, count in stats["top_values"][:top_values]
+            ]
+        if column:
+            summary[name] = column
+    return summary
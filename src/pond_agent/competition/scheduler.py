@@ -0,0 +1,80 @@
+"""Concurrent execution of pipeline steps in the order of their dependencies."""
+
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+
+class TaskGraph:
+    """Directed acyclic graph of async steps, each started as soon as its dependencies end.
+
+    Steps that do not depend on each other overlap. Blocking work, such as running a
+    script, is wrapped with :func:`asyncio.to_thread` by the caller, so that it does not
+    block the event loop. Dependencies are added before the steps that need them, so the
+    graph cannot have cycles.
+    """
+
+    def __init__(self) -> None:
+        """Initialize an empty task graph."""
+        self.steps: dict[str, tuple[Callable[[], Awaitable[Any]], tuple[str, ...]]] = {}
+
+    def add(
+        self,
+        name: str,
+        step: Callable[[], Awaitable[Any]],
+        after: Iterable[str] = (),
+    ) -> None:
+        """Add a step to the graph.
+
+        Args:
+            name: Unique name of the step
+            step: Coroutine function, called without arguments
+            after: Names of the steps that must finish before this one starts
+
+        Raises:
+            ValueError: If the name is already taken or a dependency was not added yet
+        """
+        after = tuple(after)
+        if name in self.steps:
+            raise ValueError(f"Step {name} was already added")
+        unknown = [dependency for dependency in after if dependency not in self.steps]
+        if unknown:
+            raise ValueError(f"Dependencies {unknown} of step {name} were not added yet")
+        self.steps[name] = (step, after)
+
+    async def run(self) -> dict[str, Any]:
+        """Run every step, starting each one when its dependencies have finished.
+
+        Returns:
+            Results of the steps by name
+
+        Raises:
+            Exception: The exception of the first step that fails, after the steps still
+                pending or running were cancelled. Blocking work already running in a
+                thread is not interrupted, only no longer awaited.
+        """
+        tasks: dict[str, asyncio.Task] = {}
+
+        async def run_step(name: str) -> Any:
+            step, after = self.steps[name]
+            if after:
+                await asyncio.gather(*(tasks[dependency] for dependency in after))
+            start = time.perf_counter()
+            result = await step()
+            logger.debug(f"Step {name} finished in {time.perf_counter() - start:.2f}s")
+            return result
+
+        # Created in insertion order, so every dependency exists when a step awaits it
+        for name in self.steps:
+            tasks[name] = asyncio.create_task(run_step(name), name=name)
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+        return {name: task.result() for name, task in tasks.items()}
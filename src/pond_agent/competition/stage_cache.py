@@ -0,0 +1,272 @@
+"""Make-style cache of pipeline stage outputs, reused by later runs with the same inputs."""
+
+import hashlib
+import importlib.metadata
+import importlib.resources
+import json
+import logging
+import os
+import platform
+import shutil
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+
+from .dev_sample import rewrite_paths
+
+logger = logging.getLogger(__name__)
+
+# Bumped when the layout of cache entries changes
+CACHE_VERSION = 1
+# Entries kept per stage, the oldest are removed when a new one is stored
+MAX_ENTRIES_PER_STAGE = 5
+# Distributions whose versions are part of every key, skipped if not installed
+KEY_LIBRARIES = (
+    "numpy",
+    "pandas",
+    "polars",
+    "pyarrow",
+    "scikit-learn",
+    "xgboost",
+    "lightgbm",
+    "catboost",
+    "torch",
+)
+# Stands in for the run directory in cached scripts
+RUN_DIR_PLACEHOLDER = "<run_dir>"
+
+
+def library_versions() -> dict[str, str]:
+    """Versions of Python and of the installed libraries that scripts typically use."""
+    versions = {"python": platform.python_version()}
+    for name in KEY_LIBRARIES:
+        try:
+            versions[name] = importlib.metadata.version(name)
+        except importlib.metadata.PackageNotFoundError:
+            continue
+    return versions
+
+
+def prompts_fingerprint() -> str:
+    """Fingerprint of the prompt templates, which determine the generated scripts."""
+    digest = hashlib.sha256()
+    prompts = importlib.resources.files("pond_agent.competition.prompts")
+    for template in sorted(prompts.iterdir(), key=lambda item: item.name):
+        if template.name.endswith(".txt"):
+            digest.update(template.name.encode() + b"\0" + template.read_bytes())
+    return digest.hexdigest()
+
+
+def data_fingerprint(data_dir: str | Path) -> str:
+    """Fingerprint of the files in a directory from their names, sizes and mtimes.
+
+    Hidden files, such as the profile sidecar, and hidden directories are ignored.
+    """
+    data_dir = Path(data_dir)
+    digest = hashlib.sha256()
+    for path in sorted(data_dir.rglob("*")):
+        name = path.relative_to(data_dir)
+        if not path.is_file() or any(part.startswith(".") for part in name.parts):
+            continue
+        stat = path.stat()
+        digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return digest.hexdigest()
+
+
+def _link_or_copy(source: str, target: str) -> None:
+    """Hard link a file, copying it if the target is on another file system."""
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def _link_tree(source: Path, target: Path) -> None:
+    """Link a file or the files of a directory to a target path."""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    if source.is_dir():
+        shutil.copytree(
+            source,
+            target,
+            copy_function=_link_or_copy,
+            ignore=shutil.ignore_patterns(".*"),
+            dirs_exist_ok=True,
+        )
+    else:
+        _link_or_copy(str(source), str(target))
+
+
+class StageCache:
+    """Outputs and final scripts of pipeline stages, keyed by fingerprints of their inputs.
+
+    A stage's key covers the outputs it reads, as the key of the stage before it plus
+    the identity of that stage's build, or the raw data fingerprint for the first stage.
+    It also covers the task description, the prompt templates, the model and the
+    library versions. When a key is found, the stage's outputs are hard linked into
+    the run directory instead of generating and running its script, and every stage
+    after a stage that was rebuilt is rebuilt too.
+
+    Cached files are shared with the runs through hard links, so they must not be
+    modified in place.
+    """
+
+    def __init__(self, cache_dir: str | Path, run_dir: str | Path) -> None:
+        """Initialize stage cache.
+
+        Args:
+            cache_dir: Directory of the cache entries. Hard links need it on the same
+                file system as the run directory, otherwise outputs are copied
+            run_dir: Output directory of the current run
+
+        """
+        self.cache_dir = Path(cache_dir)
+        self.run_dir = Path(run_dir).resolve()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def key(self, stage: str, upstream: str, context: dict) -> str:
+        """Fingerprint of a stage's inputs.
+
+        Args:
+            stage: Name of the stage
+            upstream: Build ID of the previous stage, or the raw data fingerprint
+            context: Other inputs of the stage, e.g. its task description, serialized
+                as JSON
+
+        Returns:
+            Key of the stage
+        """
+        fields = {
+            "version": CACHE_VERSION,
+            "stage": stage,
+            "upstream": upstream,
+            "context": context,
+            "prompts": prompts_fingerprint(),
+            "libraries": library_versions(),
+        }
+        text = json.dumps(fields, sort_keys=True, default=str)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def _entry(self, key: str) -> Path:
+        return self.cache_dir / key
+
+    def restore(
+        self,
+        key: str,
+        outputs: list[Path],
+        script_path: Path,
+        sample_dir: Optional[Path] = None,
+    ) -> Optional[dict]:
+        """Link the cached outputs of a stage into the run directory.
+
+        Args:
+            key: Key of the stage
+            outputs: Output files and directories of the stage, in the run directory
+            script_path: Path the stage's cached script is written to
+            sample_dir: Directory of the active development sample, whose outputs are
+                restored too if they were cached
+
+        Returns:
+            Metadata of the entry, with its build ID and whether the sample outputs were
+            restored, or None if the stage is not cached
+        """
+        entry = self._entry(key)
+        try:
+            meta = json.loads((entry / "meta.json").read_text())
+        except (OSError, ValueError):
+            return None
+        sample_restored = sample_dir is not None and meta.get("sample", False)
+        try:
+            for output in outputs:
+                relative = self._relative(output)
+                targets = [(entry / "outputs" / relative, output)]
+                if sample_restored and (entry / "sample" / relative).exists():
+                    targets.append((entry / "sample" / relative, sample_dir / relative))
+                for cached, target in targets:
+                    if target.is_dir() and not target.is_symlink():
+                        shutil.rmtree(target)
+                    elif target.exists():
+                        target.unlink()
+                    _link_tree(cached, target)
+            script = (entry / "script.py").read_text()
+            script_path.write_text(
+                rewrite_paths(script, {RUN_DIR_PLACEHOLDER: str(self.run_dir)})
+            )
+        except OSError as e:
+            logger.warning(f"Failed to restore cached stage {meta.get('stage')}: {e!s}")
+            return None
+        # Touched, so that recently used entries survive pruning
+        os.utime(entry / "meta.json")
+        return {**meta, "sample_restored": sample_restored}
+
+    def store(
+        self,
+        key: str,
+        stage: str,
+        outputs: list[Path],
+        script_path: Path,
+        sample_dir: Optional[Path] = None,
+    ) -> Optional[dict]:
+        """Cache the outputs and final script of a stage that ran successfully.
+
+        Args:
+            key: Key of the stage
+            stage: Name of the stage
+            outputs: Output files and directories of the stage, in the run directory
+            script_path: Path of the stage's script
+            sample_dir: Directory of the active development sample, whose outputs of
+                the stage are cached too
+
+        Returns:
+            Metadata of the new entry, with its build ID, or None if it was not stored
+        """
+        entry = self._entry(key)
+        tmp_entry = self.cache_dir / f".{key}.{os.getpid()}.tmp"
+        meta = {
+            "stage": stage,
+            "key": key,
+            "build_id": uuid.uuid4().hex,
+            "script_sha256": hashlib.sha256(script_path.read_bytes()).hexdigest(),
+            # Whether the outputs on the development sample are cached too
+            "sample": False,
+            "created_at": time.time(),
+        }
+        try:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            for output in outputs:
+                relative = self._relative(output)
+                _link_tree(output, tmp_entry / "outputs" / relative)
+                if sample_dir is not None and (sample_dir / relative).exists():
+                    _link_tree(sample_dir / relative, tmp_entry / "sample" / relative)
+                    meta["sample"] = True
+            script = script_path.read_text()
+            (tmp_entry / "script.py").write_text(
+                rewrite_paths(script, {str(self.run_dir): RUN_DIR_PLACEHOLDER})
+            )
+            # Written last, an entry without it is incomplete
+            (tmp_entry / "meta.json").write_text(json.dumps(meta))
+            shutil.rmtree(entry, ignore_errors=True)
+            tmp_entry.rename(entry)
+        except OSError as e:
+            logger.warning(f"Failed to cache stage {stage}: {e!s}")
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            return None
+        self._prune(stage)
+        return meta
+
+    def _relative(self, path: Path) -> Path:
+        """Path of an output relative to the run directory."""
+        return Path(path).resolve().relative_to(self.run_dir)
+
+    def _prune(self, stage: str) -> None:
+        """Remove the least recently used entries of a stage beyond the kept number."""
+        entries = []
+        for meta_path in self.cache_dir.glob("*/meta.json"):
+            try:
+                meta = json.loads(meta_path.read_text())
+            except (OSError, ValueError):
+                continue
+            if meta.get("stage") == stage:
+                entries.append((meta_path.stat().st_mtime, meta_path.parent))
+        for _, entry in sorted(entries, reverse=True)[MAX_ENTRIES_PER_STAGE:]:
+            shutil.rmtree(entry, ignore_errors=True)
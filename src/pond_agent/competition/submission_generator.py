@@ -1,18 +1,17 @@
 """Submission generation module with LLM-powered recommendations."""
 
 import logging
-import os
-import subprocess
 from pathlib import Path
+from typing import Optional
 
 import polars as pl
 import pandas as pd
 
-from ..llm import LLMClient
-from ..tools import run_python_script
+from ..llm import LLMClient, estimate_tokens
 from .base import BaseAgent
+from .budget import DEFAULT_MAX_PROMPT_TOKENS, TokenBudgeter
 from .bug_fixer import BugFixer
-from .utils import load_parquet_data
+from .utils import clean_script, load_parquet_metadata
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +19,10 @@ logger = logging.getLogger(__name__)
 class SubmissionGenerator(BaseAgent):
     """Submission generation component."""
 
+    script_description = "submission generation"
+    script_name = "generate_submission.py"
+    prompt_templates = ("submission_generator_system.txt", "submission_generator_user.txt")
+
     def __init__(
         self,
         llm_client: LLMClient,
@@ -28,6 +31,7 @@ class SubmissionGenerator(BaseAgent):
         script_dir: Path,
         task_description: dict,
         data_dictionary: dict,
+        max_prompt_tokens: int = DEFAULT_MAX_PROMPT_TOKENS,
     ) -> None:
         """Initialize submission generator.
 
@@ -37,6 +41,8 @@ class SubmissionGenerator(BaseAgent):
             output_dir: Directory to save processed data
             task_description: Task description
             data_dictionary: Optional data dictionary
+            max_prompt_tokens: Token budget of the prompt, which large dataset info and
+                code are compacted to fit
 
         """
         super().__init__()
@@ -48,6 +54,14 @@ class SubmissionGenerator(BaseAgent):
         self.data_dictionary = data_dictionary
         self.script = None
         self.bug_fixer = BugFixer(llm_client)
+        self.budgeter = TokenBudgeter(max_prompt_tokens, llm_client.model_name)
+        # Metadata and paths of the raw data, loaded ahead by prefetch_context
+        self.raw_metadata = None
+
+    def prefetch_context(self) -> None:
+        """Also read the metadata of the raw data, which is ready before the stage."""
+        super().prefetch_context()
+        self.raw_metadata = load_parquet_metadata(self.raw_data_dir, return_path=True)
 
     def generate_script(self) -> str:
         """Generate submission script.
@@ -58,14 +72,18 @@ class SubmissionGenerator(BaseAgent):
         """
         logger.info("Generating submission script")
 
-        # Load raw data to get schema
-        raw_data, data_paths = load_parquet_data(self.raw_data_dir, return_path=True)
+        # Read schema from the parquet metadata, without loading the data
+        raw_data, data_paths = self.raw_metadata or load_parquet_metadata(
+            self.raw_data_dir, return_path=True
+        )
+        # Known to the pre-flight check of the script
+        self.data_paths = data_paths
 
-        # Get submission script
-        script = self._get_script_from_llm(raw_data, data_paths)
+        # Get submission script, streamed to disk as it is generated
+        script_path = self.script_dir / self.script_name
+        script = self._get_script_from_llm(raw_data, data_paths, script_path)
 
-        # Save script
-        script_path = self.script_dir / "generate_submission.py"
+        # Save cleaned script
         with open(script_path, "w") as f:  # noqa: PTH123
             f.write(script)
             logger.info("Saved submission script to %s", script_path)
@@ -74,25 +92,27 @@ class SubmissionGenerator(BaseAgent):
 
     def _get_script_from_llm(
         self,
-        raw_data: dict[str, pl.DataFrame],
+        raw_data: dict[str, dict],
         data_paths: dict[str, str],
+        script_path: Optional[Path] = None,
     ) -> str:
         """Get submission script from LLM.
 
         Args:
-            raw_data: Dictionary of raw DataFrames
+            raw_data: Dictionary of raw table metadata
             data_paths: Dictionary of data paths
+            script_path: Optional path the script is streamed to while generated
         Returns:
             String containing submission script
 
         """
         # Prepare dataset info for LLM
         dataset_info = []
-        for name, df in raw_data.items():
+        for name, meta in raw_data.items():
             info = {
                 "name": name,
                 "column_dtypes": {
-                    str(col): str(dtype) for col, dtype in df.schema.items()
+                    str(col): str(dtype) for col, dtype in meta["schema"].items()
                 },
             }
             dataset_info.append(info)
@@ -117,8 +137,16 @@ class SubmissionGenerator(BaseAgent):
             "submission_generator_user.txt", context
         )
 
-        resp = self.llm.get_response(user_prompt, sys_prompt, json_response=False)
-        resp = resp.strip().strip("`").removeprefix("python")
+        # The submission script reuses most of the feature engineering and training code,
+        # so the response is long and the large prompt is resent by continuations
+        resp = self.stream_script(
+            user_prompt,
+            sys_prompt,
+            script_path,
+            expected_tokens=estimate_tokens(fe_code + train_code),
+            cache_prompt=True,
+        )
+        resp = clean_script(resp)
         self.script = resp
         return resp
 
@@ -131,49 +159,30 @@ class SubmissionGenerator(BaseAgent):
         """
         logger.info("Generating submission")
 
-        # Generate and save script
-        script_path = self.generate_script()
-        if not script_path.exists():
-            msg = f"Submission generation script not found in {self.script_dir}"
-            raise ValueError(msg)
+        # Outputs of an earlier run with the same inputs are reused
+        if self.restore_stage() is None:
+            # Generate and save script, unless a resumed run has one
+            script_path = self.resume_script or self.generate_script()
+            if not script_path.exists():
+                msg = f"Submission generation script not found in {self.script_dir}"
+                raise ValueError(msg)
+
+            self.run_script(script_path, retry_count)
+
+        # Load processed datasets
+        return pd.read_csv(self.output_dir / "submission.csv")
 
-        # Execute script in subprocess
-        env = os.environ.copy()
-        env["PYTHONPATH"] = str(
-            Path(__file__).parent.parent.parent
-        )  # Add project root to PYTHONPATH
+    def stage_outputs(self) -> list[Path]:
+        """The submission file, as the output directory is the run directory."""
+        return [self.output_dir / "submission.csv"]
 
+    def _check_outputs(self, output_dir: Path) -> Optional[str]:
+        """Check that the script wrote a readable, non-empty submission file."""
+        submission = output_dir / "submission.csv"
+        if not submission.exists():
+            return f"The script did not write {submission}"
         try:
-            returncode, stderr = run_python_script(script_path, env, logger)
-
-            while returncode != 0 and retry_count > 0:
-                msg = f"Error executing submission generation script: {stderr}"
-                logger.error(msg)
-                logger.info("Attempting to fix bug, %d attempts remaining", retry_count)
-                with open(script_path) as script_file:
-                    script = script_file.read()
-                fixed_code = self.bug_fixer.fix_bug(script, stderr)
-                if fixed_code:
-                    with open(script_path, "w") as script_file:
-                        script_file.write(fixed_code)
-                    returncode, stderr = run_python_script(script_path, env, logger)
-                retry_count -= 1
-            
-            if returncode != 0:
-                msg = f"Cannot fix the bug: {stderr}"
-                logger.error(msg)
-                raise RuntimeError(msg) from None
-
-            logger.info("Successfully executed submission generation script")
-
-            # Load processed datasets
-            return pd.read_csv(self.output_dir / "submission.csv")
-
-        except subprocess.CalledProcessError as e:
-            msg = f"Error executing submission generation script: {e.stderr}"
-            logger.error(msg)
-            raise RuntimeError(msg) from e
-
-        except RuntimeError as e:
-            logger.error(str(e))
-            raise
\ No newline at end of file
+            rows = len(pd.read_csv(submission))
+        except Exception as e:
+            return f"{submission} cannot be read: {e!s}"
+        return None if rows else f"{submission} has no rows"
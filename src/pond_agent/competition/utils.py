@@ -1,13 +1,25 @@
 """Utility functions for data loading and processing."""
 
 import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Optional
 
 import pandas as pd
 import polars as pl
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 
 logger = logging.getLogger(__name__)
 
+# Directory name of a hive partition, e.g. "year=2024"
+HIVE_PARTITION = re.compile(r"^[^=]+=[^=]*$")
+# Fenced code block of a markdown response, possibly unterminated
+CODE_FENCE = re.compile(
+    r"```[ \t]*([\w+-]*)[^\n]*\n(.*?)(?:^[ \t]*```|\Z)", re.DOTALL | re.MULTILINE
+)
+
 def read_markdown(file_path: str | Path) -> str:
     """Read markdown file content.
 
@@ -22,6 +34,25 @@ def read_markdown(file_path: str | Path) -> str:
         return f.read()
 
 
+def clean_script(response: str) -> str:
+    """Extract the code of a script from an LLM response.
+
+    Handles responses that are plain code, a fenced code block, or code blocks
+    surrounded by explanations, in which case the longest Python block is used.
+    """
+    response = response.strip()
+    if "```" not in response:
+        return response
+    python_blocks = [
+        code
+        for language, code in CODE_FENCE.findall(response)
+        if language.lower() in ("", "python", "py", "python3")
+    ]
+    if not python_blocks:
+        return response.strip("`").removeprefix("python").strip()
+    return max(python_blocks, key=len).strip("\n")
+
+
 def read_data_dictionary(file_path: str | Path) -> dict[str, dict]:
     """Read data dictionary from Excel file.
 
@@ -133,43 +164,209 @@ def read_data_dictionary(file_path: str | Path) -> dict[str, dict]:
         raise
 
 
-def load_parquet_data(data_dir: str | Path, return_path: bool = False) -> dict[str, pl.DataFrame]:
+def _parquet_sources(data_dir: Path) -> dict[str, Path]:
+    """Find parquet datasets in a directory, as single files or directories of files."""
+    sources = {}
+    for item in data_dir.iterdir():
+        if item.is_file() and item.suffix == ".parquet":
+            sources[item.stem.upper()] = item
+        elif item.is_dir() and any(f.suffix == ".parquet" for f in item.rglob("*.parquet")):
+            sources[item.name.upper()] = item
+    return sources
+
+
+def _is_hive_partitioned(path: Path) -> bool:
+    """Check whether a directory is partitioned into ``key=value`` subdirectories."""
+    return path.is_dir() and any(
+        item.is_dir() and HIVE_PARTITION.match(item.name) for item in path.iterdir()
+    )
+
+
+def scan_parquet_dataset(
+    path: str | Path,
+    columns: Optional[list[str]] = None,
+    predicate: Optional[pl.Expr] = None,
+) -> pl.LazyFrame:
+    """Lazily scan a parquet file or directory of parquet files.
+
+    Directories partitioned into ``key=value`` subdirectories are read with hive
+    partitioning, so the partition keys become columns and filters on them skip whole
+    partitions. Other directories, such as the scraper's ``*_0_0_0.snappy.parquet``
+    parts, are read as one table.
+
+    Args:
+        path: Parquet file or directory
+        columns: Columns to read (default: all), pushed down to the scan
+        predicate: Row filter, pushed down to the scan
+
+    Returns:
+        LazyFrame of the dataset
+    """
+    path = Path(path)
+    source = path
+    hive = _is_hive_partitioned(path)
+    if path.is_dir() and not hive:
+        source = path / "**" / "*.parquet"
+    lf = pl.scan_parquet(source, hive_partitioning=hive)
+    if columns is not None:
+        lf = lf.select(columns)
+    if predicate is not None:
+        lf = lf.filter(predicate)
+    return lf
+
+
+def load_parquet_data(
+    data_dir: str | Path,
+    return_path: bool = False,
+    lazy: bool = False,
+    columns: Optional[dict[str, list[str]]] = None,
+    predicates: Optional[dict[str, pl.Expr]] = None,
+    max_workers: Optional[int] = None,
+) -> dict[str, pl.DataFrame] | dict[str, pl.LazyFrame]:
     """Load all parquet files from a directory.
 
+    Tables are opened, and in eager mode read, in parallel threads.
+
     Args:
         data_dir: Directory containing parquet files
+        return_path: Also return the path of each dataset
+        lazy: Return LazyFrames instead of reading the data
+        columns: Columns to read per dataset name (default: all)
+        predicates: Row filter per dataset name, pushed down to the scan
+        max_workers: Number of threads (default: one per dataset, up to 8)
 
     Returns:
-        Dictionary mapping dataset names to DataFrames
+        Dictionary mapping dataset names to DataFrames, or LazyFrames if ``lazy``
 
     """
     data_dir = Path(data_dir)
+    sources = _parquet_sources(data_dir)
+    columns = columns or {}
+    predicates = predicates or {}
+
+    def load(name: str) -> pl.DataFrame | pl.LazyFrame:
+        lf = scan_parquet_dataset(sources[name], columns.get(name), predicates.get(name))
+        if lazy:
+            # Read the footers now, so that missing or corrupt files fail here
+            lf.collect_schema()
+            return lf
+        return lf.collect()
+
     datasets = {}
-    data_paths = {}
+    if sources:
+        workers = max_workers or min(8, len(sources))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            datasets = dict(zip(sources, executor.map(load, sources), strict=True))
+    data_paths = {name: str(path.resolve()) for name, path in sources.items()}
 
-    # Process all items in the directory
-    for item in data_dir.iterdir():
-        if item.is_file() and item.suffix == ".parquet":
-            # Single parquet file
-            name = item.stem.upper()
-            datasets[name] = pl.read_parquet(item)
-            data_paths[name] = str(item.resolve())
-        elif item.is_dir():
-            # Directory of parquet files
-            if any(f.suffix == ".parquet" for f in item.iterdir()):
-                name = item.name.upper()
-                datasets[name] = pl.read_parquet(item)
-                data_paths[name] = str(item.resolve())
-
-    logger.info(f"Loaded {len(datasets)} datasets from {data_dir}")
-    for name, df in datasets.items():
-        logger.info(f"  - {name}: shape={df.shape}")
+    logger.info(f"{'Opened' if lazy else 'Loaded'} {len(datasets)} datasets from {data_dir}")
+    if not lazy:
+        for name, df in datasets.items():
+            logger.info(f"  - {name}: shape={df.shape}")
 
     if return_path:
         return datasets, data_paths
 
     return datasets
 
+
+def read_parquet_metadata(path: str | Path) -> dict:
+    """Read the shape, schema and null counts of a parquet dataset without loading it.
+
+    Row counts and null counts come from the parquet footers and row group statistics.
+    Null counts of columns without statistics are computed with a batched scan of just
+    those columns.
+
+    Args:
+        path: Parquet file or directory of parquet files, possibly hive-partitioned
+
+    Returns:
+        Dictionary with the dataset's ``shape``, ``schema`` (column name to polars dtype)
+        and ``null_counts`` (column name to number of nulls)
+
+    """
+    path = Path(path)
+    files = sorted(path.rglob("*.parquet")) if path.is_dir() else [path]
+    schema = dict(scan_parquet_dataset(path).collect_schema())
+
+    num_rows = 0
+    null_counts = dict.fromkeys(schema, 0)
+    # Columns whose null counts are known from the statistics of every row group
+    known = set(schema)
+    for file in files:
+        metadata = pq.ParquetFile(file).metadata
+        num_rows += metadata.num_rows
+        flat_columns = set()
+        for i in range(metadata.num_row_groups):
+            row_group = metadata.row_group(i)
+            for j in range(row_group.num_columns):
+                column = row_group.column(j)
+                name = column.path_in_schema
+                if name not in null_counts:
+                    # Leaf of a nested column, which has no top-level null count
+                    continue
+                flat_columns.add(name)
+                stats = column.statistics
+                if stats is None or not stats.has_null_count:
+                    known.discard(name)
+                else:
+                    null_counts[name] += stats.null_count
+        if metadata.num_row_groups:
+            known &= flat_columns
+
+    # Nested columns, hive partition keys and columns without statistics are counted
+    missing = [name for name in schema if name not in known]
+    if missing and num_rows:
+        logger.debug(f"Computing null counts of {len(missing)} columns in {path}")
+        # Counted batch by batch with pyarrow, which bounds memory use on every polars
+        # version the package supports
+        if _is_hive_partitioned(path):
+            dataset = ds.dataset(path, format="parquet", partitioning="hive")
+        else:
+            dataset = ds.dataset([str(file) for file in files], format="parquet")
+        null_counts.update(dict.fromkeys(missing, 0))
+        for batch in dataset.to_batches(columns=missing):
+            for name in missing:
+                null_counts[name] += batch.column(name).null_count
+
+    return {
+        "shape": (num_rows, len(schema)),
+        "schema": schema,
+        "null_counts": null_counts,
+    }
+
+
+def load_parquet_metadata(
+    data_dir: str | Path, return_path: bool = False
+) -> dict[str, dict]:
+    """Discover the parquet datasets in a directory from their metadata only.
+
+    Unlike :func:`load_parquet_data`, no data is loaded, see :func:`read_parquet_metadata`.
+
+    Args:
+        data_dir: Directory containing parquet files
+
+    Returns:
+        Dictionary mapping dataset names to their shape, schema and null counts
+
+    """
+    data_dir = Path(data_dir)
+    metadata = {}
+    data_paths = {}
+    for name, path in _parquet_sources(data_dir).items():
+        metadata[name] = read_parquet_metadata(path)
+        data_paths[name] = str(path.resolve())
+
+    logger.info(f"Found {len(metadata)} datasets in {data_dir}")
+    for name, meta in metadata.items():
+        logger.info(f"  - {name}: shape={meta['shape']}")
+
+    if return_path:
+        return metadata, data_paths
+
+    return metadata
+
+
 def read_problem_description(overview_path: str | Path) -> str:
     """Load problem description from overview.md file.
 
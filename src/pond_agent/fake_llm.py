@@ -0,0 +1,268 @@
+"""Offline LLM provider serving canned responses with simulated latency."""
+
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from string import Template
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+FIXTURE_SUFFIXES = {".txt", ".md", ".py", ".json"}
+DEFAULT_SCRIPT = "```python\nprint('Hello from the fake LLM')\n```"
+
+
+class FakeAPIError(Exception):
+    """Simulated API error, classified like the SDK errors with the same status code."""
+
+    def __init__(self, message: str, status_code: int, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        headers = {"retry-after": f"{retry_after:.3f}"} if retry_after is not None else {}
+        # Mimics the SDK errors, whose response headers carry the Retry-After delay
+        self.response = type("FakeResponse", (), {"headers": headers})()
+
+
+class LatencyModel:
+    """Latency, throughput and failure model of a simulated provider.
+
+    The time to first token follows a log-normal distribution plus the prompt prefill
+    time, after which tokens are generated at a normally distributed rate.
+    """
+
+    def __init__(
+        self,
+        ttft_median: float = 0.5,
+        ttft_sigma: float = 0.5,
+        prefill_tokens_per_second: float = 5000.0,
+        tokens_per_second: float = 60.0,
+        tokens_per_second_std: float = 10.0,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        requests_per_minute: Optional[int] = None,
+        retry_after: float = 1.0,
+        seed: Optional[int] = None,
+    ) -> None:
+        """Initialize latency model.
+
+        Args:
+            ttft_median: Median time to first token in seconds, excluding prefill
+            ttft_sigma: Log-normal shape of the time to first token (0 for a fixed value)
+            prefill_tokens_per_second: Prompt processing speed
+            tokens_per_second: Mean generation speed
+            tokens_per_second_std: Standard deviation of the generation speed
+            error_rate: Probability that a request fails with a server error (503)
+            rate_limit_rate: Probability that a request is rejected with a rate limit
+                error (429), on top of the ``requests_per_minute`` limit
+            requests_per_minute: Optional request limit enforced over a sliding window
+            retry_after: Retry-After delay of random rate limit errors in seconds
+            seed: Seed of the random number generator
+
+        """
+        self.ttft_median = ttft_median
+        self.ttft_sigma = ttft_sigma
+        self.prefill_tokens_per_second = prefill_tokens_per_second
+        self.tokens_per_second = tokens_per_second
+        self.tokens_per_second_std = tokens_per_second_std
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.requests_per_minute = requests_per_minute
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self._requests = deque()
+        self._lock = threading.Lock()
+
+    def time_to_first_token(self, prompt_tokens: int) -> float:
+        """Sample the time to first token of a request."""
+        with self._lock:
+            ttft = self.ttft_median * math.exp(self.random.gauss(0, self.ttft_sigma))
+        return ttft + prompt_tokens / self.prefill_tokens_per_second
+
+    def token_interval(self) -> float:
+        """Sample the time per generated token of a request."""
+        with self._lock:
+            rate = self.random.gauss(self.tokens_per_second, self.tokens_per_second_std)
+        return 1 / max(rate, 1.0)
+
+    def failure(self) -> Optional[FakeAPIError]:
+        """Return the error a new request fails with, or None if it is accepted."""
+        now = time.monotonic()
+        with self._lock:
+            if self.requests_per_minute is not None:
+                while self._requests and now - self._requests[0] >= 60:
+                    self._requests.popleft()
+                if len(self._requests) >= self.requests_per_minute:
+                    return FakeAPIError(
+                        "Rate limit reached for requests per minute",
+                        429,
+                        retry_after=60 - (now - self._requests[0]),
+                    )
+            draw = self.random.random()
+            if draw < self.rate_limit_rate:
+                return FakeAPIError("Rate limit reached", 429, retry_after=self.retry_after)
+            if draw < self.rate_limit_rate + self.error_rate:
+                return FakeAPIError("Service unavailable", 503)
+            self._requests.append(now)
+        return None
+
+
+class FakeLLM:
+    """Offline stand-in for the provider SDKs.
+
+    Responses come from fixture files or a dictionary of templates. A fixture is used
+    when its name appears in the system prompt or prompt, with underscores matching
+    spaces (e.g. ``bug_fixer.py`` answers the bug fixer), and the most specific match
+    wins. Templates can reference ``$prompt`` and ``$system_prompt``.
+    """
+
+    def __init__(
+        self,
+        fixtures_dir: Optional[str | Path] = None,
+        responses: Optional[dict[str, str]] = None,
+        latency: Optional[LatencyModel] = None,
+        default_response: Optional[str] = None,
+    ) -> None:
+        """Initialize fake provider.
+
+        Args:
+            fixtures_dir: Directory of response fixtures (default: the
+                POND_AGENT_FAKE_FIXTURES environment variable, if set)
+            responses: Responses keyed by a regular expression searched in the system
+                prompt and prompt, taking precedence over fixtures
+            latency: Latency model (default: :class:`LatencyModel` defaults)
+            default_response: Response when nothing matches (default: an empty JSON
+                object for JSON requests and a trivial script otherwise)
+
+        """
+        self.latency = latency or LatencyModel()
+        self.default_response = default_response
+        self.responses = [
+            (re.compile(pattern, re.I), text) for pattern, text in (responses or {}).items()
+        ]
+        fixtures_dir = fixtures_dir or os.getenv("POND_AGENT_FAKE_FIXTURES")
+        if fixtures_dir:
+            self.responses.extend(self._load_fixtures(Path(fixtures_dir)))
+        self.calls = 0
+
+    @staticmethod
+    def _load_fixtures(fixtures_dir: Path) -> list[tuple[re.Pattern, str]]:
+        """Load fixture files, most specific name first."""
+        if not fixtures_dir.is_dir():
+            raise FileNotFoundError(f"Fixtures directory not found: {fixtures_dir}")
+        fixtures = []
+        for path in sorted(fixtures_dir.iterdir(), key=lambda p: -len(p.stem)):
+            if path.suffix not in FIXTURE_SUFFIXES:
+                continue
+            words = [re.escape(word) for word in path.stem.split("_") if word]
+            pattern = re.compile(r"[\s_-]+".join(words), re.I)
+            fixtures.append((pattern, path.read_text()))
+        logger.info(f"Loaded {len(fixtures)} fake LLM fixtures from {fixtures_dir}")
+        return fixtures
+
+    def respond(self, prompt: str, system_prompt: str, json_response: bool) -> str:
+        """Return the full response text for a request."""
+        for pattern, text in self.responses:
+            if pattern.search(system_prompt) or pattern.search(prompt):
+                return Template(text).safe_substitute(
+                    prompt=prompt, system_prompt=system_prompt
+                )
+        if self.default_response is not None:
+            return self.default_response
+        return json.dumps({}) if json_response else DEFAULT_SCRIPT
+
+    def _plan(
+        self,
+        prompt: str,
+        system_prompt: str,
+        json_response: bool,
+        max_tokens: int,
+        partial: str,
+        stats: dict,
+    ) -> tuple[list[str], float, float]:
+        """Prepare a response, returning its chunks, first token delay and token interval.
+
+        Raises:
+            FakeAPIError: If the latency model rejects the request
+        """
+        self.calls += 1
+        error = self.latency.failure()
+        if error is not None:
+            raise error
+        text = self.respond(prompt, system_prompt, json_response)
+        # Continuations pick up where the previous segment stopped
+        if partial and text.startswith(partial):
+            text = text[len(partial):]
+        # Roughly 4 characters per token, as in llm.estimate_tokens
+        tokens = [text[i:i + 4] for i in range(0, len(text), 4)]
+        stats["prompt_tokens"] = (len(system_prompt) + len(prompt) + len(partial)) // 4 + 1
+        stats["completion_tokens"] = min(len(tokens), max_tokens)
+        stats["stop_reason"] = "length" if len(tokens) > max_tokens else "stop"
+        return (
+            tokens[:max_tokens],
+            self.latency.time_to_first_token(stats["prompt_tokens"]),
+            self.latency.token_interval(),
+        )
+
+    def complete(
+        self,
+        prompt: str,
+        system_prompt: str,
+        json_response: bool,
+        max_tokens: int,
+        stream: bool,
+        on_chunk: Optional[Callable[[str], None]],
+        stats: dict,
+        partial: str = "",
+        prefix: str = "",
+    ) -> str:
+        """Simulate a completion, sleeping for the sampled latency."""
+        tokens, ttft, interval = self._plan(
+            prefix + prompt, system_prompt, json_response, max_tokens, partial, stats
+        )
+        if not stream:
+            time.sleep(ttft + interval * len(tokens))
+            return "".join(tokens)
+        time.sleep(ttft)
+        stats["time_to_first_token"] = time.perf_counter() - stats["start"]
+        for i in range(0, len(tokens), 8):
+            chunk = "".join(tokens[i:i + 8])
+            if on_chunk is not None:
+                on_chunk(chunk)
+            time.sleep(interval * len(tokens[i:i + 8]))
+        return "".join(tokens)
+
+    async def acomplete(
+        self,
+        prompt: str,
+        system_prompt: str,
+        json_response: bool,
+        max_tokens: int,
+        stream: bool,
+        on_chunk: Optional[Callable[[str], None]],
+        stats: dict,
+        partial: str = "",
+        prefix: str = "",
+    ) -> str:
+        """Asynchronous counterpart of :meth:`complete`."""
+        tokens, ttft, interval = self._plan(
+            prefix + prompt, system_prompt, json_response, max_tokens, partial, stats
+        )
+        if not stream:
+            await asyncio.sleep(ttft + interval * len(tokens))
+            return "".join(tokens)
+        await asyncio.sleep(ttft)
+        stats["time_to_first_token"] = time.perf_counter() - stats["start"]
+        for i in range(0, len(tokens), 8):
+            chunk = "".join(tokens[i:i + 8])
+            if on_chunk is not None:
+                on_chunk(chunk)
+            await asyncio.sleep(interval * len(tokens[i:i + 8]))
+        return "".join(tokens)
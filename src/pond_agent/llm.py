@@ -1,27 +1,715 @@
+import asyncio
+import hashlib
 import json
 import logging
 import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, closing, contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Optional
 
 import anthropic
 import openai
 from dotenv import load_dotenv
 
+from .fake_llm import FakeLLM
+from .telemetry import TelemetryStore, estimate_cost
+
 logger = logging.getLogger(__name__)
 
+DEFAULT_CACHE_DIR = Path(
+    os.getenv("POND_AGENT_CACHE_DIR", Path.home() / ".cache" / "pond_agent")
+)
+
+
+# Maximum output tokens per model family, matched by prefix (longest prefix wins)
+MAX_OUTPUT_TOKENS = {
+    "gpt-4o": 16384,
+    "gpt-4.1": 32768,
+    "gpt-4-turbo": 4096,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 4096,
+    "o1": 100000,
+    "o3": 100000,
+    "claude-3-haiku": 4096,
+    "claude-3-opus": 4096,
+    "claude-3-sonnet": 4096,
+    "claude-3-5": 8192,
+    "claude-3-7": 64000,
+    "claude-sonnet-4": 64000,
+    "claude-opus-4": 32000,
+}
+DEFAULT_MAX_OUTPUT_TOKENS = 4096
+
+# Largest max_tokens the Anthropic SDK accepts for requests that are not streamed. Larger
+# requests are streamed internally, as the SDK rejects them as possibly too long-running.
+ANTHROPIC_NONSTREAMING_MAX_TOKENS = 8192
+
+# Stop reasons of completions that were cut off by the output token limit
+TRUNCATED_STOP_REASONS = {"max_tokens", "length"}
+
+CONTINUE_PROMPT = (
+    "Your previous response was cut off. Continue exactly where it stopped, without "
+    "repeating anything and without any preamble."
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """Roughly estimate the number of tokens in ``text`` (about 4 characters per token)."""
+    return len(text) // 4 + 1
+
+
+class TokenBucket:
+    """Thread-safe token bucket that hands out waiting times instead of blocking."""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        """Initialize token bucket.
+
+        Args:
+            rate: Tokens added per second
+            capacity: Maximum number of tokens the bucket can hold
+
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float = 1) -> float:
+        """Take ``amount`` tokens from the bucket.
+
+        The bucket may go into debt, which queues later callers behind earlier ones.
+
+        Returns:
+            Number of seconds the caller has to wait before using the tokens
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated_at) * self.rate
+            )
+            self.updated_at = now
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+
+class SlotSemaphore:
+    """Counting semaphore that threads and coroutines on any event loop can share.
+
+    Threads block on an event, coroutines await a future of their own loop, so waiting
+    never blocks an event loop. Slots are handed to waiters in FIFO order.
+    """
+
+    def __init__(self, value: int) -> None:
+        """Initialize semaphore.
+
+        Args:
+            value: Number of slots
+        """
+        self._value = value
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Block until a slot is free and take it."""
+        with self._lock:
+            if self._value > 0 and not self._waiters:
+                self._value -= 1
+                return
+            event = threading.Event()
+            self._waiters.append(event)
+        # The slot is handed over by release(), which sets the event
+        event.wait()
+
+    async def aacquire(self) -> None:
+        """Wait for a free slot without blocking the event loop, and take it."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._value > 0 and not self._waiters:
+                self._value -= 1
+                return
+            future = loop.create_future()
+            self._waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                waiting = future in self._waiters
+                if waiting:
+                    self._waiters.remove(future)
+            if not waiting and future.done() and not future.cancelled():
+                # Cancelled after the slot was handed over, so it is passed on
+                self.release()
+            raise
+
+    def release(self) -> None:
+        """Hand the slot to the next waiter, or free it."""
+        with self._lock:
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if isinstance(waiter, threading.Event):
+                    waiter.set()
+                    return
+                try:
+                    waiter.get_loop().call_soon_threadsafe(self._wake, waiter)
+                    return
+                except RuntimeError:
+                    # The waiter's event loop was closed
+                    continue
+            self._value += 1
+
+    def _wake(self, future: asyncio.Future) -> None:
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+
+class RateLimiter:
+    """Concurrency and rate limiter for LLM requests.
+
+    A single limiter is shared by everything that uses the same LLMClient, from plain
+    threads as well as from coroutines, so concurrent agents stay within provider limits.
+    Calls wait for the request and token rates once, see :meth:`pace`, and hold a
+    concurrency slot only while a request is in flight, see :meth:`slot`, so that calls
+    waiting to retry do not hold up the others.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 4,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+    ) -> None:
+        """Initialize rate limiter.
+
+        Args:
+            max_concurrency: Maximum number of requests in flight at the same time
+            requests_per_minute: Optional cap on the request rate
+            tokens_per_minute: Optional cap on the (estimated) prompt token rate
+
+        """
+        self.max_concurrency = max_concurrency
+        self._slots = SlotSemaphore(max_concurrency)
+        self.request_bucket = (
+            TokenBucket(requests_per_minute / 60, requests_per_minute)
+            if requests_per_minute
+            else None
+        )
+        self.token_bucket = (
+            TokenBucket(tokens_per_minute / 60, tokens_per_minute)
+            if tokens_per_minute
+            else None
+        )
+
+    def _reserve(self, tokens: int) -> float:
+        wait = 0.0
+        if self.request_bucket is not None:
+            wait = max(wait, self.request_bucket.reserve(1))
+        if self.token_bucket is not None and tokens:
+            wait = max(wait, self.token_bucket.reserve(tokens))
+        return wait
+
+    def pace(self, tokens: int = 0) -> None:
+        """Block until the request and token rates allow a call of ``tokens`` tokens."""
+        wait = self._reserve(tokens)
+        if wait:
+            logger.debug(f"Rate limit reached, waiting {wait:.2f}s")
+            time.sleep(wait)
+
+    async def apace(self, tokens: int = 0) -> None:
+        """Asynchronous counterpart of :meth:`pace`."""
+        wait = self._reserve(tokens)
+        if wait:
+            logger.debug(f"Rate limit reached, waiting {wait:.2f}s")
+            await asyncio.sleep(wait)
+
+    @contextmanager
+    def slot(self):
+        """Hold one of the ``max_concurrency`` slots while a request is in flight."""
+        self._slots.acquire()
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    @asynccontextmanager
+    async def aslot(self):
+        """Asynchronous counterpart of :meth:`slot`."""
+        await self._slots.aacquire()
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def limit(self, tokens: int = 0):
+        """Block until a request of ``tokens`` tokens may be sent, and hold a slot."""
+        self.pace(tokens)
+        with self.slot():
+            yield
+
+    @asynccontextmanager
+    async def alimit(self, tokens: int = 0):
+        """Asynchronous counterpart of :meth:`limit`."""
+        await self.apace(tokens)
+        async with self.aslot():
+            yield
+
+
+# HTTP status codes worth retrying: timeouts, conflicts, rate limits, server errors and
+# Anthropic's "overloaded"
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+def _parse_duration(value: str) -> Optional[float]:
+    """Parse a duration such as '20ms', '1.5s' or '6m0s' into seconds."""
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+def _parse_reset(value: str) -> Optional[float]:
+    """Parse a rate limit reset header (duration or RFC 3339 timestamp) into seconds."""
+    if "T" in value:
+        try:
+            reset_at = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+        return max(0.0, reset_at.timestamp() - time.time())
+    return _parse_duration(value)
+
+
+def _retry_after(headers) -> Optional[float]:
+    """Read the server's requested retry delay from response headers."""
+    if not headers:
+        return None
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        # HTTP date
+        from email.utils import parsedate_to_datetime
+
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_error(error: Exception) -> tuple[bool, Optional[float]]:
+    """Decide whether a failed request should be retried.
+
+    Returns:
+        Tuple of whether the error is transient and the delay requested by the server
+    """
+    if isinstance(error, (openai.APIConnectionError, anthropic.APIConnectionError)):
+        return True, None
+    status_code = getattr(error, "status_code", None)
+    if status_code not in RETRYABLE_STATUS_CODES:
+        return False, None
+    response = getattr(error, "response", None)
+    return True, _retry_after(getattr(response, "headers", None))
+
+
+class RetryPolicy:
+    """Jittered exponential backoff that honours the server's Retry-After."""
+
+    def __init__(
+        self, max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0
+    ) -> None:
+        """Initialize retry policy.
+
+        Args:
+            max_retries: Maximum number of retries of a failed request
+            base_delay: Backoff delay of the first retry in seconds
+            max_delay: Upper bound of the backoff delay in seconds
+
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Delay before retry number ``attempt`` (starting at 0)."""
+        # Full jitter spreads out clients that failed at the same time
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+
+class CircuitBreaker:
+    """Stop sending requests to a provider that keeps failing.
+
+    After ``failure_threshold`` consecutive transient failures the breaker opens and
+    callers wait ``reset_timeout`` seconds before a trial request is let through.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0) -> None:
+        """Initialize circuit breaker.
+
+        Args:
+            failure_threshold: Consecutive failures that open the breaker
+            reset_timeout: Seconds the breaker stays open
+
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """'closed', 'open' or 'half-open'."""
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def wait_time(self) -> float:
+        """Seconds until requests may be sent again."""
+        with self._lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning(
+                        f"Circuit breaker opened after {self.failures} consecutive failures"
+                    )
+                self.opened_at = time.monotonic()
+
+
+class QuotaTracker:
+    """Track the remaining rate limit quota reported in provider response headers.
+
+    Requests are paced until the quota resets once it is (nearly) used up, instead of
+    waiting for the provider to answer with a 429.
+    """
+
+    # Header names of (remaining requests, remaining tokens, requests reset, tokens reset)
+    HEADERS = {
+        "openai": (
+            "x-ratelimit-remaining-requests",
+            "x-ratelimit-remaining-tokens",
+            "x-ratelimit-reset-requests",
+            "x-ratelimit-reset-tokens",
+        ),
+        "anthropic": (
+            "anthropic-ratelimit-requests-remaining",
+            "anthropic-ratelimit-tokens-remaining",
+            "anthropic-ratelimit-requests-reset",
+            "anthropic-ratelimit-tokens-reset",
+        ),
+    }
+
+    def __init__(self, provider: str) -> None:
+        """Initialize quota tracker for ``provider``."""
+        self.provider = provider
+        self.remaining_requests = None
+        self.remaining_tokens = None
+        self.requests_reset_at = 0.0
+        self.tokens_reset_at = 0.0
+        self._lock = threading.Lock()
+
+    def update(self, headers) -> None:
+        """Update the quota from the headers of a response."""
+        names = self.HEADERS.get(self.provider)
+        if not names or not headers:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if headers.get(names[0]) is not None:
+                self.remaining_requests = int(headers[names[0]])
+            if headers.get(names[1]) is not None:
+                self.remaining_tokens = int(headers[names[1]])
+            if headers.get(names[2]):
+                self.requests_reset_at = now + (_parse_reset(headers[names[2]]) or 0.0)
+            if headers.get(names[3]):
+                self.tokens_reset_at = now + (_parse_reset(headers[names[3]]) or 0.0)
+
+    def reserve(self, tokens: int = 0) -> float:
+        """Account for a request and return how long to wait before sending it."""
+        now = time.monotonic()
+        with self._lock:
+            wait = 0.0
+            if self.remaining_requests is not None:
+                if self.remaining_requests <= 0:
+                    wait = max(wait, self.requests_reset_at - now)
+                self.remaining_requests -= 1
+            if self.remaining_tokens is not None and tokens:
+                if self.remaining_tokens < tokens:
+                    wait = max(wait, self.tokens_reset_at - now)
+                self.remaining_tokens -= tokens
+            return max(0.0, wait)
+
+
+_provider_states = {}
+_provider_states_lock = threading.Lock()
+
+
+def provider_state(provider: str) -> tuple[CircuitBreaker, QuotaTracker]:
+    """Return the circuit breaker and quota tracker shared by all clients of a provider."""
+    with _provider_states_lock:
+        if provider not in _provider_states:
+            _provider_states[provider] = (CircuitBreaker(), QuotaTracker(provider))
+        return _provider_states[provider]
+
+
+class ResponseCache:
+    """On-disk, content-addressed cache of LLM responses.
+
+    Entries are stored in a SQLite database, which serializes writers across processes,
+    so several pipelines can share one cache directory. Entries older than ``max_age_days``
+    are dropped and the least recently used entries are evicted once the cache grows past
+    ``max_size_mb``.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[str | Path] = None,
+        max_size_mb: float = 512,
+        max_age_days: float = 30,
+    ) -> None:
+        """Initialize response cache.
+
+        Args:
+            cache_dir: Directory holding the cache database (default: ~/.cache/pond_agent)
+            max_size_mb: Maximum total size of cached responses in megabytes
+            max_age_days: Maximum age of a cached response in days
+
+        """
+        self.cache_dir = Path(cache_dir or DEFAULT_CACHE_DIR)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.path = self.cache_dir / "llm_cache.sqlite"
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.max_age = max_age_days * 24 * 3600
+
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_accessed_at ON responses (accessed_at)"
+            )
+        logger.debug(f"Using LLM response cache at {self.path}")
+
+    def _connect(self) -> sqlite3.Connection:
+        # A fresh connection per operation keeps the cache safe to use from threads and
+        # forked processes; the timeout makes writers wait for each other's locks.
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    @staticmethod
+    def make_key(
+        provider: str,
+        model_name: str,
+        system_prompt: str,
+        prompt: str,
+        temperature: float,
+        json_response: bool,
+    ) -> str:
+        """Compute the content address of a request."""
+        payload = json.dumps(
+            [provider, model_name, system_prompt, prompt, temperature, json_response],
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[dict | str]:
+        """Return the cached response for ``key``, or None on a miss."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.max_age:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            conn.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            return json.loads(row[0])
+        finally:
+            conn.close()
+
+    def set(self, key: str, response: dict | str) -> None:
+        """Store ``response`` under ``key`` and evict stale entries."""
+        data = json.dumps(response, ensure_ascii=False)
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(data.encode("utf-8")), now, now),
+            )
+            self._evict(conn, now)
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        """Drop expired entries, then least recently used ones until under the size cap."""
+        conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.max_age,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_size:
+            return
+        rows = conn.execute(
+            "SELECT key, size FROM responses ORDER BY accessed_at ASC"
+        ).fetchall()
+        evicted = []
+        for key, size in rows:
+            if total <= self.max_size:
+                break
+            evicted.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        logger.debug(f"Evicted {len(evicted)} entries from LLM response cache")
+
+    def clear(self) -> None:
+        """Remove all cached responses."""
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM responses")
+
+
+def _run_sync(coroutine):
+    """Run a coroutine to completion from synchronous code.
+
+    Works both with and without a running event loop (e.g. inside Jupyter), in which case
+    the coroutine runs on a fresh loop in a worker thread.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
 
 class LLMClient:
     """Client for interacting with LLM providers."""
 
-    def __init__(self, provider: str, model_name: str) -> None:
+    def __init__(
+        self,
+        provider: str,
+        model_name: str,
+        use_cache: bool = True,
+        cache_dir: Optional[str | Path] = None,
+        max_concurrency: int = 4,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        limiter: Optional[RateLimiter] = None,
+        max_continuations: int = 3,
+        retry_policy: Optional[RetryPolicy] = None,
+        record_telemetry: bool = True,
+        telemetry_path: Optional[str | Path] = None,
+        fallback_targets: Optional[list[str]] = None,
+        routes: Optional[dict[str, list[str]]] = None,
+        hedge_percentile: float = 0.9,
+        hedge_delay: float = 60.0,
+        fake_llm: Optional[FakeLLM] = None,
+        base_url: Optional[str] = None,
+    ) -> None:
         """Initialize LLM client.
 
         Args:
             provider: LLM provider ('openai' or 'anthropic')
             model_name: Name of the model to use
+            use_cache: Whether to serve repeated requests from the on-disk response cache
+            cache_dir: Directory of the response cache (default: ~/.cache/pond_agent)
+            max_concurrency: Maximum number of requests in flight at the same time
+            requests_per_minute: Optional cap on the request rate
+            tokens_per_minute: Optional cap on the prompt token rate
+            limiter: Existing rate limiter to share with other clients. Overrides
+                max_concurrency, requests_per_minute and tokens_per_minute
+            max_continuations: Maximum number of follow-up requests used to complete a
+                response that was cut off by the output token limit
+            retry_policy: Backoff policy for transient errors such as 429s and 5xx
+                (default: up to 5 retries with jittered exponential backoff)
+            record_telemetry: Whether to record every call in the telemetry store
+            telemetry_path: Path of the telemetry database
+                (default: ~/.cache/pond_agent/telemetry.sqlite)
+            fallback_targets: Ordered 'provider:model' targets tried after this client's
+                own provider and model. A duplicate request is sent to the next target when
+                a request is slower than usual or fails, and the first valid answer wins
+            routes: Ordered 'provider:model' targets per caller (e.g. 'BugFixer' or
+                'plan_tasks'), used instead of the default targets for that call site
+            hedge_percentile: Latency percentile of a target and call site after which the
+                hedged request is sent
+            hedge_delay: Hedging delay used until enough latencies have been observed
+            fake_llm: Fixtures and latency model of the offline 'fake' provider
+            base_url: Optional API base URL, e.g. of a local mock server (default: the
+                SDK's OPENAI_BASE_URL / ANTHROPIC_BASE_URL environment variables)
 
         """
         self.provider = provider.lower()
         self.model_name = model_name
+        self.use_cache = use_cache
+        self.cache = ResponseCache(cache_dir) if use_cache else None
+        self.limiter = limiter or RateLimiter(
+            max_concurrency, requests_per_minute, tokens_per_minute
+        )
+        self.max_continuations = max_continuations
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.breaker, self.quota = provider_state(self.provider)
+        self.telemetry = TelemetryStore(telemetry_path) if record_telemetry else None
+        # Identifies the pipeline run in the telemetry, set by the owning agent
+        self.run_id = None
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay
+        # Recent latencies per call site, used to decide when to hedge
+        self.latencies = {}
+        self._targets = {f"{self.provider}:{self.model_name}": self}
+        self.default_targets = [f"{self.provider}:{self.model_name}"] + list(
+            fallback_targets or []
+        )
+        self.routes = dict(routes or {})
+        self.base_url = base_url
+        self._async_client = None
+        self._async_loop = None
 
         logger.info(
             f"Initializing LLMClient with provider={provider}, model={model_name}"
@@ -34,148 +722,991 @@ class LLMClient:
             logger.warning(f"No .env file found in current directory {os.getcwd()}")
 
         if self.provider == "openai":
-            api_key = os.getenv("OPENAI_API_KEY")
-            if not api_key:
+            self.api_key = os.getenv("OPENAI_API_KEY")
+            if not self.api_key:
                 logger.error("OPENAI_API_KEY not found in environment")
                 raise ValueError("OPENAI_API_KEY not found in environment")
-            self.client = openai.OpenAI(api_key=api_key)
+            # Retries are handled by the client's own retry policy
+            self.client = openai.OpenAI(
+                api_key=self.api_key, base_url=self.base_url, max_retries=0
+            )
             logger.info("Successfully initialized OpenAI client")
         elif self.provider == "anthropic":
-            api_key = os.getenv("ANTHROPIC_API_KEY")
-            if not api_key:
+            self.api_key = os.getenv("ANTHROPIC_API_KEY")
+            if not self.api_key:
                 logger.error("ANTHROPIC_API_KEY not found in environment")
                 raise ValueError("ANTHROPIC_API_KEY not found in environment")
-            self.client = anthropic.Anthropic(api_key=api_key)
+            self.client = anthropic.Anthropic(
+                api_key=self.api_key, base_url=self.base_url, max_retries=0
+            )
             logger.info("Successfully initialized Anthropic client")
+        elif self.provider == "fake":
+            # Offline provider for load testing, no API key needed
+            self.api_key = None
+            self.client = fake_llm or FakeLLM()
+            logger.info("Successfully initialized fake LLM client")
         else:
             logger.error(f"Unsupported provider: {provider}")
             raise ValueError(f"Unsupported provider: {provider}")
 
+        # Create the clients of all other targets up front so missing API keys surface early
+        for targets in [self.default_targets, *self.routes.values()]:
+            for target in targets:
+                self._target_client(target)
+
+    @property
+    def async_client(self) -> openai.AsyncOpenAI | anthropic.AsyncAnthropic | FakeLLM:
+        """Async SDK client bound to the running event loop."""
+        if self.provider == "fake":
+            return self.client
+        loop = asyncio.get_running_loop()
+        # The underlying HTTP connection pool is tied to the loop that created it, so a
+        # new client is needed when called from a different loop (e.g. another asyncio.run).
+        if self._async_client is None or self._async_loop is not loop:
+            if self.provider == "openai":
+                self._async_client = openai.AsyncOpenAI(
+                    api_key=self.api_key, base_url=self.base_url, max_retries=0
+                )
+            else:
+                self._async_client = anthropic.AsyncAnthropic(
+                    api_key=self.api_key, base_url=self.base_url, max_retries=0
+                )
+            self._async_loop = loop
+        return self._async_client
+
+    @property
+    def max_output_tokens(self) -> int:
+        """Maximum number of output tokens the model can produce in one response."""
+        matches = [
+            prefix for prefix in MAX_OUTPUT_TOKENS if self.model_name.startswith(prefix)
+        ]
+        if not matches:
+            return DEFAULT_MAX_OUTPUT_TOKENS
+        return MAX_OUTPUT_TOKENS[max(matches, key=len)]
+
+    def size_max_tokens(self, expected_tokens: int) -> int:
+        """Size ``max_tokens`` for a response expected to be about ``expected_tokens`` long.
+
+        Leaves 50% headroom over the estimate, within the model's output limit.
+        """
+        return min(self.max_output_tokens, max(1024, int(expected_tokens * 1.5)))
+
+    def _target_client(self, target: str) -> "LLMClient":
+        """Return the client of a 'provider:model' target, creating it on first use."""
+        if target not in self._targets:
+            provider, sep, model_name = target.partition(":")
+            if not sep or not model_name:
+                raise ValueError(f"Invalid LLM target {target!r}, expected 'provider:model'")
+            # Target clients share this client's limiter; caching and telemetry happen here
+            self._targets[target] = LLMClient(
+                provider,
+                model_name,
+                use_cache=False,
+                limiter=self.limiter,
+                max_continuations=self.max_continuations,
+                retry_policy=self.retry_policy,
+                record_telemetry=False,
+                fake_llm=self.client if isinstance(self.client, FakeLLM) else None,
+            )
+        return self._targets[target]
+
+    def targets_for(self, caller: Optional[str] = None) -> list["LLMClient"]:
+        """Return the ordered target clients used for requests from ``caller``."""
+        targets = self.routes.get(caller, self.default_targets)
+        return [self._target_client(target) for target in targets]
+
+    def observe_latency(self, caller: Optional[str], latency: float) -> None:
+        """Record the latency of a successful request from ``caller``."""
+        history = self.latencies.setdefault(caller, deque(maxlen=100))
+        history.append(latency)
+
+    def hedge_after(self, caller: Optional[str], min_samples: int = 5) -> float:
+        """Seconds after which a request from ``caller`` is hedged to the next target."""
+        history = sorted(self.latencies.get(caller, ()))
+        if len(history) < min_samples:
+            return self.hedge_delay
+        index = min(len(history) - 1, int(self.hedge_percentile * len(history)))
+        return history[index]
+
+    def _cache_key(
+        self,
+        client: "LLMClient",
+        prompt: str,
+        system_prompt: str,
+        json_response: bool,
+        temperature: float,
+        use_cache: Optional[bool],
+    ) -> Optional[str]:
+        """Return the response cache key, or None if the cache is not used."""
+        if use_cache is None:
+            use_cache = self.use_cache
+        if not use_cache or self.cache is None:
+            return None
+        return ResponseCache.make_key(
+            client.provider,
+            client.model_name,
+            system_prompt,
+            prompt,
+            temperature,
+            json_response,
+        )
+
     def get_response(
         self,
         prompt: str,
         system_prompt: str = "",
         json_response: bool = True,
         temperature: float = 0.1,
-        max_tokens: int = 1000,
-    ) -> dict | str:
+        max_tokens: Optional[int] = None,
+        use_cache: Optional[bool] = None,
+        refresh_cache: bool = False,
+        stream: bool = False,
+        on_chunk: Optional[Callable[[str], None]] = None,
+        return_stats: bool = False,
+        caller: Optional[str] = None,
+        prefix: str = "",
+    ) -> dict | str | tuple[dict | str, dict]:
         """Get raw response from LLM.
 
         Args:
             prompt: The prompt to send to the LLM
+            max_tokens: Output token limit of a single request (default: the model's output
+                limit, see :meth:`size_max_tokens` to size it from the expected response
+                length). Responses cut off by the limit are continued automatically
+            use_cache: Whether to read and write the response cache for this call
+                (default: the client's ``use_cache`` setting)
+            refresh_cache: Skip the cache lookup but store the fresh response
+            stream: Stream the completion and pass text chunks to ``on_chunk`` as they arrive
+            on_chunk: Callback receiving text chunks. Cached and hedged responses are passed
+                as one chunk
+            return_stats: Also return call statistics such as latency, time to first
+                token and tokens per second
+            caller: Name of the calling agent or pipeline stage, recorded in the telemetry
+            prefix: Static context sent before ``prompt`` and marked cacheable by the
+                provider, e.g. instructions and code shared by repeated fix requests
 
         Returns:
-            Dictionary containing the structured recommendations
+            Dictionary containing the structured recommendations, and the call statistics
+            if ``return_stats`` is True
 
         """
         logger.info(f"Getting response using {self.provider}")
         logger.debug(f"Prompt: {prompt[:200]}...")  # Log first 200 chars of prompt
 
-        if self.provider == "openai":
-            return self._get_openai_response(
-                prompt, system_prompt, json_response, temperature
-            )
-        elif self.provider == "anthropic":
-            return self._get_anthropic_response(
-                prompt, system_prompt, json_response, temperature, max_tokens
-            )
-        else:
-            logger.error(f"Unsupported provider: {self.provider}")
-            raise ValueError(f"Unsupported provider: {self.provider}")
+        stats = self._new_stats()
+        targets = self.targets_for(caller)
+        cache_key = self._cache_key(
+            targets[0], prefix + prompt, system_prompt, json_response, temperature,
+            use_cache,
+        )
+        try:
+            response = self._get_cached(cache_key, refresh_cache, on_chunk, stats)
+            if response is None:
+                # Each request also holds a concurrency slot while it is in flight
+                self.limiter.pace(estimate_tokens(system_prompt + prefix + prompt))
+                self._mark_dequeued(stats)
+                if len(targets) == 1:
+                    client = targets[0]
+                    text = client._complete(
+                        prompt, system_prompt, json_response, temperature,
+                        max_tokens, stream, on_chunk, stats, prefix=prefix,
+                    )
+                else:
+                    # Hedging needs concurrent requests, which run on an event loop
+                    text, client = _run_sync(
+                        self._hedged_complete(
+                            targets, prompt, system_prompt, json_response,
+                            temperature, max_tokens, on_chunk, stats, caller,
+                            prefix=prefix,
+                        )
+                    )
+                response = client._finish(text, json_response, stats)
+                self.observe_latency(caller, stats["latency"])
+                # A hedged or fallback response is cached as the model that answered, so
+                # that it is never served as a response of the primary model
+                if client is not targets[0]:
+                    cache_key = self._cache_key(
+                        client, prefix + prompt, system_prompt, json_response, temperature,
+                        use_cache,
+                    )
+                if cache_key is not None and response:
+                    self.cache.set(cache_key, response)
+        except Exception as e:
+            self._record_call(caller, stats, e)
+            raise
 
-    def _get_openai_response(
+        self._record_call(caller, stats)
+        return (response, stats) if return_stats else response
+
+    async def aget_response(
         self,
         prompt: str,
         system_prompt: str = "",
         json_response: bool = True,
-        temperature: float = 0.2,
+        temperature: float = 0.1,
+        max_tokens: Optional[int] = None,
+        use_cache: Optional[bool] = None,
+        refresh_cache: bool = False,
+        stream: bool = False,
+        on_chunk: Optional[Callable[[str], None]] = None,
+        return_stats: bool = False,
+        caller: Optional[str] = None,
+        prefix: str = "",
+    ) -> dict | str | tuple[dict | str, dict]:
+        """Get raw response from LLM without blocking the event loop.
+
+        Takes the same arguments as :meth:`get_response`. Requests share the client's
+        rate limiter, so many of them can be gathered concurrently.
+        """
+        logger.info(f"Getting async response using {self.provider}")
+        logger.debug(f"Prompt: {prompt[:200]}...")
+
+        stats = self._new_stats()
+        targets = self.targets_for(caller)
+        cache_key = self._cache_key(
+            targets[0], prefix + prompt, system_prompt, json_response, temperature,
+            use_cache,
+        )
+        try:
+            response = self._get_cached(cache_key, refresh_cache, on_chunk, stats)
+            if response is None:
+                await self.limiter.apace(estimate_tokens(system_prompt + prefix + prompt))
+                self._mark_dequeued(stats)
+                if len(targets) == 1:
+                    client = targets[0]
+                    text = await client._acomplete(
+                        prompt, system_prompt, json_response, temperature,
+                        max_tokens, stream, on_chunk, stats, prefix=prefix,
+                    )
+                else:
+                    text, client = await self._hedged_complete(
+                        targets, prompt, system_prompt, json_response,
+                        temperature, max_tokens, on_chunk, stats, caller,
+                        prefix=prefix,
+                    )
+                response = client._finish(text, json_response, stats)
+                self.observe_latency(caller, stats["latency"])
+                # A hedged or fallback response is cached as the model that answered, so
+                # that it is never served as a response of the primary model
+                if client is not targets[0]:
+                    cache_key = self._cache_key(
+                        client, prefix + prompt, system_prompt, json_response, temperature,
+                        use_cache,
+                    )
+                if cache_key is not None and response:
+                    self.cache.set(cache_key, response)
+        except Exception as e:
+            self._record_call(caller, stats, e)
+            raise
+
+        self._record_call(caller, stats)
+        return (response, stats) if return_stats else response
+
+    def _complete(
+        self,
+        prompt: str,
+        system_prompt: str,
+        json_response: bool,
+        temperature: float,
+        max_tokens: Optional[int],
+        stream: bool,
+        on_chunk: Optional[Callable[[str], None]],
+        stats: dict,
+        prefix: str = "",
+    ) -> str:
+        """Get the full response text, continuing it while it is cut off."""
+        # The prompt length says nothing about the response length, e.g. a short prompt
+        # can ask for a long script, so without an expected length the model's limit is used.
+        # Anthropic requests that large are streamed, see _get_anthropic_response.
+        if max_tokens is None:
+            max_tokens = self.max_output_tokens
+        max_tokens = min(max_tokens, self.max_output_tokens)
+        text = ""
+        while True:
+            segment = self._new_stats()
+            part = self._send_with_retry(
+                prompt, system_prompt, json_response, temperature, max_tokens,
+                stream, on_chunk, segment, text, stats, prefix=prefix,
+            )
+            text = self._stitch(text, part)
+            if not self._should_continue(stats, segment):
+                return text
+
+    async def _acomplete(
+        self,
+        prompt: str,
+        system_prompt: str,
+        json_response: bool,
+        temperature: float,
+        max_tokens: Optional[int],
+        stream: bool,
+        on_chunk: Optional[Callable[[str], None]],
+        stats: dict,
+        prefix: str = "",
+    ) -> str:
+        """Asynchronous counterpart of :meth:`_complete`."""
+        # The prompt length says nothing about the response length, e.g. a short prompt
+        # can ask for a long script, so without an expected length the model's limit is used
+        if max_tokens is None:
+            max_tokens = self.max_output_tokens
+        max_tokens = min(max_tokens, self.max_output_tokens)
+        text = ""
+        while True:
+            segment = self._new_stats()
+            part = await self._asend_with_retry(
+                prompt, system_prompt, json_response, temperature, max_tokens,
+                stream, on_chunk, segment, text, stats, prefix=prefix,
+            )
+            text = self._stitch(text, part)
+            if not self._should_continue(stats, segment):
+                return text
+
+    async def _hedged_complete(
+        self,
+        targets: list["LLMClient"],
+        prompt: str,
+        system_prompt: str,
+        json_response: bool,
+        temperature: float,
+        max_tokens: Optional[int],
+        on_chunk: Optional[Callable[[str], None]],
+        stats: dict,
+        caller: Optional[str],
+        prefix: str = "",
+    ) -> tuple[str, "LLMClient"]:
+        """Race the targets and return the first valid response and its client.
+
+        The next target is started when all running requests are slower than the call
+        site's usual latency, or as soon as one of them fails. Losing requests are
+        cancelled. The winning response is passed to ``on_chunk`` in one piece.
+        """
+        delay = self.hedge_after(caller)
+        attempts = {}
+        errors = []
+
+        async def attempt(client: "LLMClient", attempt_stats: dict) -> str:
+            return await client._acomplete(
+                prompt, system_prompt, json_response, temperature, max_tokens,
+                False, None, attempt_stats, prefix=prefix,
+            )
+
+        def launch(index: int) -> None:
+            client = targets[index]
+            attempt_stats = client._new_stats()
+            task = asyncio.create_task(attempt(client, attempt_stats))
+            attempts[task] = (client, attempt_stats)
+            if index > 0:
+                logger.info(
+                    f"Hedging {caller or 'request'} to {client.provider}:{client.model_name}"
+                )
+
+        launch(0)
+        next_index = 1
+        try:
+            while attempts:
+                hedge_timeout = delay if next_index < len(targets) else None
+                done, _ = await asyncio.wait(
+                    attempts, timeout=hedge_timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    launch(next_index)
+                    next_index += 1
+                    continue
+                for task in done:
+                    client, attempt_stats = attempts.pop(task)
+                    if task.exception() is not None:
+                        errors.append(task.exception())
+                        logger.warning(
+                            f"{client.provider}:{client.model_name} failed: "
+                            f"{task.exception()!s}"
+                        )
+                        continue
+                    text = task.result()
+                    if not client._is_valid(text, json_response):
+                        errors.append(ValueError("Invalid response"))
+                        continue
+                    for key in (
+                        "prompt_tokens", "cached_prompt_tokens", "completion_tokens",
+                        "stop_reason", "continuations",
+                    ):
+                        stats[key] = attempt_stats[key]
+                    stats["retries"] += attempt_stats["retries"]
+                    stats["hedged"] = next_index > 1
+                    if on_chunk is not None:
+                        on_chunk(text)
+                    return text, client
+                if next_index < len(targets) and len(attempts) < len(targets):
+                    # Fail over right away instead of waiting for the hedging delay
+                    launch(next_index)
+                    next_index += 1
+        finally:
+            for task in attempts:
+                task.cancel()
+        raise errors[-1] if errors else RuntimeError("No LLM target returned a response")
+
+    def _is_valid(self, text: str, json_response: bool) -> bool:
+        """Check whether response text is usable."""
+        if not text:
+            return False
+        if not json_response:
+            return True
+        try:
+            return self._parse_response(text, json_response) is not None
+        except (ValueError, json.JSONDecodeError):
+            return False
+
+    def _send_with_retry(
+        self,
+        prompt: str,
+        system_prompt: str,
+        json_response: bool,
+        temperature: float,
+        max_tokens: int,
+        stream: bool,
+        on_chunk: Optional[Callable[[str], None]],
+        segment: dict,
+        partial: str,
+        stats: dict,
+        prefix: str = "",
+    ) -> str:
+        """Send one request, retrying transient errors with backoff."""
+        attempt = 0
+        while True:
+            wait = self._pre_request_wait(system_prompt + prefix + prompt + partial)
+            if wait:
+                logger.info(f"Pacing {self.provider} requests, waiting {wait:.2f}s")
+                time.sleep(wait)
+            try:
+                # The slot is released before a retry's backoff, see RateLimiter
+                queued = time.perf_counter()
+                with self.limiter.slot():
+                    self._mark_slot_wait(stats, time.perf_counter() - queued)
+                    segment["start"] = time.perf_counter()
+                    if self.provider == "openai":
+                        part = self._get_openai_response(
+                            prompt, system_prompt, json_response, temperature, max_tokens,
+                            stream, on_chunk, segment, partial, prefix=prefix,
+                        )
+                    elif self.provider == "anthropic":
+                        part = self._get_anthropic_response(
+                            prompt, system_prompt, json_response, temperature, max_tokens,
+                            stream, on_chunk, segment, partial, prefix=prefix,
+                        )
+                    elif self.provider == "fake":
+                        part = self.client.complete(
+                            prompt, system_prompt, json_response, max_tokens, stream,
+                            on_chunk, segment, partial, prefix=prefix,
+                        )
+                    else:
+                        logger.error(f"Unsupported provider: {self.provider}")
+                        raise ValueError(f"Unsupported provider: {self.provider}")
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, segment)
+                if delay is None:
+                    raise
+                attempt += 1
+                stats["retries"] += 1
+                time.sleep(delay)
+                continue
+            self.breaker.record_success()
+            return part
+
+    async def _asend_with_retry(
+        self,
+        prompt: str,
+        system_prompt: str,
+        json_response: bool,
+        temperature: float,
+        max_tokens: int,
+        stream: bool,
+        on_chunk: Optional[Callable[[str], None]],
+        segment: dict,
+        partial: str,
+        stats: dict,
+        prefix: str = "",
+    ) -> str:
+        """Asynchronous counterpart of :meth:`_send_with_retry`."""
+        attempt = 0
+        while True:
+            wait = self._pre_request_wait(system_prompt + prefix + prompt + partial)
+            if wait:
+                logger.info(f"Pacing {self.provider} requests, waiting {wait:.2f}s")
+                await asyncio.sleep(wait)
+            try:
+                queued = time.perf_counter()
+                async with self.limiter.aslot():
+                    self._mark_slot_wait(stats, time.perf_counter() - queued)
+                    segment["start"] = time.perf_counter()
+                    if self.provider == "openai":
+                        part = await self._aget_openai_response(
+                            prompt, system_prompt, json_response, temperature, max_tokens,
+                            stream, on_chunk, segment, partial, prefix=prefix,
+                        )
+                    elif self.provider == "anthropic":
+                        part = await self._aget_anthropic_response(
+                            prompt, system_prompt, json_response, temperature, max_tokens,
+                            stream, on_chunk, segment, partial, prefix=prefix,
+                        )
+                    elif self.provider == "fake":
+                        part = await self.client.acomplete(
+                            prompt, system_prompt, json_response, max_tokens, stream,
+                            on_chunk, segment, partial, prefix=prefix,
+                        )
+                    else:
+                        logger.error(f"Unsupported provider: {self.provider}")
+                        raise ValueError(f"Unsupported provider: {self.provider}")
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, segment)
+                if delay is None:
+                    raise
+                attempt += 1
+                stats["retries"] += 1
+                await asyncio.sleep(delay)
+                continue
+            self.breaker.record_success()
+            return part
+
+    def _pre_request_wait(self, request_text: str) -> float:
+        """Seconds to wait before sending a request to respect the breaker and quota."""
+        return max(
+            self.breaker.wait_time(),
+            self.quota.reserve(estimate_tokens(request_text)),
+        )
+
+    def _retry_delay(
+        self, error: Exception, attempt: int, segment: dict
+    ) -> Optional[float]:
+        """Return the backoff delay before retrying ``error``, or None to give up."""
+        transient, retry_after = classify_error(error)
+        if not transient:
+            return None
+        self.breaker.record_failure()
+        if segment["time_to_first_token"] is not None:
+            # Part of the response was already streamed to the caller
+            logger.error(f"{self.provider} stream failed midway: {error!s}")
+            return None
+        if attempt >= self.retry_policy.max_retries:
+            logger.error(f"Giving up on {self.provider} request after {attempt} retries")
+            return None
+        delay = self.retry_policy.backoff(attempt, retry_after)
+        logger.warning(
+            f"Transient {self.provider} error ({error!s}), "
+            f"retrying in {delay:.2f}s ({attempt + 1}/{self.retry_policy.max_retries})"
+        )
+        return delay
+
+    def _should_continue(self, stats: dict, segment: dict) -> bool:
+        """Merge the statistics of a response segment and decide whether to continue."""
+        if stats["time_to_first_token"] is None and segment["time_to_first_token"]:
+            stats["time_to_first_token"] = (
+                segment["start"] - stats["start"] + segment["time_to_first_token"]
+            )
+        for key in ("prompt_tokens", "cached_prompt_tokens", "completion_tokens"):
+            if segment[key] is not None:
+                stats[key] = (stats[key] or 0) + segment[key]
+        stats["stop_reason"] = segment["stop_reason"]
+
+        if segment["stop_reason"] not in TRUNCATED_STOP_REASONS:
+            return False
+        if stats["continuations"] >= self.max_continuations:
+            logger.warning(
+                f"Response still truncated after {stats['continuations']} continuations"
+            )
+            return False
+        stats["continuations"] += 1
+        logger.info(
+            f"Response cut off by the output token limit, requesting continuation "
+            f"{stats['continuations']}/{self.max_continuations}"
+        )
+        return True
+
+    def _stitch(self, text: str, part: str, min_overlap: int = 20) -> str:
+        """Append a continuation to the response text received so far."""
+        if not text:
+            return part
+        if self.provider == "anthropic":
+            # Anthropic continues from the prefilled text, which had its trailing
+            # whitespace removed
+            return text.rstrip() + part
+        if self.provider == "fake":
+            return text + part
+        # Other providers may repeat the end of the previous segment
+        for size in range(min(200, len(text), len(part)), min_overlap - 1, -1):
+            if text.endswith(part[:size]):
+                return text + part[size:]
+        return text + part
+
+    @staticmethod
+    def _new_stats() -> dict:
+        """Create the statistics record of a single call."""
+        return {
+            "cached": False,
+            "start": time.perf_counter(),
+            "latency": None,
+            "time_to_first_token": None,
+            "prompt_tokens": None,
+            "cached_prompt_tokens": None,
+            "completion_tokens": None,
+            "tokens_per_second": None,
+            "stop_reason": None,
+            "queue_time": 0.0,
+            "retries": 0,
+            "continuations": 0,
+            "hedged": False,
+        }
+
+    def _get_cached(
+        self,
+        cache_key: Optional[str],
+        refresh_cache: bool,
+        on_chunk: Optional[Callable[[str], None]],
+        stats: dict,
+    ) -> Optional[dict | str]:
+        """Return the cached response of a call, or None if it has to be requested."""
+        if cache_key is None or refresh_cache:
+            return None
+        cached = self.cache.get(cache_key)
+        if cached is None:
+            return None
+        logger.info("Using cached LLM response")
+        return self._replay_cached(cached, on_chunk, stats)
+
+    @staticmethod
+    def _mark_dequeued(stats: dict) -> None:
+        """Record the time spent waiting for the rate limiter and restart the clock."""
+        now = time.perf_counter()
+        stats["queue_time"] = now - stats["start"]
+        stats["start"] = now
+
+    @staticmethod
+    def _mark_slot_wait(stats: dict, wait: float) -> None:
+        """Count the time a request waited for a concurrency slot as queue time."""
+        stats["queue_time"] += wait
+        stats["start"] += wait
+
+    def _record_call(
+        self, caller: Optional[str], stats: dict, error: Optional[Exception] = None
+    ) -> None:
+        """Write the statistics of a call to the telemetry store."""
+        if self.telemetry is None:
+            return
+        if stats["latency"] is None and "start" in stats:
+            stats["latency"] = time.perf_counter() - stats["start"]
+        self.telemetry.record(
+            run_id=self.run_id,
+            stage=caller,
+            provider=stats.get("provider", self.provider),
+            model=stats.get("model", self.model_name),
+            cached=stats["cached"],
+            prompt_tokens=stats["prompt_tokens"],
+            cached_prompt_tokens=stats["cached_prompt_tokens"],
+            completion_tokens=stats["completion_tokens"],
+            queue_time=stats["queue_time"],
+            latency=stats["latency"],
+            time_to_first_token=stats["time_to_first_token"],
+            retries=stats["retries"],
+            continuations=stats["continuations"],
+            cost=0.0
+            if stats["cached"]
+            else estimate_cost(
+                stats.get("model", self.model_name),
+                stats["prompt_tokens"],
+                stats["completion_tokens"],
+                stats["cached_prompt_tokens"],
+            ),
+            stop_reason=stats["stop_reason"],
+            error=f"{type(error).__name__}: {error!s}" if error is not None else None,
+        )
+
+    @staticmethod
+    def _mark_chunk(stats: dict) -> None:
+        """Record the arrival of the first streamed chunk."""
+        if stats["time_to_first_token"] is None:
+            stats["time_to_first_token"] = time.perf_counter() - stats["start"]
+
+    def _replay_cached(
+        self,
+        cached: dict | str,
+        on_chunk: Optional[Callable[[str], None]],
+        stats: dict,
+    ) -> dict | str:
+        """Serve a cached response as if it had been streamed in one chunk."""
+        stats["cached"] = True
+        stats["latency"] = stats["time_to_first_token"] = (
+            time.perf_counter() - stats.pop("start")
+        )
+        if on_chunk is not None:
+            on_chunk(cached if isinstance(cached, str) else json.dumps(cached))
+        return cached
+
+    def _finish(self, text: str, json_response: bool, stats: dict) -> dict | str:
+        """Complete the call statistics and parse the response text."""
+        stats["latency"] = time.perf_counter() - stats.pop("start")
+        if stats["completion_tokens"] is None:
+            stats["completion_tokens"] = estimate_tokens(text)
+        # Generation speed is measured from the first token when streaming
+        generation_time = stats["latency"] - (stats["time_to_first_token"] or 0)
+        if generation_time > 0:
+            stats["tokens_per_second"] = stats["completion_tokens"] / generation_time
+        logger.info(
+            f"LLM call took {stats['latency']:.2f}s, "
+            f"{stats['completion_tokens']} completion tokens"
+            + (
+                f", {stats['cached_prompt_tokens']} prompt tokens from cache"
+                if stats["cached_prompt_tokens"]
+                else ""
+            )
+            + (
+                f", first token after {stats['time_to_first_token']:.2f}s"
+                if stats["time_to_first_token"] is not None
+                else ""
+            )
+        )
+
+        stats["provider"] = self.provider
+        stats["model"] = self.model_name
+        return self._parse_response(text, json_response)
+
+    def _parse_response(self, text: str, json_response: bool) -> dict | str:
+        """Parse response text with the provider's parser."""
+        if self.provider == "anthropic":
+            return self._parse_anthropic_response(text, json_response)
+        return self._parse_openai_response(text, json_response)
+
+    def _openai_request(
+        self,
+        prompt: str,
+        system_prompt: str,
+        json_response: bool,
+        temperature: float,
+        max_tokens: int,
+        stream: bool,
+        partial: str = "",
+        prefix: str = "",
     ) -> dict:
-        """Get response from OpenAI API."""
+        """Build keyword arguments for an OpenAI chat completion request.
+
+        OpenAI caches long prompt prefixes automatically, so the static system prompt and
+        prefix come first and the request-specific prompt last.
+        """
         messages = [
             {"role": "system", "content": system_prompt},
-            {"role": "user", "content": prompt},
+            {"role": "user", "content": prefix + prompt},
         ]
+        if partial:
+            messages.append({"role": "assistant", "content": partial})
+            messages.append({"role": "user", "content": CONTINUE_PROMPT})
+        request = {
+            "model": self.model_name,
+            "messages": messages,
+            "temperature": temperature,
+            "max_completion_tokens": max_tokens,
+        }
+        if json_response and not partial:
+            # First try with strict JSON output. Continuations of a cut off response are
+            # not valid JSON by themselves, the joined response is parsed once at the end.
+            request["response_format"] = {"type": "json_object"}
+        if stream:
+            request["stream"] = True
+            request["stream_options"] = {"include_usage": True}
+        return request
 
-        logger.info(f"Making OpenAI API call with model {self.model_name}")
+    def _handle_openai_chunk(
+        self,
+        chunk,
+        parts: list[str],
+        on_chunk: Optional[Callable[[str], None]],
+        stats: dict,
+    ) -> None:
+        """Collect the text and usage of a streamed OpenAI chunk."""
+        if chunk.usage is not None:
+            self._read_openai_usage(chunk.usage, stats)
+        if not chunk.choices:
+            return
+        if chunk.choices[0].finish_reason is not None:
+            stats["stop_reason"] = chunk.choices[0].finish_reason
+        delta = chunk.choices[0].delta.content
+        if delta:
+            self._mark_chunk(stats)
+            parts.append(delta)
+            if on_chunk is not None:
+                on_chunk(delta)
 
-        if json_response:
-            # First try with strict JSON output
-            response = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=messages,
-                temperature=temperature,
-                response_format={"type": "json_object"},
-            )
+    @staticmethod
+    def _read_openai_usage(usage, stats: dict) -> None:
+        """Collect the token usage of an OpenAI response."""
+        stats["prompt_tokens"] = usage.prompt_tokens
+        stats["completion_tokens"] = usage.completion_tokens
+        details = getattr(usage, "prompt_tokens_details", None)
+        stats["cached_prompt_tokens"] = getattr(details, "cached_tokens", None) or 0
 
-            logger.debug(
-                f"Raw OpenAI response: {response.choices[0].message.content[:200]}..."
-            )
+    @staticmethod
+    def _read_openai_completion(response, stats: dict) -> str:
+        """Collect the text and usage of a complete OpenAI response."""
+        if response.usage is not None:
+            LLMClient._read_openai_usage(response.usage, stats)
+        stats["stop_reason"] = response.choices[0].finish_reason
+        return response.choices[0].message.content
 
-            try:
-                result = json.loads(response.choices[0].message.content)
-                logger.info("Successfully parsed OpenAI response as JSON")
+    def _parse_openai_response(self, content: str, json_response: bool) -> dict | str:
+        """Parse the text of an OpenAI chat completion."""
+        logger.debug(f"Raw OpenAI response: {content[:200]}...")
+
+        if not json_response:
+            return content
+
+        try:
+            result = json.loads(content)
+            logger.info("Successfully parsed OpenAI response as JSON")
+            return result
+        except json.JSONDecodeError as e:
+            logger.warning(f"Failed to parse OpenAI response as JSON: {e!s}")
+            logger.warning("Attempting to extract JSON from response")
+
+            # If JSON parsing fails, try to extract JSON from the response
+            start_idx = content.find("{")
+            end_idx = content.rfind("}") + 1
+            if start_idx >= 0 and end_idx > start_idx:
+                json_str = content[start_idx:end_idx]
+                result = json.loads(json_str)
+                logger.info("Successfully extracted and parsed JSON from response")
                 return result
-            except json.JSONDecodeError as e:
-                logger.warning(f"Failed to parse OpenAI response as JSON: {e!s}")
-                logger.warning("Attempting to extract JSON from response")
-
-                # If JSON parsing fails, try to extract JSON from the response
-                content = response.choices[0].message.content
-                # Try to find JSON object in the response
-                start_idx = content.find("{")
-                end_idx = content.rfind("}") + 1
-                if start_idx >= 0 and end_idx > start_idx:
-                    json_str = content[start_idx:end_idx]
-                    result = json.loads(json_str)
-                    logger.info("Successfully extracted and parsed JSON from response")
-                    return result
-        else:
-            response = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=messages,
-                temperature=temperature,
-            )
-            logger.debug(
-                f"Raw OpenAI response: {response.choices[0].message.content[:200]}..."
+
+    def _get_openai_response(
+        self,
+        prompt: str,
+        system_prompt: str = "",
+        json_response: bool = True,
+        temperature: float = 0.2,
+        max_tokens: int = DEFAULT_MAX_OUTPUT_TOKENS,
+        stream: bool = False,
+        on_chunk: Optional[Callable[[str], None]] = None,
+        stats: Optional[dict] = None,
+        partial: str = "",
+        prefix: str = "",
+    ) -> str:
+        """Get response text from OpenAI API.
+
+        If ``partial`` is given, the model is asked to continue that response.
+        """
+        stats = stats if stats is not None else self._new_stats()
+        logger.info(f"Making OpenAI API call with model {self.model_name}")
+        raw = self.client.chat.completions.with_raw_response.create(
+            **self._openai_request(
+                prompt, system_prompt, json_response, temperature, max_tokens,
+                stream, partial, prefix,
             )
-            return response.choices[0].message.content
+        )
+        self.quota.update(raw.headers)
+        response = raw.parse()
+        if not stream:
+            return self._read_openai_completion(response, stats)
 
-    def _get_anthropic_response(
+        parts = []
+        for chunk in response:
+            self._handle_openai_chunk(chunk, parts, on_chunk, stats)
+        return "".join(parts)
+
+    async def _aget_openai_response(
         self,
         prompt: str,
         system_prompt: str = "",
         json_response: bool = True,
         temperature: float = 0.2,
-        max_tokens: int = 1000,
-    ) -> dict | str:
-        """Get response from Anthropic API."""
-        system_prompt = """{system_prompt}
+        max_tokens: int = DEFAULT_MAX_OUTPUT_TOKENS,
+        stream: bool = False,
+        on_chunk: Optional[Callable[[str], None]] = None,
+        stats: Optional[dict] = None,
+        partial: str = "",
+        prefix: str = "",
+    ) -> str:
+        """Get response text from OpenAI API asynchronously.
 
-        Human: {prompt}
+        If ``partial`` is given, the model is asked to continue that response.
+        """
+        stats = stats if stats is not None else self._new_stats()
+        logger.info(f"Making async OpenAI API call with model {self.model_name}")
+        raw = await self.async_client.chat.completions.with_raw_response.create(
+            **self._openai_request(
+                prompt, system_prompt, json_response, temperature, max_tokens,
+                stream, partial, prefix,
+            )
+        )
+        self.quota.update(raw.headers)
+        response = raw.parse()
+        if not stream:
+            return self._read_openai_completion(response, stats)
 
-        Assistant: Here are my responses:"""
+        parts = []
+        async for chunk in response:
+            self._handle_openai_chunk(chunk, parts, on_chunk, stats)
+        return "".join(parts)
 
-        logger.info(f"Making Anthropic API call with model {self.model_name}")
+    def _anthropic_request(
+        self,
+        prompt: str,
+        system_prompt: str,
+        temperature: float,
+        max_tokens: int,
+        partial: str = "",
+        prefix: str = "",
+    ) -> dict:
+        """Build keyword arguments for an Anthropic messages request.
 
-        response = self.client.messages.create(
-            model=self.model_name,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            messages=[
+        The system prompt and prefix are marked as cache breakpoints, so repeated requests
+        read them from Anthropic's prompt cache. Prefixes shorter than the model's
+        minimum cacheable length are processed normally.
+        """
+        content = []
+        if prefix:
+            content.append(
+                {"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}}
+            )
+        if prompt:
+            content.append({"type": "text", "text": prompt})
+        messages = [{"role": "user", "content": content}]
+        if partial:
+            # Prefill the assistant turn so the model continues where it stopped. The
+            # API rejects prefills that end in whitespace.
+            messages.append({"role": "assistant", "content": partial.rstrip()})
+        request = {
+            "model": self.model_name,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "messages": messages,
+        }
+        if system_prompt:
+            request["system"] = [
                 {
-                    "role": "user",
-                    "content": system_prompt.format(
-                        prompt=prompt, system_prompt=system_prompt
-                    ),
+                    "type": "text",
+                    "text": system_prompt,
+                    "cache_control": {"type": "ephemeral"},
                 }
-            ],
+            ]
+        return request
+
+    @staticmethod
+    def _read_anthropic_message(message, stats: dict) -> str:
+        """Collect the text and usage of a complete Anthropic message."""
+        usage = message.usage
+        cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+        cache_write = getattr(usage, "cache_creation_input_tokens", None) or 0
+        # Anthropic counts cached and uncached input tokens separately
+        stats["prompt_tokens"] = usage.input_tokens + cache_read + cache_write
+        stats["cached_prompt_tokens"] = cache_read
+        stats["completion_tokens"] = usage.output_tokens
+        stats["stop_reason"] = message.stop_reason
+        return "".join(
+            block.text for block in message.content if block.type == "text"
         )
 
-        logger.debug(f"Raw Anthropic response: {response.content[0].text[:200]}...")
+    def _parse_anthropic_response(self, text: str, json_response: bool) -> dict | str:
+        """Parse the text of an Anthropic message."""
+        logger.debug(f"Raw Anthropic response: {text[:200]}...")
 
         if json_response:
             # Extract JSON from the response
-            json_str = response.content[0].text
+            json_str = text
             # Find the start of the JSON object
             start_idx = json_str.find("{")
             if start_idx == -1:
@@ -185,4 +1716,79 @@ class LLMClient:
             result = json.loads(json_str)
             logger.info("Successfully parsed Anthropic response as JSON")
             return result
-        return response.content[0].text
+        return text
+
+    def _get_anthropic_response(
+        self,
+        prompt: str,
+        system_prompt: str = "",
+        json_response: bool = True,
+        temperature: float = 0.2,
+        max_tokens: int = DEFAULT_MAX_OUTPUT_TOKENS,
+        stream: bool = False,
+        on_chunk: Optional[Callable[[str], None]] = None,
+        stats: Optional[dict] = None,
+        partial: str = "",
+        prefix: str = "",
+    ) -> str:
+        """Get response text from Anthropic API.
+
+        If ``partial`` is given, the model continues that response. Requests for more than
+        ``ANTHROPIC_NONSTREAMING_MAX_TOKENS`` are streamed even if ``stream`` is False.
+        """
+        stats = stats if stats is not None else self._new_stats()
+        logger.info(f"Making Anthropic API call with model {self.model_name}")
+        request = self._anthropic_request(
+            prompt, system_prompt, temperature, max_tokens, partial, prefix
+        )
+        if not stream and max_tokens <= ANTHROPIC_NONSTREAMING_MAX_TOKENS:
+            raw = self.client.messages.with_raw_response.create(**request)
+            self.quota.update(raw.headers)
+            return self._read_anthropic_message(raw.parse(), stats)
+
+        with self.client.messages.stream(**request) as response:
+            self.quota.update(response.response.headers)
+            if stream:
+                for delta in response.text_stream:
+                    self._mark_chunk(stats)
+                    if on_chunk is not None:
+                        on_chunk(delta)
+            message = response.get_final_message()
+        return self._read_anthropic_message(message, stats)
+
+    async def _aget_anthropic_response(
+        self,
+        prompt: str,
+        system_prompt: str = "",
+        json_response: bool = True,
+        temperature: float = 0.2,
+        max_tokens: int = DEFAULT_MAX_OUTPUT_TOKENS,
+        stream: bool = False,
+        on_chunk: Optional[Callable[[str], None]] = None,
+        stats: Optional[dict] = None,
+        partial: str = "",
+        prefix: str = "",
+    ) -> str:
+        """Get response text from Anthropic API asynchronously.
+
+        If ``partial`` is given, the model continues that response.
+        """
+        stats = stats if stats is not None else self._new_stats()
+        logger.info(f"Making async Anthropic API call with model {self.model_name}")
+        request = self._anthropic_request(
+            prompt, system_prompt, temperature, max_tokens, partial, prefix
+        )
+        if not stream and max_tokens <= ANTHROPIC_NONSTREAMING_MAX_TOKENS:
+            raw = await self.async_client.messages.with_raw_response.create(**request)
+            self.quota.update(raw.headers)
+            return self._read_anthropic_message(raw.parse(), stats)
+
+        async with self.async_client.messages.stream(**request) as response:
+            self.quota.update(response.response.headers)
+            if stream:
+                async for delta in response.text_stream:
+                    self._mark_chunk(stats)
+                    if on_chunk is not None:
+                        on_chunk(delta)
+            message = await response.get_final_message()
+        return self._read_anthropic_message(message, stats)
@@ -0,0 +1,201 @@
+"""Local store of per-call LLM telemetry."""
+
+import logging
+import os
+import sqlite3
+import time
+from contextlib import closing
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TELEMETRY_PATH = (
+    Path(os.getenv("POND_AGENT_CACHE_DIR", Path.home() / ".cache" / "pond_agent"))
+    / "telemetry.sqlite"
+)
+
+# USD per million (input, output) tokens, matched by model name prefix (longest wins)
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4.1-nano": (0.1, 0.4),
+    "gpt-4.1-mini": (0.4, 1.6),
+    "gpt-4.1": (2.0, 8.0),
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-3.5-turbo": (0.5, 1.5),
+    "o1-mini": (1.1, 4.4),
+    "o1": (15.0, 60.0),
+    "o3-mini": (1.1, 4.4),
+    "o3": (2.0, 8.0),
+    "claude-3-haiku": (0.25, 1.25),
+    "claude-3-5-haiku": (0.8, 4.0),
+    "claude-3-5-sonnet": (3.0, 15.0),
+    "claude-3-7-sonnet": (3.0, 15.0),
+    "claude-sonnet-4": (3.0, 15.0),
+    "claude-3-opus": (15.0, 75.0),
+    "claude-opus-4": (15.0, 75.0),
+}
+
+# Price of prompt tokens read from the provider's prompt cache, relative to uncached ones
+CACHED_INPUT_DISCOUNT = {"claude": 0.1, "": 0.5}
+
+COLUMNS = [
+    "timestamp",
+    "run_id",
+    "stage",
+    "provider",
+    "model",
+    "cached",
+    "prompt_tokens",
+    "cached_prompt_tokens",
+    "completion_tokens",
+    "queue_time",
+    "latency",
+    "time_to_first_token",
+    "retries",
+    "continuations",
+    "cost",
+    "stop_reason",
+    "error",
+]
+
+
+def estimate_cost(
+    model_name: str,
+    prompt_tokens: Optional[int],
+    completion_tokens: Optional[int],
+    cached_prompt_tokens: Optional[int] = None,
+) -> Optional[float]:
+    """Estimate the cost of a call in USD, or None if the model's price is unknown.
+
+    ``cached_prompt_tokens`` of the ``prompt_tokens`` were read from the prompt cache and
+    are billed at a discount.
+    """
+    matches = [prefix for prefix in MODEL_PRICES if model_name.startswith(prefix)]
+    if not matches:
+        return None
+    input_price, output_price = MODEL_PRICES[max(matches, key=len)]
+    discount = CACHED_INPUT_DISCOUNT[
+        max((p for p in CACHED_INPUT_DISCOUNT if model_name.startswith(p)), key=len)
+    ]
+    cached = cached_prompt_tokens or 0
+    return (
+        ((prompt_tokens or 0) - cached + cached * discount) * input_price
+        + (completion_tokens or 0) * output_price
+    ) / 1e6
+
+
+class TelemetryStore:
+    """SQLite store holding one record per LLM call.
+
+    Several processes can write to the same store; SQLite serializes the inserts.
+    """
+
+    def __init__(self, path: Optional[str | Path] = None) -> None:
+        """Initialize telemetry store.
+
+        Args:
+            path: Path of the SQLite database (default: ~/.cache/pond_agent/telemetry.sqlite)
+
+        """
+        self.path = Path(path or DEFAULT_TELEMETRY_PATH)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_calls ("
+                "timestamp REAL, run_id TEXT, stage TEXT, provider TEXT, model TEXT, "
+                "cached INTEGER, prompt_tokens INTEGER, cached_prompt_tokens INTEGER, "
+                "completion_tokens INTEGER, "
+                "queue_time REAL, latency REAL, time_to_first_token REAL, "
+                "retries INTEGER, continuations INTEGER, cost REAL, stop_reason TEXT, "
+                "error TEXT)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_run_stage ON llm_calls (run_id, stage)"
+            )
+            # Add columns introduced after the store was created
+            existing = {row[1] for row in conn.execute("PRAGMA table_info(llm_calls)")}
+            for column in COLUMNS:
+                if column not in existing:
+                    conn.execute(f"ALTER TABLE llm_calls ADD COLUMN {column}")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def record(self, **fields) -> None:
+        """Insert one call record. Unknown fields are ignored, missing ones stored as NULL."""
+        fields.setdefault("timestamp", time.time())
+        values = [fields.get(column) for column in COLUMNS]
+        try:
+            with closing(self._connect()) as conn:
+                conn.execute(
+                    f"INSERT INTO llm_calls ({', '.join(COLUMNS)}) "
+                    f"VALUES ({', '.join('?' * len(COLUMNS))})",
+                    values,
+                )
+        except sqlite3.Error as e:
+            # Telemetry must never break the pipeline
+            logger.warning(f"Failed to record LLM telemetry: {e!s}")
+
+    def load(self, run_id: Optional[str] = None) -> pd.DataFrame:
+        """Load call records, optionally restricted to one run."""
+        query = f"SELECT {', '.join(COLUMNS)} FROM llm_calls"
+        params = ()
+        if run_id is not None:
+            query += " WHERE run_id = ?"
+            params = (run_id,)
+        with closing(self._connect()) as conn:
+            return pd.read_sql_query(query, conn, params=params)
+
+    def summarize(self, run_id: Optional[str] = None) -> pd.DataFrame:
+        """Summarize latency, tokens and cost per pipeline stage.
+
+        Args:
+            run_id: Only summarize calls of this run (default: all runs)
+
+        Returns:
+            DataFrame indexed by stage with call counts, p50/p95 latency and queue time,
+            token totals including prompt cache hits, retries and estimated cost
+        """
+        calls = self.load(run_id)
+        if calls.empty:
+            return pd.DataFrame()
+        calls["stage"] = calls["stage"].fillna("unknown")
+        grouped = calls.groupby("stage")
+        summary = pd.DataFrame(
+            {
+                "calls": grouped.size(),
+                "cached_calls": grouped["cached"].sum(),
+                "errors": grouped["error"].count(),
+                "p50_latency": grouped["latency"].quantile(0.5),
+                "p95_latency": grouped["latency"].quantile(0.95),
+                "p50_queue_time": grouped["queue_time"].quantile(0.5),
+                "p95_queue_time": grouped["queue_time"].quantile(0.95),
+                "total_latency": grouped["latency"].sum(),
+                "prompt_tokens": grouped["prompt_tokens"].sum(),
+                "cached_prompt_tokens": grouped["cached_prompt_tokens"].sum(),
+                "completion_tokens": grouped["completion_tokens"].sum(),
+                "retries": grouped["retries"].sum(),
+                "cost": grouped["cost"].sum(),
+            }
+        )
+        return summary.sort_values("total_latency", ascending=False)
+
+
+def summarize_telemetry(
+    path: Optional[str | Path] = None, run_id: Optional[str] = None
+) -> pd.DataFrame:
+    """Summarize latency, tokens and cost per pipeline stage across runs.
+
+    Args:
+        path: Path of the telemetry database (default: ~/.cache/pond_agent/telemetry.sqlite)
+        run_id: Only summarize calls of this run (default: all runs)
+
+    Returns:
+        DataFrame indexed by stage, see :meth:`TelemetryStore.summarize`
+    """
+    return TelemetryStore(path).summarize(run_id)
@@ -1,36 +1,547 @@
+import codecs
+import contextlib
+import logging
+import math
 import os
+import signal
 import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
 
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where the CPU time cap is not enforced
+    resource = None
 
-def run_python_script(script_path: str, env: dict = None, logger = None) -> None:
+if TYPE_CHECKING:
+    from .worker_pool import WorkerPool
+
+
+# Environment variables capping the thread pools of common data science libraries
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "POLARS_MAX_THREADS",
+    "RAYON_NUM_THREADS",
+)
+# Seconds between checks of the wall time and memory of a running script
+MONITOR_INTERVAL = 0.25
+# Characters of stderr kept in memory, from its start and its end. The full output of a
+# run is written to log files next to the script.
+STDERR_HEAD_CHARS = 4_000
+STDERR_TAIL_CHARS = 16_000
+# Longest line kept whole, longer lines (e.g. progress bars without newlines) are split
+MAX_LINE_CHARS = 2_000
+READ_SIZE = 65_536
+# Runner of scripts with cell checkpoints, run as a script
+CELL_RUNNER = Path(__file__).parent / "cells.py"
+# Seconds to wait for the output of a finished script, which its own subprocesses can
+# keep open
+DRAIN_TIMEOUT = 5
+
+
+def thread_limit_env(max_threads: Optional[int], env: Optional[dict] = None) -> dict:
+    """Return a copy of an environment with the thread pools capped to ``max_threads``."""
+    env = dict(os.environ if env is None else env)
+    if max_threads:
+        env.update(dict.fromkeys(THREAD_ENV_VARS, str(max_threads)))
+    return env
+
+
+def _process_group_rss(pgid: int) -> Optional[int]:
+    """Total resident memory in bytes of a process group, or None without /proc."""
+    proc = Path("/proc")
+    if not proc.is_dir():
+        return None
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    total = 0
+    for entry in proc.iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            # The process group is the 5th field of stat, after the parenthesized name
+            stat = (entry / "stat").read_text()
+            if int(stat.rsplit(")", 1)[1].split()[2]) != pgid:
+                continue
+            total += int((entry / "statm").read_text().split()[1]) * page_size
+        except (OSError, ValueError, IndexError):
+            continue
+    return total
+
+
+class _ResourceMonitor:
+    """Enforce the wall-clock timeout and memory cap of a running script.
+
+    The script runs in its own process group, which is killed as a whole when a limit
+    is exceeded. Memory is the total resident memory of the group, polled from /proc,
+    so it is only capped on Linux.
+    """
+
+    def __init__(
+        self,
+        timeout: Optional[float],
+        max_memory_mb: Optional[float],
+        cancel: Optional[threading.Event] = None,
+    ) -> None:
+        self.timeout = timeout
+        self.max_memory = max_memory_mb * 2**20 if max_memory_mb else None
+        self.cancel = cancel
+        self.limit = None
+        self.cancelled = False
+        self.peak_rss = 0
+        self.start_time = time.perf_counter()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self, pid: int) -> None:
+        """Start monitoring the process group led by ``pid``."""
+        # E.g. a warm worker's imports before the run are not counted
+        self.start_time = time.perf_counter()
+        self._thread = threading.Thread(target=self._watch, args=(pid,), daemon=True)
+        self._thread.start()
+
+    def _watch(self, pgid: int) -> None:
+        while not self._stopped.wait(MONITOR_INTERVAL):
+            rss = _process_group_rss(pgid)
+            self.peak_rss = max(self.peak_rss, rss or 0)
+            if self.cancel is not None and self.cancel.is_set():
+                self.cancelled = True
+            elif self.timeout and time.perf_counter() - self.start_time > self.timeout:
+                self.limit = "timeout"
+            elif self.max_memory and rss and rss > self.max_memory:
+                self.limit = "memory"
+            if self.limit or self.cancelled:
+                with contextlib.suppress(ProcessLookupError, PermissionError):
+                    os.killpg(pgid, signal.SIGKILL)
+                return
+
+    def stop(self) -> float:
+        """Stop monitoring and return the wall time in seconds."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        return time.perf_counter() - self.start_time
+
+
+def _usage_from_rusage(rusage: Optional[dict]) -> dict:
+    """Resource usage figures from the rusage of a finished script."""
+    if not rusage:
+        return {"cpu_time": None, "peak_rss_mb": None, "read_mb": None, "write_mb": None}
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere, I/O is in 512-byte blocks
+    maxrss = rusage["maxrss"] if sys.platform == "darwin" else rusage["maxrss"] * 1024
+    return {
+        "cpu_time": rusage["utime"] + rusage["stime"],
+        "peak_rss_mb": maxrss / 2**20,
+        "read_mb": rusage["inblock"] * 512 / 2**20,
+        "write_mb": rusage["oublock"] * 512 / 2**20,
+    }
+
+
+def _rusage_dict(rusage) -> dict:
+    """Convert a ``resource.struct_rusage`` to the dictionary used for accounting."""
+    return {
+        "utime": rusage.ru_utime,
+        "stime": rusage.ru_stime,
+        "maxrss": rusage.ru_maxrss,
+        "inblock": rusage.ru_inblock,
+        "oublock": rusage.ru_oublock,
+    }
+
+
+def describe_limit(usage: dict, limits: dict) -> str:
+    """Describe which limit stopped a script, e.g. 'memory cap of 4096 MB'."""
+    return {
+        "timeout": f"wall-clock timeout of {limits.get('timeout')}s",
+        "memory": f"memory cap of {limits.get('max_memory_mb')} MB",
+        "cpu": f"CPU time cap of {limits.get('max_cpu_seconds')}s",
+    }[usage["limit"]]
+
+
+class OutputBuffer:
+    """Bounded buffer of the lines of a stream, keeping its head and tail.
+
+    Lines are kept from the start until ``head_chars`` is reached, then only the most
+    recent ``tail_chars`` characters are kept. The first error messages and the final
+    traceback thus survive arbitrarily long output.
+    """
+
+    def __init__(
+        self, head_chars: int = STDERR_HEAD_CHARS, tail_chars: int = STDERR_TAIL_CHARS
+    ) -> None:
+        self.head_chars = head_chars
+        self.tail_chars = tail_chars
+        self.head = []
+        self.head_size = 0
+        self.tail = deque()
+        self.tail_size = 0
+        self.omitted = 0
+
+    def append(self, line: str) -> None:
+        """Append a line, including its newline."""
+        if not self.tail and self.head_size + len(line) <= self.head_chars:
+            self.head.append(line)
+            self.head_size += len(line)
+            return
+        self.tail.append(line)
+        self.tail_size += len(line)
+        while self.tail_size > self.tail_chars and len(self.tail) > 1:
+            self.tail_size -= len(self.tail.popleft())
+            self.omitted += 1
+
+    def text(self, log_path: Optional[Path] = None) -> str:
+        """Buffered text, with a note where lines were dropped."""
+        if not self.omitted:
+            return "".join(self.head) + "".join(self.tail)
+        where = f", full output in {log_path}" if log_path else ""
+        note = f"... [{self.omitted} lines omitted{where}] ...\n"
+        return "".join(self.head) + note + "".join(self.tail)
+
+
+def _split_lines(text: str) -> tuple[list[str], str]:
+    """Split decoded output into complete lines and the pending partial line.
+
+    Carriage returns overwrite the line, as in a terminal, so only the final state of a
+    progress bar is kept.
+    """
+    *lines, pending = text.split("\n")
+    lines = [line.rstrip("\r").rsplit("\r", 1)[-1] for line in lines]
+    if "\r" in pending[:-1]:
+        pending = pending[pending.rindex("\r", 0, len(pending) - 1) + 1 :]
+    while len(pending) > MAX_LINE_CHARS:
+        lines.append(pending[:MAX_LINE_CHARS])
+        pending = pending[MAX_LINE_CHARS:]
+    return lines, pending
+
+
+class _StreamReader:
+    """Drain a stream in a thread, writing it to a log file and passing on its lines."""
+
+    def __init__(self, stream, log_path: Optional[Path], on_line) -> None:
+        self.stream = stream
+        self.log_path = log_path
+        self.on_line = on_line
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+
+    def _drain(self) -> None:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        log_file = None
+        if self.log_path is not None:
+            try:
+                log_file = open(self.log_path, "wb")  # noqa: SIM115
+            except OSError as e:
+                logging.getLogger(__name__).warning(f"Cannot write {self.log_path}: {e!s}")
+                self.log_path = None
+        pending = ""
+        try:
+            while chunk := self.stream.read(READ_SIZE):
+                if log_file is not None:
+                    log_file.write(chunk)
+                lines, pending = _split_lines(pending + decoder.decode(chunk))
+                for line in lines:
+                    self.on_line(line)
+            pending += decoder.decode(b"", final=True)
+            if pending.rstrip("\r"):
+                self.on_line(pending.rstrip("\r").rsplit("\r", 1)[-1])
+        except (OSError, ValueError):
+            # The stream was closed after the script finished
+            pass
+        finally:
+            if log_file is not None:
+                log_file.close()
+
+    def join(self) -> None:
+        self._thread.join(DRAIN_TIMEOUT)
+        if self._thread.is_alive():
+            logging.getLogger(__name__).warning(
+                "Output stream still open after the script finished, not reading it further"
+            )
+        self.stream.close()
+
+
+class _OutputCapture:
+    """Concurrently drain the stdout and stderr of a script.
+
+    Both streams are read by their own thread as soon as the script starts, so a script
+    filling one pipe while the other is not being read cannot block. Stdout is streamed
+    to a logger, stderr is kept in a bounded :class:`OutputBuffer`, and both are written
+    in full to ``<script>.stdout.log`` and ``<script>.stderr.log`` next to the script.
+    """
+
+    def __init__(self, script_path: str | Path, stdout, stderr, logger) -> None:
+        script_path = Path(script_path)
+        self.stderr_log = script_path.with_suffix(".stderr.log")
+        self.buffer = OutputBuffer()
+
+        def log_stdout(line: str) -> None:
+            if logger:
+                logger.info(line)
+            else:
+                print(line)
+
+        self._readers = [
+            _StreamReader(stdout, script_path.with_suffix(".stdout.log"), log_stdout),
+            _StreamReader(stderr, self.stderr_log, lambda line: self.buffer.append(line + "\n")),
+        ]
+
+    def finish(self) -> str:
+        """Wait for the streams to be drained and return the buffered stderr."""
+        for reader in self._readers:
+            reader.join()
+        return self.buffer.text(self._readers[1].log_path)
+
+
+def run_python_script(
+    script_path: str,
+    env: dict = None,
+    logger = None,
+    pool: Optional["WorkerPool"] = None,
+    limits: Optional[dict] = None,
+    return_usage: bool = False,
+    checkpoint_dir: Optional[str | Path] = None,
+    cancel: Optional[threading.Event] = None,
+) -> tuple[int, str] | tuple[int, str, dict]:
     """Run Python script.
 
     Args:
         script_path: Path to Python script
+        env: Environment of the script (default: the current environment)
+        logger: Logger the script's stdout is streamed to. If None, it is printed
+        pool: Optional pool of warm workers to run the script in, which saves the
+            interpreter start and library imports. Falls back to a new process if the
+            pool is not available on this platform
+        limits: Optional resource limits of the script:
+            - timeout: Wall-clock time in seconds
+            - max_memory_mb: Resident memory of the script and its subprocesses in MB
+              (enforced on Linux)
+            - max_cpu_seconds: CPU time in seconds, enforced with RLIMIT_CPU
+            - max_threads: Threads of the common numeric libraries' thread pools, set
+              with their environment variables
+            A script exceeding a limit is killed and fails with a message in stderr
+        return_usage: Also return the resource usage of the script
+        checkpoint_dir: If set, the script is run cell by cell with checkpoints in this
+            directory, and resumes from the first changed cell when it is run again
+            after a fix, see :mod:`pond_agent.cells`
+        cancel: Optional event that kills the script when set, e.g. once a competing
+            run has succeeded
+
+    Both output streams are drained concurrently while the script runs. The full output
+    is written to ``<script>.stdout.log`` and ``<script>.stderr.log`` next to the script,
+    and the returned stderr keeps only its start and end if it is long.
+
+    Returns:
+        Return code and stderr of the script, and if ``return_usage``, a dictionary with
+        its wall time and CPU time in seconds, peak resident memory, megabytes read and
+        written, the limit it exceeded ('timeout', 'memory', 'cpu' or None) and whether
+        it was cancelled
 
     """
+    limits = limits or {}
     if env is None:
         env = os.environ.copy()
+    if limits.get("max_threads"):
+        env = thread_limit_env(limits["max_threads"], env)
+
+    # The script itself, or the cell runner with the script as its arguments
+    command = [str(script_path)]
+    if checkpoint_dir is not None:
+        command = [str(CELL_RUNNER), str(script_path), str(checkpoint_dir)]
+
+    monitor = _ResourceMonitor(limits.get("timeout"), limits.get("max_memory_mb"), cancel)
+    returncode = stderr = rusage = None
+    if pool is not None and pool.available:
+        try:
+            returncode, stderr, rusage = _run_in_pool(
+                script_path, command, env, logger, pool, limits.get("max_cpu_seconds"), monitor
+            )
+        except RuntimeError as e:
+            logging.getLogger(__name__).warning(
+                f"{e!s}, running {Path(script_path).name} in a new process"
+            )
+
+    if returncode is None:
+        returncode, stderr, rusage = _run_subprocess(
+            script_path, command, env, logger, limits.get("max_cpu_seconds"), monitor
+        )
+    wall_time = monitor.stop()
+
+    usage = {
+        "wall_time": wall_time,
+        **_usage_from_rusage(rusage),
+        "limit": monitor.limit,
+        "cancelled": monitor.cancelled,
+    }
+    if monitor.peak_rss:
+        # ru_maxrss can include the memory of the parent at fork time, so the sampled
+        # total of the process group is preferred for scripts running long enough
+        usage["peak_rss_mb"] = monitor.peak_rss / 2**20
+    # The CPU time cap kills the script with SIGXCPU, or SIGKILL at the hard limit
+    max_cpu_seconds = limits.get("max_cpu_seconds")
+    if usage["limit"] is None and not monitor.cancelled and max_cpu_seconds and returncode < 0:
+        cpu_signal = getattr(signal, "SIGXCPU", None)
+        if -returncode == cpu_signal or (usage["cpu_time"] or 0) >= max_cpu_seconds:
+            usage["limit"] = "cpu"
+    if usage["limit"] is not None:
+        stderr += f"\nScript was killed after exceeding the {describe_limit(usage, limits)}\n"
+    elif monitor.cancelled:
+        stderr += "\nScript was cancelled\n"
+
+    if return_usage:
+        return returncode, stderr, usage
+    return returncode, stderr
+
+
+def _run_in_pool(
+    script_path: str,
+    command: list[str],
+    env: dict,
+    logger,
+    pool: "WorkerPool",
+    cpu_seconds: Optional[float],
+    monitor: _ResourceMonitor,
+) -> tuple[int, str, Optional[dict]]:
+    """Run a script in a warm worker, returning its return code, stderr and rusage."""
+    stdout_read, stdout_write = os.pipe()
+    stderr_read, stderr_write = os.pipe()
+    try:
+        run = pool.start(
+            command[0], env, stdout_write, stderr_write, cpu_seconds, tuple(command[1:])
+        )
+    except RuntimeError:
+        for fd in (stdout_read, stdout_write, stderr_read, stderr_write):
+            os.close(fd)
+        raise
+    # The child has its own copies, the streams end when it and its subprocesses exit
+    os.close(stdout_write)
+    os.close(stderr_write)
+    monitor.start(run.pid)
+    capture = _OutputCapture(
+        script_path,
+        open(stdout_read, "rb", buffering=0),  # noqa: SIM115
+        open(stderr_read, "rb", buffering=0),  # noqa: SIM115
+        logger,
+    )
+    returncode, rusage = run.wait()
+    return returncode, capture.finish(), rusage
+
+
+def _run_subprocess(
+    script_path: str,
+    command: list[str],
+    env: dict,
+    logger,
+    cpu_seconds: Optional[float],
+    monitor: _ResourceMonitor,
+) -> tuple[int, str, Optional[dict]]:
+    """Run a script in a new interpreter, returning its return code, stderr and rusage."""
+
+    def set_cpu_limit() -> None:
+        seconds = math.ceil(cpu_seconds)
+        # The soft limit sends SIGXCPU, the hard limit a few seconds later SIGKILL
+        resource.setrlimit(resource.RLIMIT_CPU, (seconds, seconds + 5))
 
     process = subprocess.Popen(  # noqa: S603
-        ["python", str(script_path)],  # noqa: S607
+        ["python", *command],  # noqa: S607
         env=env,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
-        text=True,
-        bufsize=1,  # Line-buffered output
+        bufsize=0,
+        # Own process group, so that the script and its subprocesses can be killed
+        start_new_session=os.name == "posix",
+        preexec_fn=set_cpu_limit if cpu_seconds and resource is not None else None,  # noqa: PLW1509
     )
-    for line in process.stdout:
-        if logger:
-            logger.info(line.rstrip("\n"))
-        else:
-            print(line.rstrip("\n"))
+    if os.name == "posix":
+        monitor.start(process.pid)
+    capture = _OutputCapture(script_path, process.stdout, process.stderr, logger)
 
-    process.stdout.close()
-    returncode = process.wait()
+    rusage = None
+    if hasattr(os, "wait4"):
+        _, status, ru = os.wait4(process.pid, 0)
+        process.returncode = returncode = os.waitstatus_to_exitcode(status)
+        rusage = _rusage_dict(ru)
+    else:
+        returncode = process.wait()
 
-    # Read any remaining stderr output
-    stderr = process.stderr.read()
-    process.stderr.close()
+    return returncode, capture.finish(), rusage
 
-    return returncode, stderr
+
+class ScriptStreamWriter:
+    """Write a generated script to disk while the LLM completion is streamed.
+
+    A leading markdown fence is dropped as soon as it is complete, so the partial file can
+    be inspected before the stream ends. Use as a context manager and pass :meth:`write`
+    as the ``on_chunk`` callback of ``LLMClient.get_response``.
+    """
+
+    def __init__(
+        self,
+        script_path: str | Path,
+        logger: Optional[logging.Logger] = None,
+        log_every: int = 2000,
+    ) -> None:
+        """Initialize script writer.
+
+        Args:
+            script_path: Path of the script to write
+            logger: Logger for progress messages
+            log_every: Number of characters between progress messages
+
+        """
+        self.script_path = Path(script_path)
+        self.logger = logger or logging.getLogger(__name__)
+        self.log_every = log_every
+        self.parts = []
+        self.size = 0
+        self._pending = ""
+        self._started = False
+        self._file = None
+
+    def __enter__(self) -> "ScriptStreamWriter":
+        self._file = open(self.script_path, "w")  # noqa: SIM115
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if self._pending and self._started:
+            self._file.write(self._pending)
+        self._file.close()
+        self.logger.info(f"Received {self.size} characters of {self.script_path.name}")
+
+    @property
+    def text(self) -> str:
+        """Text received so far."""
+        return "".join(self.parts)
+
+    def write(self, chunk: str) -> None:
+        """Append a streamed chunk to the script file."""
+        self.parts.append(chunk)
+        previous_size = self.size
+        self.size += len(chunk)
+        self._pending += chunk
+
+        if not self._started:
+            head = self._pending.lstrip()
+            if not head:
+                return
+            if head.startswith("```") or "```".startswith(head):
+                # Wait until the whole fence line (e.g. ```python) has arrived
+                if "\n" not in head:
+                    return
+                head = head.split("\n", 1)[1]
+            self._pending = head
+            self._started = True
+
+        self._file.write(self._pending)
+        self._file.flush()
+        self._pending = ""
+        if self.size // self.log_every > previous_size // self.log_every:
+            self.logger.info(
+                f"Received {self.size} characters of {self.script_path.name} so far"
+            )
@@ -0,0 +1,357 @@
+"""Pre-warmed worker processes that run Python scripts without interpreter cold starts.
+
+A worker imports the heavy libraries once, then forks a child per script, so every run
+starts with the libraries already imported and still runs in its own process. The
+worker receives each request, together with the file descriptors of the child's stdout
+and stderr, over a Unix socket. Workers need ``os.fork`` and file descriptor passing, so
+they are only available on POSIX systems.
+
+This module only uses the standard library, as workers run it directly as a script.
+"""
+
+import atexit
+import json
+import logging
+import os
+import math
+import queue
+import runpy
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from pathlib import Path
+from typing import Optional
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# Libraries imported by the workers before forking, skipped if not installed
+DEFAULT_PRELOAD = (
+    "numpy",
+    "pandas",
+    "polars",
+    "pyarrow",
+    "pyarrow.parquet",
+    "sklearn",
+    "xgboost",
+    "lightgbm",
+    "catboost",
+    "torch",
+)
+MAX_MESSAGE_SIZE = 1 << 20
+
+
+def workers_available() -> bool:
+    """Check whether the platform supports forking workers."""
+    return hasattr(os, "fork") and hasattr(socket, "send_fds")
+
+
+class WorkerPool:
+    """Pool of pre-warmed worker processes running Python scripts.
+
+    Each run is forked from a worker that has already imported the ``preload``
+    libraries. Workers are started in the background on creation, so their imports
+    overlap with e.g. the generation of the first script, and are restarted if they die.
+    Libraries are imported but not used before forking, so that no thread pools are
+    started in the parent. Environment variables that libraries only read on import,
+    such as thread counts, must therefore be set in ``env`` when the pool is created.
+    """
+
+    def __init__(
+        self,
+        size: int = 1,
+        preload: tuple[str, ...] = DEFAULT_PRELOAD,
+        env: Optional[dict] = None,
+    ) -> None:
+        """Initialize worker pool.
+
+        Args:
+            size: Number of workers, i.e. of scripts that can run concurrently
+            preload: Modules imported by the workers before forking
+            env: Environment of the workers (default: the current environment)
+
+        """
+        self.size = size
+        self.preload = preload
+        self.env = env
+        self._idle = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        self._closed = False
+        if workers_available():
+            for _ in range(size):
+                self._idle.put(self._start_worker())
+        else:
+            logger.warning("Warm workers need os.fork, scripts run in new processes")
+
+    def _start_worker(self) -> "_Worker":
+        worker = _Worker(self.preload, self.env)
+        with self._lock:
+            self._workers.append(worker)
+        return worker
+
+    @property
+    def available(self) -> bool:
+        """Whether scripts can be run in the pool's workers."""
+        return not self._closed and workers_available()
+
+    def start(
+        self,
+        script_path: str | Path,
+        env: dict,
+        stdout: int,
+        stderr: int,
+        cpu_seconds: Optional[float] = None,
+        args: tuple[str, ...] = (),
+    ) -> "WorkerRun":
+        """Start a Python script in a child forked from a warm worker.
+
+        The child writes to the given file descriptors, typically the write ends of
+        pipes, which the caller can close once the run has started.
+
+        Args:
+            script_path: Path to Python script
+            env: Environment of the script
+            stdout: File descriptor the child's stdout is redirected to
+            stderr: File descriptor the child's stderr is redirected to
+            cpu_seconds: Optional CPU time limit of the script, set with RLIMIT_CPU
+            args: Command line arguments of the script
+
+        Returns:
+            Handle of the run, whose process ID is also its process group ID
+
+        Raises:
+            RuntimeError: If the pool is closed, the platform has no ``os.fork`` or the
+                worker failed to start
+        """
+        if not self.available:
+            raise RuntimeError("Worker pool is not available")
+        worker = self._idle.get()
+        try:
+            if not worker.alive():
+                worker.close()
+                with self._lock:
+                    self._workers.remove(worker)
+                worker = self._start_worker()
+            pid = worker.start(script_path, env, stdout, stderr, cpu_seconds, args)
+        except (ConnectionError, OSError, ValueError, KeyError) as e:
+            self._idle.put(worker)
+            raise RuntimeError(f"Warm worker failed to start: {e!s}") from e
+        return WorkerRun(self, worker, pid)
+
+    def close(self) -> None:
+        """Stop the workers."""
+        self._closed = True
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.close()
+
+    def __enter__(self) -> "WorkerPool":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+
+class WorkerRun:
+    """Script run in a child of a warm worker."""
+
+    def __init__(self, pool: WorkerPool, worker: "_Worker", pid: int) -> None:
+        self.pool = pool
+        self.worker = worker
+        self.pid = pid
+
+    def wait(self) -> tuple[int, Optional[dict]]:
+        """Wait for the run to finish and release its worker.
+
+        Returns:
+            Return code of the script, as for a subprocess, and its user and system CPU
+            time, maximum resident set size and block I/O counts as reported by
+            ``os.wait4``, or None if the worker died
+        """
+        try:
+            reply = self.worker.reply()
+            return reply["returncode"], reply["rusage"]
+        except (ConnectionError, OSError, ValueError, KeyError) as e:
+            logger.error(f"Warm worker failed while running a script: {e!s}")
+            return -1, None
+        finally:
+            self.pool._idle.put(self.worker)
+
+
+class _Worker:
+    """Handle of one worker process."""
+
+    def __init__(self, preload: tuple[str, ...], env: Optional[dict]) -> None:
+        self.sock, worker_sock = socket.socketpair()
+        self.process = subprocess.Popen(  # noqa: S603
+            [sys.executable, __file__, str(worker_sock.fileno()), *preload],
+            env=env,
+            pass_fds=(worker_sock.fileno(),),
+            stdin=subprocess.DEVNULL,
+        )
+        worker_sock.close()
+        self.replies = self.sock.makefile("r")
+        self.ready = False
+        self.start_time = time.perf_counter()
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def reply(self) -> dict:
+        line = self.replies.readline()
+        if not line:
+            raise ConnectionError("Worker process exited")
+        return json.loads(line)
+
+    def start(
+        self,
+        script_path: str | Path,
+        env: dict,
+        stdout: int,
+        stderr: int,
+        cpu_seconds: Optional[float],
+        args: tuple[str, ...],
+    ) -> int:
+        if not self.ready:
+            # Wait for the preloaded imports, which the first run overlaps with
+            modules = self.reply()["ready"]
+            self.ready = True
+            logger.info(
+                f"Warm worker ready after {time.perf_counter() - self.start_time:.1f}s "
+                f"with {', '.join(modules) or 'no modules'} preloaded"
+            )
+        request = {
+            "script": str(Path(script_path).resolve()),
+            "env": env,
+            "cwd": os.getcwd(),
+            "cpu_seconds": cpu_seconds,
+            "args": list(args),
+        }
+        socket.send_fds(self.sock, [json.dumps(request).encode() + b"\n"], [stdout, stderr])
+        return self.reply()["pid"]
+
+    def close(self) -> None:
+        self.replies.close()
+        self.sock.close()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+def _send(sock: socket.socket, message: dict) -> None:
+    sock.sendall(json.dumps(message).encode() + b"\n")
+
+
+def _run_child(request: dict, fds: list[int]) -> None:
+    """Run the requested script in a forked child, which never returns."""
+    code = 1
+    script = request["script"]
+    try:
+        # New session, so that the run and its subprocesses can be stopped as a group
+        os.setsid()
+        if request.get("cpu_seconds") and resource is not None:
+            seconds = math.ceil(request["cpu_seconds"])
+            # The soft limit sends SIGXCPU, the hard limit a few seconds later SIGKILL
+            resource.setrlimit(resource.RLIMIT_CPU, (seconds, seconds + 5))
+        os.dup2(fds[0], 1)
+        os.dup2(fds[1], 2)
+        for fd in fds:
+            os.close(fd)
+        # Line-buffered, so that output is streamed as it is printed
+        sys.stdout = open(1, "w", buffering=1, closefd=False)  # noqa: SIM115, PTH123
+        sys.stderr = open(2, "w", buffering=1, closefd=False)  # noqa: SIM115, PTH123
+
+        os.environ.clear()
+        os.environ.update(request["env"])
+        os.chdir(request["cwd"])
+        # Same module search path as 'python script.py' with this environment
+        pythonpath = [p for p in request["env"].get("PYTHONPATH", "").split(os.pathsep) if p]
+        sys.path[0:1] = [str(Path(script).parent), *pythonpath]
+        sys.argv = [script, *request.get("args", [])]
+        # Exit handlers of the preloaded libraries belong to the worker, and some of them,
+        # e.g. polars', hang in a forked child. Only the script's own handlers are run.
+        atexit._clear()
+
+        try:
+            runpy.run_path(script, run_name="__main__")
+            code = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                code = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+        except BaseException as e:  # noqa: BLE001
+            # Print the traceback from the script's frames, as the interpreter would
+            tb = e.__traceback__
+            while tb is not None and tb.tb_frame.f_code.co_filename != script:
+                tb = tb.tb_next
+            traceback.print_exception(type(e), e, tb or e.__traceback__)
+        atexit._run_exitfuncs()
+    except BaseException:  # noqa: BLE001
+        traceback.print_exc()
+    finally:
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except Exception:  # noqa: BLE001, S110
+                pass
+        os._exit(code)
+
+
+def _serve(sock: socket.socket, preload: list[str]) -> None:
+    """Import the preloaded modules, then fork a child per request until the pool exits."""
+    modules = []
+    for module in preload:
+        try:
+            __import__(module)
+            modules.append(module)
+        except Exception:  # noqa: BLE001, S112
+            continue
+    _send(sock, {"ready": modules})
+
+    while True:
+        try:
+            message, fds, _, _ = socket.recv_fds(sock, MAX_MESSAGE_SIZE, 2)
+        except OSError:
+            return
+        if not message:
+            # The pool closed its end of the socket
+            return
+        request = json.loads(message)
+        pid = os.fork()
+        if pid == 0:
+            sock.close()
+            _run_child(request, fds)
+        for fd in fds:
+            os.close(fd)
+        _send(sock, {"pid": pid})
+        _, status, rusage = os.wait4(pid, 0)
+        _send(
+            sock,
+            {
+                "returncode": os.waitstatus_to_exitcode(status),
+                "rusage": {
+                    "utime": rusage.ru_utime,
+                    "stime": rusage.ru_stime,
+                    "maxrss": rusage.ru_maxrss,
+                    "inblock": rusage.ru_inblock,
+                    "oublock": rusage.ru_oublock,
+                },
+            },
+        )
+
+
+if __name__ == "__main__":
+    # Worker process, started by _Worker with the socket's file descriptor
+    _serve(socket.socket(fileno=int(sys.argv[1])), sys.argv[2:])
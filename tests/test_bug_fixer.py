@@ -0,0 +1,55 @@
+import sqlite3
+
+from pond_agent.competition.bug_fixer import BugFixer
+from pond_agent.competition.fix_memory import FixMemory
+
+from .test_fix_memory import ERROR, FIXED_SCRIPT, SCRIPT
+
+OTHER_ERROR = """Traceback (most recent call last):
+  File "/tmp/run_1/scripts/preprocess_data.py", line 6, in <module>
+    summary = train.group_by("user_id").agg(pl.len())
+polars.exceptions.ColumnNotFoundError: 'user_id'
+"""
+
+
+def make_fixer(tmp_path):
+    return BugFixer(None, memory=FixMemory(tmp_path / "fixes.sqlite"))
+
+
+def test_fix_is_stored_when_script_succeeds(tmp_path):
+    fixer = make_fixer(tmp_path)
+    fixer.track_fix(SCRIPT, ERROR, FIXED_SCRIPT)
+    fixer.report_outcome(0, "")
+    assert fixer.memory.lookup(SCRIPT, ERROR)
+
+
+def test_fix_leading_to_another_error_is_not_stored(tmp_path):
+    fixer = make_fixer(tmp_path)
+    fixer.track_fix(SCRIPT, ERROR, FIXED_SCRIPT)
+    fixer.report_outcome(1, OTHER_ERROR)
+    assert fixer.memory.lookup(SCRIPT, ERROR) == []
+
+
+def test_stored_fix_is_not_reinforced_by_another_error(tmp_path):
+    fixer = make_fixer(tmp_path)
+    fixer.memory.record(ERROR, SCRIPT, FIXED_SCRIPT)
+    assert fixer.recall_fix(SCRIPT, ERROR) == FIXED_SCRIPT
+    fixer.report_outcome(1, OTHER_ERROR)
+    with sqlite3.connect(fixer.memory.path) as conn:
+        assert conn.execute("SELECT successes, failures FROM fixes").fetchall() == [(1, 0)]
+
+
+def test_stored_fix_failing_with_same_error_is_dropped(tmp_path):
+    fixer = make_fixer(tmp_path)
+    fixer.memory.record(ERROR, SCRIPT, FIXED_SCRIPT)
+    assert fixer.recall_fix(SCRIPT, ERROR) == FIXED_SCRIPT
+    fixer.report_outcome(1, ERROR)
+    assert fixer.memory.lookup(SCRIPT, ERROR) == []
+
+
+def test_ambiguous_patch_is_not_applied(tmp_path):
+    code = "df = load()\ndf = df.drop_nulls()\nsave(df)\ndf = df.drop_nulls()\n"
+    response = (
+        "<<<<<<< SEARCH\ndf = df.drop_nulls()\n=======\ndf = df.fill_null(0)\n>>>>>>> REPLACE\n"
+    )
+    assert BugFixer._apply_patch(code, response) is None
@@ -0,0 +1,97 @@
+import json
+import sqlite3
+
+from pond_agent.competition.fix_memory import FixMemory, error_signature, make_edits
+
+SCRIPT = """import polars as pl
+
+path = "/data/run_1/train.parquet"
+train = pl.scan_parquet(path)
+print(train.columns)
+summary = train.group_by("user_id").agg(pl.len())
+"""
+
+FIXED_SCRIPT = SCRIPT.replace("pl.scan_parquet(path)", "pl.scan_parquet(path).collect()")
+
+ERROR = """Traceback (most recent call last):
+  File "/tmp/run_1/scripts/preprocess_data.py", line 5, in <module>
+    print(train.columns)
+  File "/usr/lib/python3.11/site-packages/polars/lazyframe/frame.py", line 42, in columns
+    return self._ldf.collect_schema()
+polars.exceptions.PerformanceWarning: Resolving the schema of 'train' at /tmp/run_1 took 3 s
+"""
+
+
+def test_error_signature_ignores_paths_and_numbers():
+    other = ERROR.replace("/tmp/run_1", "/home/me/run_2").replace("line 5,", "line 9,")
+    signature = error_signature(ERROR)
+    assert signature == error_signature(other.replace("3 s", "12 s"))
+    assert signature.startswith("PerformanceWarning | ")
+    assert "'train'" in signature
+    assert "<path>" in signature and "<n>" in signature
+    assert "print" in signature
+    assert "polars/lazyframe/frame.py:columns" in signature
+
+
+def test_error_signature_without_exception():
+    assert error_signature("Killed") is None
+
+
+def test_make_edits_stores_whole_lines_with_context():
+    edits = make_edits(SCRIPT, FIXED_SCRIPT)
+    assert edits == [
+        {
+            "search": 'path = "/data/run_1/train.parquet"\n'
+            "train = pl.scan_parquet(path)\n"
+            "print(train.columns)\n",
+            "replace": 'path = "/data/run_1/train.parquet"\n'
+            "train = pl.scan_parquet(path).collect()\n"
+            "print(train.columns)\n",
+        }
+    ]
+
+
+def test_make_edits_rejects_generic_edits():
+    assert make_edits("x = f(a)\ny = g(b)\n", "x = f(a)\ny = g(b, c)\n") is None
+
+
+def test_make_edits_rejects_ambiguous_edits():
+    block = "frame = load_table(path)\nframe = frame.sort('time')\n"
+    code = block + "print(frame)\n" + block
+    fixed = block + "print(frame)\n" + block.replace("sort('time')", "sort('ts')")
+    assert make_edits(code, fixed) is None
+
+
+def test_lookup_replays_fix_on_matching_script(tmp_path):
+    memory = FixMemory(tmp_path / "fixes.sqlite")
+    memory.record(ERROR, SCRIPT, FIXED_SCRIPT)
+    other_script = "import os\n" + SCRIPT + "print(summary)\n"
+    fixes = memory.lookup(other_script, ERROR)
+    assert len(fixes) == 1
+    assert fixes[0][1] == "import os\n" + FIXED_SCRIPT + "print(summary)\n"
+
+
+def test_lookup_skips_unrelated_script(tmp_path):
+    memory = FixMemory(tmp_path / "fixes.sqlite")
+    memory.record(ERROR, SCRIPT, FIXED_SCRIPT)
+    unrelated = "import polars as pl\nx = pl.read_parquet('a.parquet')\nprint(len(x))\n"
+    assert memory.lookup(unrelated, ERROR) == []
+
+
+def test_lookup_skips_generic_stored_edits(tmp_path):
+    path = tmp_path / "fixes.sqlite"
+    memory = FixMemory(path)
+    memory.record(ERROR, SCRIPT, FIXED_SCRIPT)
+    # A token-level edit as stored by earlier versions, which matches any closing call
+    edits = json.dumps([{"search": ")\n", "replace": ").collect()\n"}])
+    with sqlite3.connect(path) as conn:
+        conn.execute("UPDATE fixes SET edits = ?", (edits,))
+    assert memory.lookup("print(len(x))\n", ERROR) == []
+
+
+def test_failing_fixes_are_no_longer_returned(tmp_path):
+    memory = FixMemory(tmp_path / "fixes.sqlite")
+    memory.record(ERROR, SCRIPT, FIXED_SCRIPT)
+    [(edits_hash, _)] = memory.lookup(SCRIPT, ERROR)
+    memory.report(ERROR, edits_hash, success=False)
+    assert memory.lookup(SCRIPT, ERROR) == []
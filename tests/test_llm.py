@@ -0,0 +1,265 @@
+import asyncio
+import json
+import threading
+import time
+
+import anthropic
+import httpx
+import pytest
+
+from pond_agent.fake_llm import FakeAPIError, FakeLLM, LatencyModel
+from pond_agent.llm import LLMClient, ResponseCache, RetryPolicy, SlotSemaphore
+
+FAST = LatencyModel(ttft_median=0.01, ttft_sigma=0, tokens_per_second=1e5)
+SLOW = LatencyModel(ttft_median=5, ttft_sigma=0, tokens_per_second=1e5)
+
+
+def test_hedged_response_is_cached_as_the_model_that_answered(tmp_path):
+    client = LLMClient(
+        "fake",
+        "primary",
+        cache_dir=tmp_path,
+        record_telemetry=False,
+        fallback_targets=["fake:backup"],
+        hedge_delay=0.05,
+        fake_llm=FakeLLM(latency=SLOW, default_response="from primary"),
+    )
+    client._target_client("fake:backup").client = FakeLLM(
+        latency=FAST, default_response="from backup"
+    )
+    assert client.get_response("prompt", "system", json_response=False) == "from backup"
+
+    def cached(model_name):
+        key = ResponseCache.make_key("fake", model_name, "system", "prompt", 0.1, False)
+        return client.cache.get(key)
+
+    assert cached("primary") is None
+    assert cached("backup") == "from backup"
+
+
+def make_client(tmp_path, model_name="gpt-4o"):
+    return LLMClient(
+        "fake",
+        model_name,
+        use_cache=False,
+        record_telemetry=False,
+        fake_llm=FakeLLM(latency=FAST, default_response="{}"),
+    )
+
+
+def test_default_max_tokens_is_the_model_output_limit(tmp_path, monkeypatch):
+    client = make_client(tmp_path)
+    sent = []
+    original = client._send_with_retry
+
+    def send(prompt, system_prompt, json_response, temperature, max_tokens, *args, **kwargs):
+        sent.append(max_tokens)
+        return original(
+            prompt, system_prompt, json_response, temperature, max_tokens, *args, **kwargs
+        )
+
+    monkeypatch.setattr(client, "_send_with_retry", send)
+    client.get_response("Write a long script", json_response=False)
+    assert sent == [client.max_output_tokens]
+
+
+def test_continuation_requests_drop_json_mode(tmp_path):
+    client = make_client(tmp_path)
+    first = client._openai_request("prompt", "system", True, 0.1, 100, False)
+    assert first["response_format"] == {"type": "json_object"}
+    continuation = client._openai_request(
+        "prompt", "system", True, 0.1, 100, False, partial='{"summary": "cut'
+    )
+    assert "response_format" not in continuation
+    assert continuation["messages"][-2] == {"role": "assistant", "content": '{"summary": "cut'}
+
+
+def test_slot_semaphore_is_shared_by_threads_and_event_loops():
+    slots = SlotSemaphore(2)
+    in_flight = []
+    peak = []
+    lock = threading.Lock()
+
+    def hold():
+        with lock:
+            in_flight.append(1)
+            peak.append(len(in_flight))
+        time.sleep(0.02)
+        with lock:
+            in_flight.pop()
+
+    def thread_worker():
+        for _ in range(3):
+            slots.acquire()
+            try:
+                hold()
+            finally:
+                slots.release()
+
+    async def coroutine_worker():
+        await slots.aacquire()
+        try:
+            await asyncio.to_thread(hold)
+        finally:
+            slots.release()
+
+    async def loop_main():
+        await asyncio.wait_for(asyncio.gather(*(coroutine_worker() for _ in range(3))), 5)
+
+    # One thread and two event loops in their own threads compete for the slots
+    workers = [threading.Thread(target=thread_worker)]
+    workers += [threading.Thread(target=asyncio.run, args=(loop_main(),)) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=10)
+    assert len(peak) == 9
+    assert max(peak) <= 2
+
+
+def test_waiting_for_a_slot_does_not_block_the_event_loop():
+    slots = SlotSemaphore(1)
+
+    async def main():
+        slots.acquire()
+        waiter = asyncio.create_task(slots.aacquire())
+        ticks = 0
+        while ticks < 5:
+            await asyncio.sleep(0)
+            ticks += 1
+        assert not waiter.done()
+        # A cancelled waiter gives up its place without taking the slot
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        slots.release()
+        await asyncio.wait_for(slots.aacquire(), 1)
+        slots.release()
+
+    asyncio.run(main())
+    assert slots._value == 1
+
+
+class FlakyLLM(FakeLLM):
+    """Fails the first request of each prompt with a 503 and a Retry-After delay."""
+
+    def __init__(self, retry_after):
+        super().__init__(latency=FAST, default_response="ok")
+        self.retry_after = retry_after
+        self.failed = set()
+        self.finished = []
+
+    def complete(self, prompt, *args, **kwargs):
+        if prompt == "flaky" and prompt not in self.failed:
+            self.failed.add(prompt)
+            raise FakeAPIError("overloaded", 503, retry_after=self.retry_after)
+        response = super().complete(prompt, *args, **kwargs)
+        self.finished.append(prompt)
+        return response
+
+
+def test_retry_backoff_does_not_hold_a_concurrency_slot(tmp_path):
+    fake = FlakyLLM(retry_after=0.5)
+    client = LLMClient(
+        "fake",
+        "gpt-4o",
+        use_cache=False,
+        record_telemetry=False,
+        max_concurrency=1,
+        retry_policy=RetryPolicy(base_delay=0),
+        fake_llm=fake,
+    )
+    flaky = threading.Thread(
+        target=client.get_response, args=("flaky",), kwargs={"json_response": False}
+    )
+    flaky.start()
+    time.sleep(0.1)
+    # Sent while the flaky request waits to retry, so it gets the only slot
+    assert client.get_response("steady", json_response=False) == "ok"
+    flaky.join(timeout=5)
+    assert fake.finished == ["steady", "flaky"]
+
+
+MESSAGE = {
+    "id": "msg_1",
+    "type": "message",
+    "role": "assistant",
+    "model": "claude-sonnet-4-20250514",
+    "content": [{"type": "text", "text": "hello"}],
+    "stop_reason": "end_turn",
+    "stop_sequence": None,
+    "usage": {"input_tokens": 3, "output_tokens": 1},
+}
+
+
+def anthropic_events():
+    start = {**MESSAGE, "content": [], "stop_reason": None}
+    start["usage"] = {"input_tokens": 3, "output_tokens": 0}
+    events = [
+        ("message_start", {"type": "message_start", "message": start}),
+        (
+            "content_block_start",
+            {"type": "content_block_start", "index": 0,
+             "content_block": {"type": "text", "text": ""}},
+        ),
+        (
+            "content_block_delta",
+            {"type": "content_block_delta", "index": 0,
+             "delta": {"type": "text_delta", "text": "hello"}},
+        ),
+        ("content_block_stop", {"type": "content_block_stop", "index": 0}),
+        (
+            "message_delta",
+            {"type": "message_delta", "delta": {"stop_reason": "end_turn",
+             "stop_sequence": None}, "usage": {"output_tokens": 1}},
+        ),
+        ("message_stop", {"type": "message_stop"}),
+    ]
+    return "".join(f"event: {name}\ndata: {json.dumps(data)}\n\n" for name, data in events)
+
+
+def test_long_anthropic_requests_are_streamed(monkeypatch):
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "test")
+    requests = []
+
+    def handler(request):
+        body = json.loads(request.content)
+        requests.append(body)
+        if body.get("stream"):
+            return httpx.Response(
+                200, text=anthropic_events(), headers={"content-type": "text/event-stream"}
+            )
+        return httpx.Response(200, json=MESSAGE)
+
+    client = LLMClient(
+        "anthropic", "claude-sonnet-4-20250514", use_cache=False, record_telemetry=False
+    )
+    # The SDK checks non-streaming requests for their max_tokens before sending them
+    client.client = anthropic.Anthropic(
+        api_key="test",
+        max_retries=0,
+        http_client=httpx.Client(transport=httpx.MockTransport(handler)),
+    )
+    assert client.get_response("hi", json_response=False) == "hello"
+    assert client.get_response("hi", json_response=False, max_tokens=1000) == "hello"
+    assert [(r["max_tokens"], r.get("stream", False)) for r in requests] == [
+        (client.max_output_tokens, True),
+        (1000, False),
+    ]
+
+    # Hedged attempts go through _acomplete without streaming and without max_tokens
+    async def acomplete():
+        client._async_client = anthropic.AsyncAnthropic(
+            api_key="test",
+            max_retries=0,
+            http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+        )
+        client._async_loop = asyncio.get_running_loop()
+        return await client._acomplete(
+            "hi", "", False, 0.1, None, False, None, client._new_stats()
+        )
+
+    assert asyncio.run(acomplete()) == "hello"
+    assert (requests[-1]["max_tokens"], requests[-1]["stream"]) == (
+        client.max_output_tokens, True
+    )
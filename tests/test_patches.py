@@ -0,0 +1,138 @@
+from pond_agent.competition.patches import (
+    apply_edits,
+    code_window,
+    failing_lines,
+    parse_edits,
+    trim_traceback,
+)
+
+SCRIPT = """import pandas as pd
+import polars as pl
+
+train = pl.read_parquet("train.parquet")
+train = train.groupby("user_id").agg(pl.len())
+train.write_parquet("out.parquet")
+"""
+
+ERROR = """Loading data
+Traceback (most recent call last):
+  File "/tmp/scripts/preprocess_data.py", line 5, in <module>
+    train = train.groupby("user_id").agg(pl.len())
+            ^^^^^^^^^^^^^
+  File "/usr/lib/python3.11/site-packages/polars/dataframe/frame.py", line 10, in __getattr__
+    return self._df.getattr(name)
+  File "/usr/lib/python3.11/site-packages/polars/_utils/wrap.py", line 20, in getattr
+    raise AttributeError(name)
+AttributeError: 'DataFrame' object has no attribute 'groupby'
+"""
+
+
+def test_parse_edits():
+    response = """Fix the renamed method:
+<<<<<<< SEARCH
+train = train.groupby("user_id").agg(pl.len())
+=======
+train = train.group_by("user_id").agg(pl.len())
+>>>>>>> REPLACE
+<<<<<<< SEARCH
+=======
+print("empty search")
+>>>>>>> REPLACE
+"""
+    assert parse_edits(response) == [
+        {
+            "search": 'train = train.groupby("user_id").agg(pl.len())\n',
+            "replace": 'train = train.group_by("user_id").agg(pl.len())\n',
+        }
+    ]
+    assert parse_edits("no edits here") == []
+
+
+def test_apply_edits():
+    edits = [{"search": ".groupby(", "replace": ".group_by("}]
+    assert apply_edits(SCRIPT, edits) == SCRIPT.replace(".groupby(", ".group_by(")
+
+
+def test_apply_edits_tolerates_trailing_whitespace():
+    edits = [
+        {
+            "search": 'train = pl.read_parquet("train.parquet")   \n',
+            "replace": 'train = pl.read_parquet("data/train.parquet")',
+        }
+    ]
+    fixed = apply_edits(SCRIPT, edits)
+    assert 'train = pl.read_parquet("data/train.parquet")\ntrain = train.groupby' in fixed
+
+
+def test_apply_edits_rejects_missing_search_and_invalid_result():
+    assert apply_edits(SCRIPT, [{"search": "missing", "replace": "x"}]) is None
+    assert apply_edits(SCRIPT, [{"search": "import pandas as pd", "replace": "import ("}]) is None
+
+
+def test_apply_edits_rejects_ambiguous_search():
+    code = "x = load(a)\ny = load(a)\n"
+    edits = [{"search": "load(a)", "replace": "load(b)"}]
+    assert apply_edits(code, edits) is None
+    assert apply_edits(code, edits, exact=True) is None
+    assert apply_edits(code, [{"search": "y = load(a)", "replace": "y = 1"}], exact=True) == (
+        "x = load(a)\ny = 1\n"
+    )
+    # Copies that differ in trailing whitespace are ambiguous too
+    code = "df = df.drop_nulls()  \nprint(df)\ndf = df.drop_nulls()\n"
+    assert apply_edits(code, [{"search": "df = df.drop_nulls()\n", "replace": ""}]) is None
+
+
+def test_patch_matching_outside_the_shown_window_is_rejected():
+    lines = [f"step_{i} = {i}" for i in range(40)]
+    lines[2] = lines[35] = "df = df.drop_nulls()"
+    code = "\n".join(lines) + "\n"
+    window = code_window(code, [36], context=3)
+    assert "step_2 = 2" not in window
+    assert "df = df.drop_nulls()" in window
+    edits = [{"search": "df = df.drop_nulls()\n", "replace": "df = df.fill_null(0)\n"}]
+    assert apply_edits(code, edits) is None
+    # Enough lines to be unique, as the prompt asks for, apply at the intended place
+    edits = [
+        {
+            "search": "step_34 = 34\ndf = df.drop_nulls()\n",
+            "replace": "step_34 = 34\ndf = df.fill_null(0)\n",
+        }
+    ]
+    fixed = apply_edits(code, edits).splitlines()
+    assert fixed[2] == "df = df.drop_nulls()"
+    assert fixed[35] == "df = df.fill_null(0)"
+
+
+def test_trim_traceback():
+    trimmed = trim_traceback(ERROR, tail_lines=2)
+    assert trimmed.splitlines() == [
+        "...",
+        "Traceback (most recent call last):",
+        '  File "/tmp/scripts/preprocess_data.py", line 5, in <module>',
+        '    train = train.groupby("user_id").agg(pl.len())',
+        "  ...",
+        "    raise AttributeError(name)",
+        "AttributeError: 'DataFrame' object has no attribute 'groupby'",
+    ]
+
+
+def test_trim_traceback_without_traceback():
+    error = "\n".join(f"line {i}" for i in range(100))
+    trimmed = trim_traceback(error).splitlines()
+    assert trimmed[0] == "..."
+    assert trimmed[-1] == "line 99"
+
+
+def test_failing_lines():
+    assert failing_lines(ERROR, line_count=6) == [5]
+    assert failing_lines(ERROR, line_count=4) == []
+    preflight = "script.py was not run:\n- line 3: name 'x' is not defined\n"
+    assert failing_lines(preflight, line_count=6) == [3]
+
+
+def test_code_window():
+    window = code_window(SCRIPT, [5], context=0)
+    assert window == (
+        "Lines 1-2 of 6:\n```python\nimport pandas as pd\nimport polars as pl\n```\n\n"
+        'Lines 5-5 of 6:\n```python\ntrain = train.groupby("user_id").agg(pl.len())\n```'
+    )
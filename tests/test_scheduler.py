@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+
+from pond_agent.competition.scheduler import TaskGraph
+
+
+def test_steps_start_after_their_dependencies():
+    started = []
+
+    def step(name):
+        async def run():
+            started.append(name)
+            await asyncio.sleep(0.01)
+            return name
+
+        return run
+
+    graph = TaskGraph()
+    graph.add("a", step("a"))
+    graph.add("b", step("b"))
+    graph.add("c", step("c"), after=["a", "b"])
+    assert asyncio.run(graph.run()) == {"a": "a", "b": "b", "c": "c"}
+    assert started[-1] == "c"
+
+
+def test_failure_cancels_other_steps():
+    async def fail():
+        raise RuntimeError("failed")
+
+    graph = TaskGraph()
+    graph.add("fail", fail)
+    graph.add("slow", lambda: asyncio.sleep(10))
+    graph.add("after", lambda: asyncio.sleep(0), after=["fail"])
+    with pytest.raises(RuntimeError, match="failed"):
+        asyncio.run(asyncio.wait_for(graph.run(), timeout=5))
+
+
+def test_dependencies_must_be_added_first():
+    graph = TaskGraph()
+    with pytest.raises(ValueError):
+        graph.add("b", lambda: asyncio.sleep(0), after=["a"])
+    graph.add("a", lambda: asyncio.sleep(0))
+    with pytest.raises(ValueError):
+        graph.add("a", lambda: asyncio.sleep(0))
@@ -0,0 +1,32 @@
+import polars as pl
+import pyarrow.parquet as pq
+
+from pond_agent.competition.utils import read_parquet_metadata
+
+
+def test_null_counts_from_statistics(tmp_path):
+    path = tmp_path / "train.parquet"
+    pl.DataFrame({"id": [1, 2, 3], "x": [1.0, None, None]}).write_parquet(path)
+    meta = read_parquet_metadata(path)
+    assert meta["shape"] == (3, 2)
+    assert meta["schema"] == {"id": pl.Int64, "x": pl.Float64}
+    assert meta["null_counts"] == {"id": 0, "x": 2}
+
+
+def test_null_counts_without_statistics(tmp_path):
+    table = pl.DataFrame({"x": [1, None, 3], "tags": [["a"], None, []]}).to_arrow()
+    for part in range(2):
+        pq.write_table(table, tmp_path / f"part_{part}.parquet", write_statistics=False)
+    meta = read_parquet_metadata(tmp_path)
+    assert meta["shape"] == (6, 2)
+    assert meta["null_counts"] == {"x": 2, "tags": 2}
+
+
+def test_null_counts_of_hive_partition_keys(tmp_path):
+    for day in ["2024-01-01", "2024-01-02"]:
+        directory = tmp_path / f"day={day}"
+        directory.mkdir()
+        pl.DataFrame({"x": [1, None]}).write_parquet(directory / "data.parquet")
+    meta = read_parquet_metadata(tmp_path)
+    assert meta["shape"] == (4, 2)
+    assert meta["null_counts"] == {"x": 2, "day": 0}